@@ -0,0 +1,249 @@
+"""
+__author__          ==  Amit Parag
+__organization__    ==  Sintef Ocean
+__description__     ==  Picks the batch size, DataLoader worker count and torch thread count with the highest
+                        training throughput on the current machine.
+
+                        Every candidate runs a few training steps in a fresh process, so its peak memory can be
+                        measured on its own and a candidate that runs out of memory does not take the tuner down.
+                        The search is coordinate-wise (threads, then batch size, then workers) and skips every
+                        candidate whose peak memory exceeds the ceiling. The result is cached per host and model
+                        configuration in trained_models/autotune.json.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import resource
+import multiprocessing
+
+import torch
+from torch.utils.data import DataLoader
+from torchvision.transforms import Compose, ToTensor
+
+from dataset_manager import VideoDataset
+from train import build_video_vision_transformer, build_resnet, frames_of
+from utils import colored_print
+
+
+# ru_maxrss is in kilobytes on Linux and in bytes on macOS
+_MAXRSS_PER_MB = 1024 ** 2 if sys.platform == 'darwin' else 1024
+
+
+def _meminfo_mb(field):
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _sysconf_mb(pages):
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf(pages) / 1024 ** 2
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _total_memory_mb():
+    # /proc/meminfo on Linux, sysconf elsewhere; None if neither is there
+    memory_mb = _meminfo_mb('MemTotal')
+    return memory_mb if memory_mb is not None else _sysconf_mb('SC_PHYS_PAGES')
+
+
+def _available_memory_mb():
+    memory_mb = _meminfo_mb('MemAvailable')
+    return memory_mb if memory_mb is not None else _sysconf_mb('SC_AVPHYS_PAGES')
+
+
+def _available_cores():
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+
+def _cycle(loader):
+    while True:
+        for batch in loader:
+            yield batch
+
+
+def _measure(config, project_dir, model_name, frames, vvt_params, cache_dir, steps, result_queue):
+    # Runs in its own process: peak RSS below belongs to this candidate only
+    torch.set_num_threads(config['num_threads'])
+    model = build_video_vision_transformer(frames, vvt_params) if model_name == 'vvt' else build_resnet()
+    model.train()
+
+    dataset = VideoDataset(os.path.join(project_dir, 'train'), transform=Compose([ToTensor()]), cache_dir=cache_dir)
+    loader = DataLoader(dataset, batch_size=config['batch_size'], shuffle=True, num_workers=config['num_workers'], drop_last=len(dataset) >= config['batch_size'])
+    criterion = torch.nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+
+    batches = _cycle(loader)
+
+    def train_step():
+        videos, labels = next(batches)
+        optimizer.zero_grad()
+        loss = criterion(model(videos), labels)
+        loss.backward()
+        optimizer.step()
+        return labels.size(0)
+
+    # Warm-up step starts the workers and allocates the buffers
+    train_step()
+
+    samples = 0
+    start = time.perf_counter()
+    for _ in range(steps):
+        samples += train_step()
+    elapsed = time.perf_counter() - start
+
+    # Shut the workers down so their peak RSS shows up under RUSAGE_CHILDREN
+    del batches
+    worker_peak_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / _MAXRSS_PER_MB
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / _MAXRSS_PER_MB + config['num_workers'] * worker_peak_mb
+
+    result_queue.put({'samples_per_s': samples / elapsed, 'peak_memory_mb': peak_mb})
+
+
+class AutoTuner:
+    def __init__(self, project_dir, model_name='vvt', vvt_params=None, memory_limit_mb=None, steps=5, cache_dir=None,
+                 cache_file='./trained_models/autotune.json', timeout=600):
+        """
+        Parameters:
+        - project_dir: Dataset directory, e.g. './datasets/5_Frames'. The number of frames is taken from its name.
+        - model_name: 'vvt' or 'resnet'.
+        - vvt_params: ViT parameters, see train.build_video_vision_transformer.
+        - memory_limit_mb: Memory ceiling for a candidate. Defaults to 80% of the memory available now, or no ceiling
+                           if the available memory cannot be read on this platform.
+        - steps: Number of timed training steps per candidate (after one warm-up step).
+        - cache_dir: Decoded video cache, see VideoDataset.
+        - cache_file: JSON file holding the tuned configurations per host and model configuration.
+        - timeout: Seconds after which a candidate is considered failed.
+        """
+        self.project_dir = project_dir
+        self.model_name = model_name
+        self.frames = frames_of(os.path.basename(os.path.normpath(project_dir)))
+        self.vvt_params = vvt_params
+        available_memory_mb = _available_memory_mb()
+        if memory_limit_mb is None and available_memory_mb is not None:
+            memory_limit_mb = 0.8 * available_memory_mb
+        self.memory_limit_mb = memory_limit_mb
+        self.steps = steps
+        self.cache_dir = cache_dir
+        self.cache_file = cache_file
+        self.timeout = timeout
+
+    def cache_key(self):
+        # Nodes differ in core count and RAM, so both are part of the key
+        total_memory_mb = _total_memory_mb()
+        return json.dumps({
+            'host': socket.gethostname(),
+            'cores': _available_cores(),
+            'memory_mb': None if total_memory_mb is None else round(total_memory_mb),
+            'model': self.model_name,
+            'frames': self.frames,
+            'vvt_params': self.vvt_params
+        }, sort_keys=True)
+
+    def _load_cache(self):
+        if not os.path.exists(self.cache_file):
+            return {}
+        with open(self.cache_file) as f:
+            return json.load(f)
+
+    def _save_result(self, result):
+        cache = self._load_cache()
+        cache[self.cache_key()] = result
+        os.makedirs(os.path.dirname(self.cache_file) or '.', exist_ok=True)
+        temporary_file = f"{self.cache_file}.{os.getpid()}.tmp"
+        with open(temporary_file, 'w') as f:
+            json.dump(cache, f, indent=2)
+        os.replace(temporary_file, self.cache_file)
+
+    def measure(self, config):
+        """
+        Runs one candidate in a fresh process.
+
+        Returns:
+        - dict: samples_per_s and peak_memory_mb, or None if the candidate crashed, timed out or exceeded the memory ceiling.
+        """
+        context = multiprocessing.get_context('spawn')
+        result_queue = context.Queue()
+        process = context.Process(target=_measure, args=(config, self.project_dir, self.model_name, self.frames, self.vvt_params, self.cache_dir, self.steps, result_queue))
+        process.start()
+        try:
+            result = result_queue.get(timeout=self.timeout)
+        except Exception:
+            result = None
+        process.join(timeout=10)
+        if process.is_alive():
+            process.kill()
+
+        if result is None:
+            colored_print(f"  {config}: failed", color_code=31)
+            return None
+        if self.memory_limit_mb is not None and result['peak_memory_mb'] > self.memory_limit_mb:
+            colored_print(f"  {config}: {result['peak_memory_mb']:.0f} MB exceeds the {self.memory_limit_mb:.0f} MB ceiling", color_code=33)
+            return None
+
+        colored_print(f"  {config}: {result['samples_per_s']:.1f} samples/s, {result['peak_memory_mb']:.0f} MB", color_code=36)
+        return result
+
+    def tune(self, batch_sizes=(8, 16, 32, 64, 128), worker_counts=None, thread_counts=None, use_cache=True):
+        """
+        Searches threads, then batch size, then workers, keeping the best value of each.
+
+        Parameters:
+        - batch_sizes: Candidate batch sizes, in increasing order.
+        - worker_counts: Candidate DataLoader workers. Defaults to 0, 2, 4, ... up to the number of cores.
+        - thread_counts: Candidate torch threads. Defaults to 1, 2, 4, ... up to the number of cores.
+        - use_cache: Return the cached result for this host and model configuration if there is one.
+
+        Returns:
+        - dict: batch_size, num_workers, num_threads, samples_per_s and peak_memory_mb.
+        """
+        if use_cache:
+            cached = self._load_cache().get(self.cache_key())
+            if cached is not None:
+                colored_print(f"Using cached autotune result: {cached}", color_code=36)
+                return cached
+
+        cores = _available_cores()
+        powers_of_two = [2 ** i for i in range(cores.bit_length()) if 2 ** i <= cores]
+        thread_counts = list(thread_counts or sorted(set(powers_of_two + [cores])))
+        worker_counts = list(worker_counts or sorted({0} | {n for n in powers_of_two if n >= 2}))
+
+        best_config = {'batch_size': batch_sizes[0], 'num_workers': min(4, cores), 'num_threads': cores}
+        best_result = None
+
+        for name, candidates in [('num_threads', thread_counts), ('batch_size', batch_sizes), ('num_workers', worker_counts)]:
+            colored_print(f"Tuning {name} over {list(candidates)}", color_code=36)
+            for value in candidates:
+                config = {**best_config, name: value}
+                result = self.measure(config)
+                if result is None:
+                    # Larger batches will not fit either
+                    if name == 'batch_size':
+                        break
+                    continue
+                if best_result is None or result['samples_per_s'] > best_result['samples_per_s']:
+                    best_config, best_result = config, result
+
+        if best_result is None:
+            if self.memory_limit_mb is None:
+                raise RuntimeError("No configuration ran")
+            raise RuntimeError(f"No configuration fits in {self.memory_limit_mb:.0f} MB")
+
+        tuned = {**best_config, **best_result}
+        self._save_result(tuned)
+        colored_print(f"Autotune result: {tuned}", color_code=32)
+        return tuned
+
+
+if __name__ == '__main__':
+    tuner = AutoTuner('./datasets/5_Frames', model_name='vvt')
+    tuner.tune()
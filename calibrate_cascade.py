@@ -0,0 +1,169 @@
+"""
+__author__          ==  Amit Parag
+__organization__    ==  Sintef Ocean
+__description__     ==  Calibrates the cascade of cascade.py on the validation split: finds the smallest uncertainty
+                        margin of the first stage (the fewest second-stage runs) at which the cascade still reaches a
+                        target slip recall, and writes it to a JSON file for CascadeClassifier.from_calibration.
+
+                        python calibrate_cascade.py ./trained_models/5_Frames/frame_difference.npz ./trained_models/5_Frames/vvt_checkpoint_epoch75.onnx --dataset ./datasets/5_Frames --fit-first-stage --target-recall 0.95
+"""
+
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+from torch.utils.data import DataLoader
+from torchvision.transforms import Compose, ToTensor
+
+from cascade import SLIP, FrameDifferenceClassifier, load_stage
+from dataset_manager import VideoDataset
+from utils import colored_print
+
+
+def _loader(dataset_dir, split, batch_size, num_workers):
+    dataset = VideoDataset(os.path.join(dataset_dir, split), transform=Compose([ToTensor()]))
+    return DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+
+
+def collect_outputs(stage, loader):
+    """
+    Runs a stage on every clip of a loader.
+
+    Returns:
+    - tuple: Slip probabilities, labels, and the mean latency per clip in milliseconds.
+    """
+    probabilities, labels, seconds = [], [], 0.0
+    for videos, batch_labels in loader:
+        videos = videos.numpy()
+        start_time = time.perf_counter()
+        _, slip_probabilities = stage.predict(videos)
+        seconds += time.perf_counter() - start_time
+        probabilities.append(np.asarray(slip_probabilities, dtype=np.float32))
+        labels.append(batch_labels.numpy())
+    probabilities, labels = np.concatenate(probabilities), np.concatenate(labels)
+    return probabilities, labels, 1000 * seconds / len(labels)
+
+
+def cascade_metrics(first_probabilities, second_probabilities, labels, margin, threshold=0.5):
+    """
+    Metrics of the cascade with a given margin, from the outputs of both stages on the same clips.
+
+    Returns:
+    - dict: Recall and precision of slip, accuracy, and the fraction of clips deferred to the second stage.
+    """
+    deferred = np.abs(first_probabilities - threshold) < margin
+    probabilities = np.where(deferred, second_probabilities, first_probabilities)
+    predicted_slip, slip = probabilities >= threshold, labels == SLIP
+
+    true_positives = np.sum(predicted_slip & slip)
+    return {
+        'Recall': true_positives / max(np.sum(slip), 1),
+        'Precision': true_positives / max(np.sum(predicted_slip), 1),
+        'Accuracy': float(np.mean(predicted_slip == slip)),
+        'Deferral Rate': float(np.mean(deferred))
+    }
+
+
+def calibrate_margin(first_probabilities, second_probabilities, labels, target_recall, threshold=0.5):
+    """
+    Returns the smallest margin at which the cascade reaches target_recall of slip, or the margin that defers every clip
+    (the second stage alone) if no margin does.
+    """
+    distances = np.abs(first_probabilities - threshold)
+    # A margin just above a distance defers that clip; 0 defers none, above 0.5 all of them
+    candidates = np.concatenate([[0.0], np.nextafter(np.unique(distances), np.inf), [np.nextafter(0.5, np.inf)]])
+    for margin in candidates:
+        if cascade_metrics(first_probabilities, second_probabilities, labels, margin, threshold)['Recall'] >= target_recall:
+            return float(margin)
+    colored_print(f"No margin reaches a recall of {target_recall}, every clip goes to the second stage", color_code=33)
+    return float(candidates[-1])
+
+
+def fit_frame_difference_stage(dataset_dir, output_path, batch_size=8, num_workers=4):
+    """
+    Fits a FrameDifferenceClassifier on the training split and saves it to output_path (.npz).
+    """
+    classifier = FrameDifferenceClassifier()
+    features, labels = [], []
+    for videos, batch_labels in _loader(dataset_dir, 'train', batch_size, num_workers):
+        features.append(classifier.features(videos.numpy()))
+        labels.append(batch_labels.numpy())
+    classifier.fit(np.concatenate(features), np.concatenate(labels))
+    classifier.save(output_path)
+    colored_print(f"Frame difference first stage written to {output_path}", color_code=36)
+    return classifier
+
+
+def calibrate_cascade(first_stage_path, second_stage_path, dataset_dir, target_recall=0.95, threshold=0.5, first_stage_frames=None,
+                      first_stage_downsample=1, output_path=None, batch_size=8, num_workers=4):
+    """
+    Tunes the margin of the cascade on the validation split and compares it with both stages alone.
+
+    Parameters:
+    - first_stage_path: Cheap model, .npz (FrameDifferenceClassifier) or .onnx.
+    - second_stage_path: Full model, .onnx.
+    - dataset_dir: Dataset directory, e.g. './datasets/5_Frames'.
+    - target_recall: Slip recall the cascade has to reach on the validation split.
+    - threshold: Slip probability threshold of the detector.
+    - first_stage_frames: Frames of the window the first stage gets, e.g. [0, -1] for a 2-frame ViViT.
+    - first_stage_downsample: Downsampling of the frames the first stage gets, e.g. 2 for a ViViT trained on 120x160 frames.
+    - output_path: Calibration file, next to the first stage by default.
+
+    Returns:
+    - dict: The calibration: margin, threshold, target recall, and the metrics of the cascade on the validation split.
+    """
+    output_path = output_path or os.path.splitext(first_stage_path)[0] + '_cascade.json'
+    first_stage = load_stage(first_stage_path, first_stage_frames, downsample=first_stage_downsample)
+    second_stage = load_stage(second_stage_path)
+
+    loader = _loader(dataset_dir, 'validation', batch_size, num_workers)
+    first_probabilities, labels, first_latency = collect_outputs(first_stage, loader)
+    second_probabilities, _, second_latency = collect_outputs(second_stage, loader)
+
+    margin = calibrate_margin(first_probabilities, second_probabilities, labels, target_recall, threshold)
+    results = {
+        'First stage': cascade_metrics(first_probabilities, second_probabilities, labels, 0.0, threshold),
+        'Second stage': cascade_metrics(first_probabilities, second_probabilities, labels, 1.0, threshold),
+        'Cascade': cascade_metrics(first_probabilities, second_probabilities, labels, margin, threshold)
+    }
+    results['First stage']['Latency (ms)'] = first_latency
+    results['Second stage']['Latency (ms)'] = second_latency
+    # The first stage sees every clip, the second stage only the deferred ones
+    results['Cascade']['Latency (ms)'] = first_latency + results['Cascade']['Deferral Rate'] * second_latency
+
+    print("{:<15} {:<10} {:<10} {:<10} {:<10} {:<15}".format("", "Recall", "Precision", "Accuracy", "Deferred", "Latency (ms)"))
+    for name, metrics in results.items():
+        print("{:<15} {:<10.3f} {:<10.3f} {:<10.3f} {:<10.3f} {:<15.2f}".format(name, metrics['Recall'], metrics['Precision'], metrics['Accuracy'], metrics['Deferral Rate'], metrics['Latency (ms)']))
+
+    calibration = {
+        'margin': margin, 'threshold': threshold, 'target_recall': target_recall,
+        # Absolute, the detector loads the stages from docs/franka-servo
+        'first_stage': os.path.abspath(first_stage_path), 'second_stage': os.path.abspath(second_stage_path), 'first_stage_frames': first_stage_frames,
+        'first_stage_downsample': first_stage_downsample,
+        'validation': {name: {key: float(value) for key, value in metrics.items()} for name, metrics in results.items()}
+    }
+    with open(output_path, 'w') as calibration_file:
+        json.dump(calibration, calibration_file, indent=2)
+    colored_print(f"Cascade margin {margin:.4f} written to {output_path}", color_code=32)
+    return calibration
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tune the uncertainty margin of the two-stage cascade to a target slip recall.')
+    parser.add_argument('first_stage', help='Cheap model: FrameDifferenceClassifier (.npz) or ONNX model')
+    parser.add_argument('second_stage', help='Full model, ONNX (see onnx_export.py)')
+    parser.add_argument('--dataset', required=True, help='Dataset directory, e.g. ./datasets/5_Frames')
+    parser.add_argument('--target-recall', type=float, default=0.95)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    parser.add_argument('--first-stage-frames', type=int, nargs='+', default=None, help='Frames the first stage gets, e.g. 0 -1')
+    parser.add_argument('--first-stage-downsample', type=int, default=1, help='Downsampling of the frames the first stage gets, e.g. 2')
+    parser.add_argument('--fit-first-stage', action='store_true', help='Fit the FrameDifferenceClassifier (.npz) on the training split first')
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    if args.fit_first_stage:
+        fit_frame_difference_stage(args.dataset, args.first_stage)
+    calibrate_cascade(args.first_stage, args.second_stage, args.dataset, target_recall=args.target_recall, threshold=args.threshold,
+                      first_stage_frames=args.first_stage_frames, first_stage_downsample=args.first_stage_downsample, output_path=args.output)
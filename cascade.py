@@ -0,0 +1,204 @@
+"""
+__author__          ==  Amit Parag
+__organization__    ==  Sintef Ocean
+__description__     ==  Two-stage cascade for the live slip detector.
+
+                        A cheap first stage classifies every window. Only the windows it is unsure about
+                        (slip probability within a margin of the threshold) go to the full model, e.g. the
+                        5-frame ViViT or the ResNet-50 3D exported with onnx_export.py. The margin is tuned on
+                        the validation split to a target slip recall with calibrate_cascade.py.
+
+                        First stages:
+                        - FrameDifferenceClassifier: logistic regression on the change energy between the frames
+                          of the window, a few microseconds per window.
+                        - FrameSubsetClassifier: a model trained on fewer frames (e.g. the 2-frame ViViT) on a
+                          subset of the frames of the window, optionally downsampled for a model trained on
+                          smaller frames.
+
+                        Like onnx_engine, only needs numpy and onnxruntime. Every stage and the cascade have
+                        predict(videos) -> (classes, slip probabilities), so the cascade plugs into
+                        StreamingSlipDetector like a SlipDetectionEngine.
+"""
+
+import json
+
+import numpy as np
+
+from onnx_engine import CLASSES, SlipDetectionEngine
+
+
+SLIP = CLASSES.index('slip')
+
+
+class FrameDifferenceClassifier:
+    def __init__(self, weights=None, bias=0.0, mean=None, std=None, downsample=8):
+        """
+        Logistic regression of the slip probability on the change energy of a window: the mean, the maximum and the
+        first-to-last mean squared difference of consecutive grayscale frames, downsampled by downsample, on a log scale.
+
+        Parameters:
+        - weights, bias: Coefficients, see fit.
+        - mean, std: Standardization of the features, see fit.
+        - downsample (int): Spatial stride applied before the differences.
+        """
+        self.weights = np.zeros(3) if weights is None else np.asarray(weights, dtype=np.float64)
+        self.bias = float(bias)
+        self.mean = np.zeros(3) if mean is None else np.asarray(mean, dtype=np.float64)
+        self.std = np.ones(3) if std is None else np.asarray(std, dtype=np.float64)
+        self.downsample = downsample
+
+    def features(self, videos):
+        """
+        Parameters:
+        - videos: float32 array of shape (batch, 3, frames, height, width) with values in [0, 1].
+
+        Returns:
+        - np.ndarray: Features of shape (batch, 3).
+        """
+        gray = np.asarray(videos)[:, :, :, ::self.downsample, ::self.downsample].mean(axis=1)
+        steps = np.square(np.diff(gray, axis=1)).mean(axis=(2, 3))
+        overall = np.square(gray[:, -1] - gray[:, 0]).mean(axis=(1, 2))
+        return np.log(np.stack([steps.mean(axis=1), steps.max(axis=1), overall], axis=1) + 1e-8)
+
+    def slip_probability(self, features):
+        z = (features - self.mean) / self.std
+        return 1 / (1 + np.exp(-(z @ self.weights + self.bias)))
+
+    def fit(self, features, labels, l2=1e-2, iterations=50):
+        """
+        Fits the logistic regression with Newton's method.
+
+        Parameters:
+        - features: Features of the training clips, see features.
+        - labels: Class indices of the clips (see onnx_engine.CLASSES).
+        - l2: Ridge penalty of the weights.
+        """
+        self.mean = features.mean(axis=0)
+        self.std = features.std(axis=0) + 1e-8
+        x = np.hstack([(features - self.mean) / self.std, np.ones((len(features), 1))])
+        y = (np.asarray(labels) == SLIP).astype(np.float64)
+
+        theta = np.zeros(x.shape[1])
+        penalty = l2 * np.diag([1.0] * (x.shape[1] - 1) + [0.0])
+        for _ in range(iterations):
+            p = 1 / (1 + np.exp(-(x @ theta)))
+            gradient = x.T @ (p - y) + penalty @ theta
+            hessian = (x * (p * (1 - p))[:, None]).T @ x + penalty
+            step = np.linalg.solve(hessian, gradient)
+            theta -= step
+            if np.abs(step).max() < 1e-8:
+                break
+        self.weights, self.bias = theta[:-1], float(theta[-1])
+        return self
+
+    def predict(self, videos):
+        slip_probabilities = self.slip_probability(self.features(videos)).astype(np.float32)
+        classes = np.where(slip_probabilities >= 0.5, SLIP, 1 - SLIP)
+        return classes, slip_probabilities
+
+    def save(self, path):
+        np.savez(path, weights=self.weights, bias=self.bias, mean=self.mean, std=self.std, downsample=self.downsample)
+
+    @classmethod
+    def load(cls, path):
+        parameters = np.load(path)
+        return cls(parameters['weights'], float(parameters['bias']), parameters['mean'], parameters['std'], int(parameters['downsample']))
+
+
+class FrameSubsetClassifier:
+    def __init__(self, classifier, frame_indices=None, downsample=1):
+        """
+        Runs a classifier trained on fewer (and smaller) frames on a subset of the frames of each window.
+
+        Parameters:
+        - classifier: Object with predict(videos), e.g. a SlipDetectionEngine of the 2-frame ViViT.
+        - frame_indices (list): Frames of the window it gets, e.g. [0, -1] for the first and the last. None keeps all.
+        - downsample (int): Averages downsample x downsample pixel blocks, e.g. 2 turns 240x320 frames into 120x160
+                            for a model exported with image_size=(120, 160). 1 keeps the full resolution.
+        """
+        self.classifier = classifier
+        self.frame_indices = None if frame_indices is None else list(frame_indices)
+        self.downsample = downsample
+
+    def predict(self, videos):
+        videos = np.asarray(videos)
+        if self.frame_indices is not None:
+            videos = videos[:, :, self.frame_indices]
+        if self.downsample > 1:
+            # Block mean, the rows and columns that do not fill a block are left out
+            batch, channels, frames, height, width = videos.shape
+            height, width = height // self.downsample, width // self.downsample
+            blocks = videos[..., :height * self.downsample, :width * self.downsample]
+            videos = blocks.reshape(batch, channels, frames, height, self.downsample, width, self.downsample).mean(axis=(4, 6), dtype=np.float32)
+        return self.classifier.predict(np.ascontiguousarray(videos, dtype=np.float32))
+
+
+class CascadeClassifier:
+    def __init__(self, first_stage, second_stage, margin, threshold=0.5):
+        """
+        Parameters:
+        - first_stage: Cheap classifier that sees every window.
+        - second_stage: Full model, only for the windows the first stage is unsure about.
+        - margin (float): The first stage is unsure if its slip probability is within margin of threshold. 0 never
+                          runs the second stage, 0.5 always does. See calibrate_cascade.py.
+        - threshold (float): Slip probability threshold of the detector.
+        """
+        self.first_stage = first_stage
+        self.second_stage = second_stage
+        self.margin = margin
+        self.threshold = threshold
+
+        self.windows = 0
+        self.deferred = 0
+
+    def uncertain(self, slip_probabilities):
+        return np.abs(np.asarray(slip_probabilities) - self.threshold) < self.margin
+
+    def predict(self, videos):
+        """
+        Returns:
+        - tuple: The predicted class indices and the probability of slip, one per clip, from the second stage for the
+                 clips the first stage was unsure about.
+        """
+        classes, slip_probabilities = self.first_stage.predict(videos)
+        classes, slip_probabilities = np.array(classes), np.array(slip_probabilities, dtype=np.float32)
+
+        deferred = np.flatnonzero(self.uncertain(slip_probabilities))
+        if len(deferred):
+            deferred_classes, deferred_probabilities = self.second_stage.predict(np.asarray(videos)[deferred])
+            classes[deferred] = deferred_classes
+            slip_probabilities[deferred] = deferred_probabilities
+
+        self.windows += len(slip_probabilities)
+        self.deferred += len(deferred)
+        return classes, slip_probabilities
+
+    def deferral_rate(self):
+        """
+        Returns:
+        - float: Fraction of the windows so far that ran the second stage.
+        """
+        return self.deferred / self.windows if self.windows else 0.0
+
+    @classmethod
+    def from_calibration(cls, first_stage, second_stage, calibration_path):
+        """
+        Builds the cascade with the margin and threshold written by calibrate_cascade.calibrate_cascade.
+        """
+        with open(calibration_path) as calibration_file:
+            calibration = json.load(calibration_file)
+        return cls(first_stage, second_stage, calibration['margin'], calibration['threshold'])
+
+
+def load_stage(path, frame_indices=None, num_threads=None, downsample=1):
+    """
+    Loads a stage of the cascade: an ONNX model (onnx_export.py) or a FrameDifferenceClassifier (.npz).
+
+    Parameters:
+    - path: Path of the model.
+    - frame_indices: If given, the model gets only these frames of each window (see FrameSubsetClassifier).
+    - num_threads: Intra-op threads of an ONNX model.
+    - downsample: If above 1, the model gets the frames downsampled by this factor (see FrameSubsetClassifier).
+    """
+    stage = FrameDifferenceClassifier.load(path) if path.endswith('.npz') else SlipDetectionEngine(path, num_threads=num_threads)
+    return FrameSubsetClassifier(stage, frame_indices, downsample) if frame_indices or downsample > 1 else stage
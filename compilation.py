@@ -0,0 +1,81 @@
+"""
+__author__          ==  Amit Parag
+__organization__    ==  Sintef Ocean
+__description__     ==  Compiled model paths: torch.compile for training and inference, TorchScript for inference.
+
+                        The ViViT used here is tiny (dim=8, heads=2), so its latency is dominated by the
+                        dispatch overhead of many small ops rather than by arithmetic. Compiling fuses them.
+
+                        Both paths cache their artifacts on disk so later runs start warm:
+                        - torch.compile: the Inductor cache (generated kernels and FX graphs) is kept in
+                          <cache_dir>/inductor instead of /tmp. A later run recompiles from cache hits.
+                        - TorchScript: the frozen, traced module is saved as <cache_dir>/<key>.pt, keyed on
+                          the torch version, the model weights and the input shape, and loaded as is.
+"""
+
+import os
+import hashlib
+
+import torch
+
+from utils import colored_print
+
+
+COMPILE_MODES = ('compile', 'torchscript')
+
+
+def set_compile_cache_dir(cache_dir):
+    """
+    Keeps the torch.compile (Inductor) cache in cache_dir, so it survives reboots and is shared by later runs.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cache_dir)
+
+
+def _torchscript_path(model, example_input, cache_dir):
+    digest = hashlib.sha1()
+    digest.update(f"{torch.__version__}:{type(model).__name__}:{tuple(example_input.shape)}:{example_input.dtype}".encode())
+    for name, tensor in model.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return os.path.join(cache_dir, f"{type(model).__name__}_{digest.hexdigest()[:16]}.pt")
+
+
+def compile_model(model, mode='compile', example_input=None, cache_dir='./trained_models/compile_cache'):
+    """
+    Compiles a model, reusing the artifacts of earlier runs when possible.
+
+    Parameters:
+    - model: The ViViT or ResNet model.
+    - mode: 'compile' compiles the forward pass in place with torch.compile (training and inference, the
+            state dict is unchanged). 'torchscript' returns a traced and frozen module (inference only).
+    - example_input: Input used for tracing, e.g. torch.randn(1, 3, 5, 240, 320). Required for 'torchscript'.
+    - cache_dir: Directory for the compilation artifacts.
+
+    Returns:
+    - nn.Module: The compiled model. The first call of a torch.compile model triggers the compilation.
+    """
+    if mode == 'compile':
+        set_compile_cache_dir(os.path.join(cache_dir, 'inductor'))
+        model.compile()
+        return model
+
+    if mode == 'torchscript':
+        if example_input is None:
+            raise ValueError("TorchScript needs an example_input to trace the model")
+        os.makedirs(cache_dir, exist_ok=True)
+        script_path = _torchscript_path(model, example_input, cache_dir)
+        if os.path.exists(script_path):
+            colored_print(f"Loading TorchScript model from {script_path}", color_code=36)
+            return torch.jit.load(script_path)
+
+        model.eval()
+        with torch.no_grad():
+            traced_model = torch.jit.freeze(torch.jit.trace(model, example_input))
+        temporary_path = f"{script_path}.{os.getpid()}.tmp"
+        torch.jit.save(traced_model, temporary_path)
+        os.replace(temporary_path, script_path)
+        colored_print(f"TorchScript model saved to {script_path}", color_code=36)
+        return traced_model
+
+    raise ValueError(f"Unknown compile mode '{mode}', expected one of {list(COMPILE_MODES)}")
@@ -1,8 +1,11 @@
 import os
 import random
+import hashlib
+import numpy as np
 import torch
 import shutil  # Added import for shutil
 from torch.utils.data import DataLoader, Dataset
+from torch.utils.data.distributed import DistributedSampler
 from torchvision.transforms import Compose, ToTensor
 import imageio
 
@@ -35,7 +38,7 @@ class MakeDatasets:
                     os.makedirs(class_dir)
 
                 source_videos = source_slip_videos if class_name == 'slip' else source_wriggle_videos
-                video_files = [f for f in os.listdir(source_videos) if f.endswith('.avi')]
+                video_files = [f for f in os.listdir(source_videos) if f.endswith(('.avi', '.npy'))]
                 random.shuffle(video_files)  # Shuffle video files
 
                 split_ratio = split_ratios[subsets.index(subset)]
@@ -74,7 +77,7 @@ class MakeDatasets:
                     os.makedirs(class_dir)
 
                 source_videos = source_slip_videos if class_name == 'slip' else source_wriggle_videos
-                video_files = [f for f in os.listdir(source_videos) if f.endswith('.avi')]
+                video_files = [f for f in os.listdir(source_videos) if f.endswith(('.avi', '.npy'))]
                 random.shuffle(video_files)  # Shuffle video files
 
                 split_ratio = split_ratios[subsets.index(subset)]
@@ -88,26 +91,33 @@ class MakeDatasets:
         print("Directory structure and video copying completed.")
 
 class VideoDataset(Dataset):
-    def __init__(self, data_dir, transform=None):
+    def __init__(self, data_dir, transform=None, cache_dir=None):
         """
         Custom dataset for loading video data.
 
         Args:
             data_dir (str): Path to the directory containing video data.
             transform (callable, optional): A function/transform to apply to each video frame.
+            cache_dir (str, optional): Directory of decoded videos. Each video is decoded with ffmpeg once,
+                saved as a uint8 .npy array and memory-mapped afterwards, so processes training on the same
+                data (e.g. the trials of a sweep) share one decoded copy through the page cache.
         """
         self.data_dir = data_dir
         self.classes = sorted(os.listdir(data_dir))
         self.class_to_idx = {cls: idx for idx, cls in enumerate(self.classes)}
         self.videos = self._load_videos()
         self.transform = transform
+        self.cache_dir = cache_dir
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
 
     def _load_videos(self):
         videos = []
         for class_name in self.classes:
             class_dir = os.path.join(self.data_dir, class_name)
             for video_file in os.listdir(class_dir):
-                if video_file.endswith('.avi'):
+                # .npy: uint8 RGB clips of shape (frames, height, width, 3), e.g. written by stream.ClipShardWriter
+                if video_file.endswith(('.avi', '.npy')):
                     video_path = os.path.join(class_dir, video_file)
                     videos.append((video_path, self.class_to_idx[class_name]))
         return videos
@@ -115,13 +125,48 @@ class VideoDataset(Dataset):
     def __len__(self):
         return len(self.videos)
 
-    def __getitem__(self, idx):
-        video_path, label = self.videos[idx]
-
+    def _decode(self, video_path):
         video = imageio.get_reader(video_path, 'ffmpeg')
 
         frames = [frame[:, :, :3] for frame in video]  # Keep only the first three channels (RGB)
         video.close()
+        return frames
+
+    def _cache_path(self, video_path):
+        # Key on the path, size and modification time so a re-recorded video is decoded again
+        stat = os.stat(video_path)
+        key = f"{os.path.realpath(video_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npy')
+
+    def _load_frames(self, video_path):
+        # Clips saved as arrays need no decoding and no cache
+        if video_path.endswith('.npy'):
+            return list(np.load(video_path, mmap_mode='c'))
+
+        if self.cache_dir is None:
+            return self._decode(video_path)
+
+        cache_path = self._cache_path(video_path)
+        if not os.path.exists(cache_path):
+            # Write to a temporary file and rename, so concurrent readers never see a partial array
+            temporary_path = f"{cache_path}.{os.getpid()}.tmp"
+            with open(temporary_path, 'wb') as f:
+                np.save(f, np.stack(self._decode(video_path)))
+            os.replace(temporary_path, cache_path)
+
+        return list(np.load(cache_path, mmap_mode='c'))
+
+    def precache(self):
+        """
+        Decodes every video into the cache that is not there yet.
+        """
+        for video_path, _ in self.videos:
+            self._load_frames(video_path)
+
+    def __getitem__(self, idx):
+        video_path, label = self.videos[idx]
+
+        frames = self._load_frames(video_path)
 
         if self.transform:
             frames = [self.transform(frame) for frame in frames]
@@ -129,16 +174,31 @@ class VideoDataset(Dataset):
 
         return video_tensor.permute(1, 0, 2, 3), label  # Permute to (batch, channels, frames, height, width)
 
+def collate_channels_last(batch):
+    """
+    Collates (video, label) samples into a batch of videos in channels_last_3d (NDHWC) memory format.
+    Runs in the DataLoader workers, so the main process receives the batch in its final layout.
+    """
+    videos, labels = zip(*batch)
+    video_batch = torch.empty((len(videos),) + videos[0].shape, dtype=videos[0].dtype, memory_format=torch.channels_last_3d)
+    for video_in_batch, video in zip(video_batch, videos):
+        video_in_batch.copy_(video)
+    return video_batch, torch.tensor(labels)
+
 class VideoDataLoader:
     @staticmethod
-    def create_loaders(root_dir, batch_size, num_workers=16):
+    def create_loaders(root_dir, batch_size, num_workers=16, distributed=False, cache_dir=None, channels_last=False):
         """
         Static method for creating training, testing, and validation loaders.
 
         Args:
             root_dir (str): Root directory containing the dataset folders.
-            batch_size (int): Number of samples per batch.
+            batch_size (int): Number of samples per batch (per process when distributed).
             num_workers (int): Number of subprocesses to use for data loading.
+            distributed (bool): If True, each loader gets a DistributedSampler so that every rank
+                sees its own shard of the data. Requires an initialized process group.
+            cache_dir (str, optional): Directory of decoded videos shared by all loaders. See VideoDataset.
+            channels_last (bool): If True, the video batches are in channels_last_3d memory format (for the 3D ResNet).
 
         Returns:
             tuple: A tuple containing the training, testing, and validation loaders.
@@ -147,23 +207,40 @@ class VideoDataLoader:
             ToTensor(),
         ])
 
+        def make_loader(dataset):
+            sampler = DistributedSampler(dataset, shuffle=True) if distributed else None
+            collate_fn = collate_channels_last if channels_last else None
+            return DataLoader(dataset, batch_size=batch_size, shuffle=sampler is None, sampler=sampler, num_workers=num_workers, collate_fn=collate_fn)
+
         # Create training dataset loader
         train_data_dir = os.path.join(root_dir, 'train')
-        train_dataset = VideoDataset(train_data_dir, transform=data_transform)
-        train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+        train_dataset = VideoDataset(train_data_dir, transform=data_transform, cache_dir=cache_dir)
+        train_loader = make_loader(train_dataset)
 
         # Create testing dataset loader
         test_data_dir = os.path.join(root_dir, 'test')
-        test_dataset = VideoDataset(test_data_dir, transform=data_transform)
-        test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+        test_dataset = VideoDataset(test_data_dir, transform=data_transform, cache_dir=cache_dir)
+        test_loader = make_loader(test_dataset)
 
         # Create validation dataset loader
         val_data_dir = os.path.join(root_dir, 'validation')
-        val_dataset = VideoDataset(val_data_dir, transform=data_transform)
-        val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+        val_dataset = VideoDataset(val_data_dir, transform=data_transform, cache_dir=cache_dir)
+        val_loader = make_loader(val_dataset)
 
         return train_loader, test_loader, val_loader
 
+    @staticmethod
+    def precache(root_dir, cache_dir):
+        """
+        Decodes the train, test and validation videos of a dataset into cache_dir ahead of training.
+
+        Args:
+            root_dir (str): Root directory containing the dataset folders.
+            cache_dir (str): Directory of decoded videos.
+        """
+        for subset in ['train', 'test', 'validation']:
+            VideoDataset(os.path.join(root_dir, subset), cache_dir=cache_dir).precache()
+
 if __name__ == '__main__':
     root_directory = './datasets'
     batch_size = 32
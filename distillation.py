@@ -0,0 +1,167 @@
+"""
+__author__          ==  Amit Parag
+__organization__    ==  Sintef Ocean
+__description__     ==  Knowledge distillation from a trained ResNet-50 3D (or a larger ViViT) into the tiny ViViT.
+
+                        The student is trained on a mix of the usual cross-entropy with the labels and the
+                        KL divergence to the softened teacher outputs. The teacher is frozen, so its logits
+                        for a clip never change: they are computed once per clip, cached in memory and on
+                        disk, and served by the training loader next to the labels. The teacher does not
+                        run during training at all.
+"""
+
+import os
+import hashlib
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import DataLoader, Dataset, Subset
+from torchvision.transforms import Compose, ToTensor
+
+from dataset_manager import VideoDataset
+from utils import colored_print
+
+
+class DistillationLoss(nn.Module):
+    def __init__(self, temperature=4.0, alpha=0.5):
+        """
+        (1 - alpha) * cross-entropy with the labels + alpha * T^2 * KL(teacher || student) at temperature T.
+        Without teacher logits (test and validation) it is the plain cross-entropy.
+
+        Parameters:
+        - temperature: Softens both distributions so the student also learns from the teacher's non-maximal outputs.
+        - alpha: Weight of the distillation term.
+        """
+        super().__init__()
+        self.temperature = temperature
+        self.alpha = alpha
+
+    def forward(self, outputs, labels, teacher_logits=None):
+        hard_loss = F.cross_entropy(outputs, labels)
+        if teacher_logits is None:
+            return hard_loss
+
+        soft_loss = F.kl_div(F.log_softmax(outputs / self.temperature, dim=1),
+                             F.softmax(teacher_logits / self.temperature, dim=1),
+                             reduction='batchmean')
+        # T^2 keeps the gradient scale of the soft term independent of the temperature
+        return (1 - self.alpha) * hard_loss + self.alpha * self.temperature ** 2 * soft_loss
+
+
+class TeacherLogitCache:
+    def __init__(self, teacher_model, cache_dir=None, device='cpu'):
+        """
+        Teacher logits per clip, in memory and optionally in one file per teacher in cache_dir.
+
+        Parameters:
+        - teacher_model: The trained teacher.
+        - cache_dir: Directory for the logits. None keeps them in memory only.
+        - device: Device to run the teacher on.
+        """
+        self.teacher_model = teacher_model
+        self.cache_dir = cache_dir
+        self.device = device
+        self.fingerprint = self._fingerprint()
+        self.logits = {}
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            if os.path.exists(self._path()):
+                self.logits = torch.load(self._path())
+
+    def _fingerprint(self):
+        # Logits of another teacher (or of other weights) must not be reused
+        digest = hashlib.sha1(type(self.teacher_model).__name__.encode())
+        for name, tensor in self.teacher_model.state_dict().items():
+            digest.update(name.encode())
+            digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+        return digest.hexdigest()[:16]
+
+    def _path(self):
+        return os.path.join(self.cache_dir, f'teacher_{self.fingerprint}.pt')
+
+    @staticmethod
+    def _key(video_path):
+        # A re-recorded clip gets new logits
+        stat = os.stat(video_path)
+        return f"{os.path.realpath(video_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+    def get(self, video_path):
+        return self.logits.get(self._key(video_path))
+
+    def fill(self, video_dataset, batch_size=16, num_workers=4):
+        """
+        Runs the teacher on every clip of video_dataset that has no cached logits yet, then drops the teacher: the
+        cache is held by the training dataset (and pickled into every DataLoader worker), the teacher must not be.
+        """
+        missing = [idx for idx, (video_path, _) in enumerate(video_dataset.videos) if self.get(video_path) is None]
+        if not missing:
+            self.teacher_model = None
+            return
+        if self.teacher_model is None:
+            raise RuntimeError(f"{len(missing)} clips of {video_dataset.data_dir} have no teacher logits and the teacher was already released")
+
+        colored_print(f"Computing teacher logits for {len(missing)} clips of {video_dataset.data_dir}", color_code=36)
+        loader = DataLoader(Subset(video_dataset, missing), batch_size=batch_size, num_workers=num_workers)
+        self.teacher_model.eval()
+        position = 0
+        with torch.no_grad():
+            for videos, _ in loader:
+                logits = self.teacher_model(videos.to(self.device)).float().cpu()
+                for clip_logits in logits:
+                    self.logits[self._key(video_dataset.videos[missing[position]][0])] = clip_logits.clone()
+                    position += 1
+
+        if self.cache_dir is not None:
+            temporary_path = f"{self._path()}.{os.getpid()}.tmp"
+            torch.save(self.logits, temporary_path)
+            os.replace(temporary_path, self._path())
+
+        # The fingerprint and the logits are stored, the teacher is not needed anymore
+        self.teacher_model = None
+
+
+class DistillationDataset(Dataset):
+    def __init__(self, video_dataset, cache):
+        """
+        Dataset of (video, label, teacher logits) for the clips of a VideoDataset. Call cache.fill(video_dataset) first.
+        """
+        self.video_dataset = video_dataset
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.video_dataset)
+
+    def __getitem__(self, idx):
+        video, label = self.video_dataset[idx]
+        return video, label, self.cache.get(self.video_dataset.videos[idx][0])
+
+
+def create_distillation_loaders(root_dir, teacher_model, batch_size, num_workers=8, cache_dir=None, video_cache_dir=None, device='cpu'):
+    """
+    Computes the teacher logits of the training clips once and returns the loaders for distillation.
+
+    Parameters:
+    - root_dir: Dataset directory, e.g. './datasets/5_Frames'.
+    - teacher_model: The trained teacher.
+    - batch_size: Number of samples per batch.
+    - num_workers: DataLoader workers.
+    - cache_dir: Directory for the teacher logits. None keeps them in memory.
+    - video_cache_dir: Decoded video cache, see VideoDataset.
+    - device: Device to run the teacher on.
+
+    Returns:
+    - tuple: Training loader of (video, label, teacher logits), testing and validation loaders of (video, label).
+    """
+    data_transform = Compose([ToTensor()])
+    train_dataset = VideoDataset(os.path.join(root_dir, 'train'), transform=data_transform, cache_dir=video_cache_dir)
+
+    cache = TeacherLogitCache(teacher_model, cache_dir=cache_dir, device=device)
+    cache.fill(train_dataset, batch_size=batch_size, num_workers=num_workers)
+
+    train_loader = DataLoader(DistillationDataset(train_dataset, cache), batch_size=batch_size, shuffle=True, num_workers=num_workers)
+    test_loader, val_loader = [
+        DataLoader(VideoDataset(os.path.join(root_dir, subset), transform=data_transform, cache_dir=video_cache_dir), batch_size=batch_size, shuffle=True, num_workers=num_workers)
+        for subset in ['test', 'validation']
+    ]
+    return train_loader, test_loader, val_loader
@@ -0,0 +1,98 @@
+"""
+__author__          ==  Amit Parag
+__organization__    ==  Sintef Ocean
+__description__     ==  Helpers for multi-process CPU data-parallel training with the gloo backend.
+                        Launch with torchrun, e.g. on each of two nodes:
+
+                        torchrun --nnodes 2 --nproc_per_node 4 --node_rank <0|1> \\
+                                 --master_addr <host of node 0> --master_port 29500 train.py
+
+                        Every process is pinned to its own slice of the cores of its node, so on a
+                        dual-socket machine the ranks do not fight over the same caches and memory.
+"""
+
+import os
+import torch
+import torch.distributed as dist
+
+from utils import colored_print, pin_to_cores
+
+
+def is_distributed():
+    """
+    Returns True if the default process group has been initialized.
+    """
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """
+    Returns True on rank 0 or when not running distributed.
+    Use it to guard printing, checkpointing and writing metrics.
+    """
+    return get_rank() == 0
+
+
+def launched_with_torchrun():
+    """
+    Returns True if the environment variables set by torchrun are present.
+    """
+    return 'RANK' in os.environ and 'WORLD_SIZE' in os.environ
+
+
+def setup_distributed(backend='gloo', num_threads=None):
+    """
+    Initializes the default process group from the environment set by torchrun
+    (RANK, WORLD_SIZE, LOCAL_RANK, LOCAL_WORLD_SIZE, MASTER_ADDR, MASTER_PORT) and pins
+    this process to its share of the cores of the node.
+
+    Parameters:
+    - backend: Process group backend. gloo is the one that works on CPU.
+    - num_threads: Number of torch threads per process. Defaults to the number of pinned cores.
+
+    Returns:
+    - tuple: (rank, world_size, local_rank)
+    """
+    rank = int(os.environ.get('RANK', 0))
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+
+    if not is_distributed():
+        dist.init_process_group(backend=backend, rank=rank, world_size=world_size)
+
+    cores = pin_to_cores(local_rank, local_world_size, num_threads)
+    colored_print(f"Rank {rank}/{world_size} pinned to cores {cores[0]}-{cores[-1]} with {torch.get_num_threads()} threads", color_code=36)
+
+    return rank, world_size, local_rank
+
+
+def cleanup_distributed():
+    """
+    Destroys the default process group if there is one.
+    """
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def all_reduce_tensor(tensor):
+    """
+    Sums a tensor over all ranks. Returns the input unchanged when not running distributed.
+
+    Parameters:
+    - tensor: Tensor to sum. It is reduced in place when distributed.
+
+    Returns:
+    - torch.Tensor: The summed tensor.
+    """
+    if is_distributed():
+        dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor
@@ -35,7 +35,8 @@ from utils import colored_print
 
 
 
-def execute_robotic_motion(exp_number: int, object_name: str, motion: str = 'wriggle', base_dir: str = './datasets', cam1_id: int = 3, cam2_id: int = 4):
+def execute_robotic_motion(exp_number: int, object_name: str, motion: str = 'wriggle', base_dir: str = './datasets', cam1_id: int = 3, cam2_id: int = 4,
+                           clip_shards: bool = False, frames_per_shard: int = 5):
     """
     Execute robotic motion and record videos.
 
@@ -46,6 +47,10 @@ def execute_robotic_motion(exp_number: int, object_name: str, motion: str = 'wri
     - base_dir (str): The base directory for saving datasets (default is './datasets').
     - cam1_id (int): Camera ID for the first camera (default is 3).
     - cam2_id (int): Camera ID for the second camera (default is 4).
+    - clip_shards (bool): Also save training-ready clips of frames_per_shard frames (see stream.ClipShardWriter).
+    - frames_per_shard (int): Frames per clip (default is 5).
+
+    Every recording is added to {base_dir}/manifest.jsonl with its object, experiment number and motion.
     """
 
     dataset_manager = DatasetManager()
@@ -68,7 +73,10 @@ def execute_robotic_motion(exp_number: int, object_name: str, motion: str = 'wri
         colored_print("The motions are \n lift \n perp_shake \n vert_shake \n tan_shake \n rot_shake \n", "91")
 
     # Call the function to record and save videos
-    record_and_save_videos(cam1_id=cam1_id, cam2_id=cam2_id,save_path=dataset_path)
+    record_and_save_videos(cam1_id=cam1_id, cam2_id=cam2_id,save_path=dataset_path,
+                           clip_shards=clip_shards, frames_per_shard=frames_per_shard,
+                           experiment={'object': object_name, 'exp_number': exp_number, 'motion': motion},
+                           manifest_path=os.path.join(base_dir, 'manifest.jsonl'))
 
 
 
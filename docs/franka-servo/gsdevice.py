@@ -2,6 +2,9 @@ import cv2
 import numpy as np
 import os
 import re
+import threading
+import time
+from collections import deque
 
 def warp_perspective(img, corners, output_sz):
     TOPLEFT, TOPRIGHT, BOTTOMRIGHT, BOTTOMLEFT = corners
@@ -54,28 +57,186 @@ if os.name == 'nt':
         return device
 
 
-def resize_crop_mini(img, imgw, imgh):
+def crop_roi(shape):
     # remove 1/7th of border from each size
-    border_size_x, border_size_y = int(img.shape[0] * (1 / 7)), int(np.floor(img.shape[1] * (1 / 7)))
+    border_size_x, border_size_y = int(shape[0] * (1 / 7)), int(np.floor(shape[1] * (1 / 7)))
     # keep the ratio the same as the original image size
-    img = img[border_size_x+2:img.shape[0] - border_size_x, border_size_y:img.shape[1] - border_size_y]
+    return slice(border_size_x+2, shape[0] - border_size_x), slice(border_size_y, shape[1] - border_size_y)
+
+
+def resize_crop_mini(img, imgw, imgh):
+    img = img[crop_roi(img.shape)]
     # final resize for 3d
     img = cv2.resize(img, (imgw, imgh))
     return img
 
 
+class CropResize:
+    def __init__(self, imgw, imgh, num_buffers=2):
+        """
+        resize_crop_mini without the per-frame work: the crop ROI is computed once per input resolution and every
+        frame is resized into one of num_buffers preallocated outputs, in turn. The output is identical to
+        resize_crop_mini.
+
+        A returned frame stays valid until num_buffers more frames are preprocessed; copy it to keep it longer.
+
+        Parameters:
+        - imgw (int), imgh (int): Output width and height, as for resize_crop_mini.
+        - num_buffers (int): Number of output buffers.
+        """
+        self.size = (imgw, imgh)
+        self.num_buffers = num_buffers
+        self.input_shape = None
+        self.roi = None
+        self.buffers = []
+        self.index = 0
+
+    def __call__(self, frame):
+        if frame.shape != self.input_shape:
+            self.input_shape = frame.shape
+            self.roi = crop_roi(frame.shape)
+            self.buffers = [np.empty((self.size[1], self.size[0]) + frame.shape[2:], dtype=frame.dtype) for _ in range(self.num_buffers)]
+
+        out = self.buffers[self.index]
+        self.index = (self.index + 1) % self.num_buffers
+        # The crop is a view, the resize writes into out
+        cv2.resize(frame[self.roi], self.size, dst=out)
+        return out
+
+
+class FrameGrabber:
+    def __init__(self, camera, queue_size=1):
+        """
+        Reads a connected Camera continuously on a background thread, so consumers never wait on
+        cv2.VideoCapture.read() and several cameras are captured at the same time instead of one after the other.
+
+        Parameters:
+        - camera (Camera): A connected camera.
+        - queue_size (int): Number of frames kept. 1 keeps only the latest frame; when the queue is full the
+                            oldest frame is dropped.
+        """
+        self.camera = camera
+        self.frames = deque(maxlen=queue_size)
+        self.condition = threading.Condition()
+        self.thread = None
+        self.running = False
+        # The capture thread stopped, e.g. at the end of a replayed recording
+        self.finished = False
+        self.frame_count = 0
+        # Frames no consumer got: pushed out of the queue unread, or skipped by latest()
+        self.dropped = 0
+        self.last_index = -1
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name=f'FrameGrabber-{self.camera.dev_id}', daemon=True)
+        self.thread.start()
+        return self
+
+    def _run(self):
+        while self.running:
+            read_start = time.perf_counter()
+            ret, frame = self.camera.cam.read()
+            # Timestamp taken as soon as the frame is available
+            timestamp = time.perf_counter()
+            if not ret:
+                if getattr(self.camera.cam, 'finished', False):
+                    break
+                print('ERROR! reading image from camera!')
+                time.sleep(0.01)
+                continue
+            frame = self.camera.preprocess(frame)
+            if self.camera.tracer is not None:
+                self.camera.tracer.record('read', read_start, timestamp, self.camera.dev_id, self.frame_count)
+                self.camera.tracer.record('preprocess', timestamp, time.perf_counter(), self.camera.dev_id, self.frame_count)
+
+            with self.condition:
+                # Frames handed out already (index <= last_index) are not lost when they leave the queue
+                if len(self.frames) == self.frames.maxlen and self.frames[0][2] > self.last_index:
+                    self.dropped += 1
+                self.frames.append((frame, timestamp, self.frame_count))
+                self.frame_count += 1
+                self.condition.notify_all()
+
+            # End of a replayed recording (ReplaySource)
+            if getattr(self.camera.cam, 'finished', False):
+                break
+
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    def latest(self, wait=True, timeout=1.0):
+        """
+        Returns the newest frame.
+
+        Parameters:
+        - wait (bool): Wait until there is a frame newer than the one returned last. Otherwise return the newest
+                       frame right away, possibly the same one again, or None if none arrived yet.
+        - timeout (float): Seconds to wait at most.
+
+        Returns:
+        - tuple: (frame, capture timestamp from time.perf_counter(), frame index), or None. The frame is a copy that
+                 the consumer owns: the capture thread reuses its preprocessing buffers.
+        """
+        with self.condition:
+            if wait:
+                self.condition.wait_for(lambda: self.frames and self.frames[-1][2] > self.last_index, timeout=timeout)
+            if not self.frames:
+                return None
+            # Older queued frames that were not handed out are skipped for good
+            self.dropped += sum(1 for frame in self.frames if self.last_index < frame[2] < self.frames[-1][2])
+            frame, timestamp, index = self.frames[-1]
+            self.last_index = index
+            return frame.copy(), timestamp, index
+
+    def get(self, timeout=1.0):
+        """
+        Removes and returns the oldest queued frame, waiting for one if the queue is empty. For consumers that
+        need every frame (e.g. recording), with queue_size > 1.
+
+        Returns:
+        - tuple: (frame, capture timestamp, frame index), or None on timeout or when the capture thread has stopped
+                 and every frame was taken. The frame is a copy, as in latest.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.frames or self.finished, timeout=timeout) or not self.frames:
+                return None
+            frame, timestamp, index = self.frames.popleft()
+            self.last_index = index
+            return frame.copy(), timestamp, index
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=1.0)
+            self.thread = None
+
+
 class Camera:
     def __init__(self, dev_type):
         # variable to store data
         self.data = None
+        # time.perf_counter() when self.data was captured
+        self.timestamp = None
+        # Index of self.data among the frames read from the camera, with gaps where frames were dropped in capture
+        self.frame_index = -1
+        self.grabber = None
+        # Optional latency_tracer.LatencyTracer for the read and preprocess stages
+        self.tracer = None
         self.name = dev_type
         self.dev_id = get_camera_id(dev_type)
         self.imgw = 320 # this is for R1, R1.5 is 240
         self.imgh = 240 # this is for R1, R1.5 is 320
         self.cam = None
         self.while_condition = 1
+        self.preprocessor = None
+        self.warmed_up = False
 
-    def connect(self):
+    def connect(self, warmup_frames=10):
+        """
+        Opens the camera and reads warmup_frames frames once, to get past the black frames at start-up.
+        """
 
         # The camera in Mini is a USB camera and uses open cv to get the video data from the streamed video
         self.cam = cv2.VideoCapture(self.dev_id)
@@ -83,15 +244,23 @@ class Camera:
             print('Warning: unable to open video source: ', self.dev_id)
         self.imgw = 240
         self.imgh = 320
+        self.preprocessor = CropResize(self.imgh, self.imgw)
 
+        self.warmup(warmup_frames)
         return self.cam
 
+    def warmup(self, num_frames=10):
+        for i in range(num_frames): ## flush out the first frames to remove black frames
+            self.cam.read()
+        self.warmed_up = True
+
     def get_raw_image(self):
-        for i in range(10): ## flush out fist 100 frames to remove black frames
-            ret, f0 = self.cam.read()
+        # Flushes the black frames only if connect() did not
+        if not self.warmed_up:
+            self.warmup()
         ret, f0 = self.cam.read()
         if ret:
-            f0 = resize_crop_mini(f0,self.imgh,self.imgw)
+            f0 = self.preprocess(f0)
         else:
             print('ERROR! reading image from camera')
 
@@ -99,17 +268,83 @@ class Camera:
         return self.data
 
 
-    def get_image(self):
+    def preprocess(self, frame):
+        """
+        Crops and resizes a frame like resize_crop_mini, into a buffer that is reused (see CropResize).
+        """
+        if self.preprocessor is None:
+            self.preprocessor = CropResize(self.imgh, self.imgw)
+        return self.preprocessor(frame)
+
+    def recorded_frame(self, frame):
+        """
+        Crops and resizes a frame of get_image once more, like stream.record_and_save_videos does before writing it,
+        so the frame matches the recorded training clips.
+        """
+        return resize_crop_mini(frame, self.imgh, self.imgw)
+
+    def start_capture(self, queue_size=1):
+        """
+        Starts reading frames on a background thread (see FrameGrabber). get_image then returns the newest frame.
+        """
+        # Frames in the queue and the one being written must not share a buffer; consumers get copies
+        self.preprocessor = CropResize(self.imgh, self.imgw, num_buffers=queue_size + 1)
+        self.grabber = FrameGrabber(self, queue_size=queue_size).start()
+        return self.grabber
+
+    def stop_capture(self):
+        if self.grabber is not None:
+            self.grabber.stop()
+            self.grabber = None
 
+    def get_image(self, wait=True):
+        """
+        Returns the next frame. With threaded capture (start_capture) it is the newest frame of the capture thread:
+        wait=True blocks until a frame newer than the last one arrives (at most 1 s, then the last frame comes back
+        again), wait=False returns right away. Either way frame_index only changes with a new frame.
+        """
+        if self.grabber is not None:
+            latest = self.grabber.latest(wait=wait)
+            if latest is None:
+                print('ERROR! reading image from camera!')
+                return self.data
+            self.data, self.timestamp, self.frame_index = latest
+            return self.data
+
+        read_start = time.perf_counter()
         ret, f0 = self.cam.read()
+        self.timestamp = time.perf_counter()
         if ret:
-            f0 = resize_crop_mini(f0, self.imgh, self.imgw)
+            f0 = self.preprocess(f0)
+            self.frame_index += 1
+            if self.tracer is not None:
+                self.tracer.record('read', read_start, self.timestamp, self.dev_id)
+                self.tracer.record('preprocess', self.timestamp, time.perf_counter(), self.dev_id)
         else:
             print('ERROR! reading image from camera!')
 
         self.data = f0
         return self.data
 
+    def get_next_image(self, timeout=1.0):
+        """
+        Returns the oldest frame not handed out yet, for consumers that need every frame, e.g. recording. With threaded
+        capture, start it with queue_size > 1: the frames queue up while the consumer is busy and come out in order
+        (FrameGrabber.get). Without threaded capture it is get_image.
+
+        Parameters:
+        - timeout (float): Seconds to wait for a frame. On a timeout the last frame comes back, with the same frame_index.
+        """
+        if self.grabber is None:
+            return self.get_image()
+
+        queued = self.grabber.get(timeout=timeout)
+        if queued is None:
+            print('ERROR! reading image from camera!')
+            return self.data
+        self.data, self.timestamp, self.frame_index = queued
+        return self.data
+
     def save_image(self, fname):
          cv2.imwrite(fname, self.data)
 
@@ -124,5 +359,194 @@ class Camera:
         cv2.destroyAllWindows()
 
 
+class ReplaySource:
+    def __init__(self, path, fps=None, realtime=True, jitter_ms=0.0, drop_rate=0.0, loop=False, buffer_size=1, seed=None):
+        """
+        Plays back a recording with the read() interface of cv2.VideoCapture, for running the live pipeline
+        without a sensor. All frames are decoded up front, so decoding does not distort the timing.
+
+        Parameters:
+        - path (str): An .avi/.mp4 video, an .npy array of frames (frames, height, width, 3) in RGB, or a directory
+                      of such arrays, e.g. the camera_<id>_clips directory of stream.ClipShardWriter.
+        - fps (float): Playback rate. Defaults to the capture times of the <recording>.timestamps.csv sidecar if there
+                       is one (the real frame intervals), otherwise the fps of the video, otherwise 25.
+        - realtime (bool): Deliver every frame at its time. False delivers the frames as fast as they are read.
+        - jitter_ms (float): Standard deviation of a random extra delay per frame, in milliseconds.
+        - drop_rate (float): Probability that a frame is lost, like a USB frame drop.
+        - loop (bool): Start over at the end instead of returning (False, None).
+        - buffer_size (int): Frames a late reader can still get; older ones are skipped, like the driver buffer of a camera.
+        - seed (int): Seed of the jitter and drops, for reproducible runs.
+        """
+        self.path = path
+        self.frames = self._load(path)
+        self.realtime = realtime
+        self.jitter = jitter_ms / 1000
+        self.drop_rate = drop_rate
+        self.loop = loop
+        self.buffer_size = buffer_size
+        self.rng = np.random.default_rng(seed)
+
+        # Time of every frame relative to the first one
+        capture_times = self._capture_times(path)
+        if fps is None and capture_times is not None and len(capture_times) >= len(self.frames):
+            self.frame_times = capture_times[:len(self.frames)] - capture_times[0]
+        else:
+            self.fps = fps or self.fps or 25
+            self.frame_times = np.arange(len(self.frames)) / self.fps
+        # Duration of one pass, with one mean frame interval before the loop starts over
+        interval = self.frame_times[-1] / (len(self.frames) - 1) if len(self.frames) > 1 else 0
+        self.duration = self.frame_times[-1] + (interval if interval > 0 else 1 / 25)
+
+        self.index = 0
+        self.start_time = None
+        self.dropped = 0
+        self.skipped = 0
+        # Set once the last frame was read (never with loop)
+        self.finished = False
+
+    def _load(self, path):
+        self.fps = None
+        if os.path.isdir(path):
+            arrays = [np.load(os.path.join(path, name)) for name in sorted(os.listdir(path)) if name.endswith('.npy')]
+            return [cv2.cvtColor(frame, cv2.COLOR_RGB2BGR) for frame in np.concatenate(arrays)]
+        if path.endswith('.npy'):
+            return [cv2.cvtColor(frame, cv2.COLOR_RGB2BGR) for frame in np.load(path)]
+
+        capture = cv2.VideoCapture(path)
+        if not capture.isOpened():
+            raise IOError(f"Unable to open recording '{path}'")
+        self.fps = capture.get(cv2.CAP_PROP_FPS) or None
+        frames = []
+        while True:
+            ret, frame = capture.read()
+            if not ret:
+                break
+            frames.append(frame)
+        capture.release()
+        if not frames:
+            raise IOError(f"No frames in recording '{path}'")
+        return frames
+
+    @staticmethod
+    def _capture_times(path):
+        # Sidecar of stream.AsyncVideoWriter / ClipShardWriter
+        timestamps_path = f'{os.path.splitext(os.path.normpath(path))[0]}.timestamps.csv'
+        if not os.path.exists(timestamps_path):
+            return None
+        return np.loadtxt(timestamps_path, delimiter=',', skiprows=1, ndmin=2)[:, 1]
+
+    def isOpened(self):
+        return True
+
+    def _due_time(self, index):
+        # Frame index of the whole playback, also over loops
+        passes, position = divmod(index, len(self.frames))
+        return self.start_time + passes * self.duration + self.frame_times[position]
+
+    def read(self):
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+
+        while True:
+            if not self.loop and self.index >= len(self.frames):
+                self.finished = True
+                return False, None
+
+            if self.realtime:
+                now = time.perf_counter()
+                # A reader that fell behind only gets the last buffer_size frames that arrived
+                while self._due_time(self.index + self.buffer_size) <= now and (self.loop or self.index + self.buffer_size < len(self.frames)):
+                    self.index += 1
+                    self.skipped += 1
+                delay = self._due_time(self.index) - now
+                if delay > 0:
+                    time.sleep(delay)
+            if self.jitter:
+                time.sleep(abs(self.rng.normal(0.0, self.jitter)))
+
+            frame = self.frames[self.index % len(self.frames)]
+            self.index += 1
+            self.finished = not self.loop and self.index >= len(self.frames)
+            if self.drop_rate and self.rng.random() < self.drop_rate:
+                self.dropped += 1
+                if self.finished:
+                    return False, None
+                continue
+            return True, frame.copy()
+
+    def release(self):
+        pass
+
+
+class ReplayCamera(Camera):
+    def __init__(self, path, preprocessed=True, **replay_params):
+        """
+        Camera that plays back a recording instead of opening a sensor (see ReplaySource), with the interface of
+        Camera: connect, get_image, start_capture, timestamp. while_condition becomes 0 at the end of the recording.
+        With realtime=False every frame is delivered, in order (see start_capture).
+
+        Parameters:
+        - path (str): The recording, see ReplaySource.
+        - preprocessed (bool): The frames are already cropped and resized (the recordings of stream.py are), so
+                               preprocess leaves them as they are. False crops raw frames like a live camera.
+        - replay_params: fps, realtime, jitter_ms, drop_rate, loop, buffer_size and seed of ReplaySource.
+        """
+        # No /sys/class/video4linux lookup, the rest as in Camera
+        self.data = None
+        self.timestamp = None
+        self.frame_index = -1
+        self.grabber = None
+        self.tracer = None
+        self.name = f'Replay {os.path.basename(os.path.normpath(path))}'
+        self.dev_id = path
+        self.imgw = 320
+        self.imgh = 240
+        self.cam = None
+        self.while_condition = 1
+        self.preprocessor = None
+        self.warmed_up = False
+
+        self.path = path
+        self.preprocessed = preprocessed
+        self.replay_params = replay_params
+
+    def connect(self, warmup_frames=0):
+        self.cam = ReplaySource(self.path, **self.replay_params)
+        self.imgw = 240
+        self.imgh = 320
+        self.preprocessor = CropResize(self.imgh, self.imgw)
+        self.warmup(warmup_frames)
+        return self.cam
+
+    def preprocess(self, frame):
+        return frame if self.preprocessed else super().preprocess(frame)
+
+    def start_capture(self, queue_size=1):
+        """
+        Starts the capture thread like Camera.start_capture, except for realtime=False: as fast as possible, every frame
+        has to reach the consumer, so get_image reads the recording in step instead of through a FrameGrabber, which
+        would replace frames the consumer has not read yet.
+        """
+        if not self.cam.realtime:
+            return None
+        return super().start_capture(queue_size)
+
+    def recorded_frame(self, frame):
+        # The frames of a recording of stream.py are already cropped twice
+        return frame if self.preprocessed else super().recorded_frame(frame)
 
+    def get_image(self, wait=True):
+        frame = super().get_image(wait)
+        if self.cam.finished:
+            # End of the recording, like closing the loop of stream.py with 'q'
+            self.while_condition = 0
+        return frame
 
+    def get_next_image(self, timeout=1.0):
+        if self.grabber is None:
+            return self.get_image()
+        frame = super().get_next_image(timeout)
+        # The recording ends once the capture thread stopped and its queue is empty
+        if self.grabber.finished and not self.grabber.frames:
+            self.while_condition = 0
+        return frame
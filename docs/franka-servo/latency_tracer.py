@@ -0,0 +1,198 @@
+"""
+__author__          ==  Amit Parag
+__organization__    ==  Sintef Ocean
+__date__            ==  19th October, 2026
+__description__     ==  Per-frame latency tracing of the live loops (stream.py, slip_detector.py).
+
+                        Every stage a frame goes through records a span: camera read, crop/resize,
+                        enqueue, model forward, decision and video write. The tracer keeps the recent
+                        durations of every stage (p50/p95/p99, rate), the frame-to-decision latency of
+                        every decision, and which stage took the longest in the decisions that missed the
+                        deadline. The numbers are printed periodically, served as JSON on a local port,
+                        and the spans can be exported in Chrome trace format (chrome://tracing or Perfetto).
+
+                        Timestamps are time.perf_counter(), like gsdevice.Camera.timestamp.
+"""
+
+import os
+import json
+import time
+import threading
+from collections import Counter, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from utils import colored_print
+
+
+class LatencyTracer:
+    STAGES = ['read', 'preprocess', 'enqueue', 'queue wait', 'gate', 'forward', 'decision', 'write']
+
+    def __init__(self, deadline_ms=None, window=1000, max_events=100000, log_interval=None):
+        """
+        Parameters:
+        - deadline_ms (float): Frame-to-decision deadline of the control loop. Decisions that take longer are counted
+                               as misses, per stage that took the longest.
+        - window (int): Number of recent spans per stage (and decisions) the statistics are computed over.
+        - max_events (int): Spans kept for the Chrome trace; the oldest are dropped.
+        - log_interval (float): Seconds between two summaries printed by log(). None prints only when forced.
+        """
+        self.deadline = None if deadline_ms is None else deadline_ms / 1000
+        self.window = window
+        self.log_interval = log_interval
+
+        self.durations = {}
+        self.ends = {}
+        self.events = deque(maxlen=max_events)
+        self.latencies = deque(maxlen=window)
+        self.decision_times = deque(maxlen=window)
+        self.decisions = 0
+        self.misses = Counter()
+
+        self.start_time = time.perf_counter()
+        self.last_log = self.start_time
+        self.server = None
+
+    def record(self, stage, start, end, camera=None, frame=None):
+        """
+        Adds a span of a stage that was timed elsewhere.
+
+        Parameters:
+        - stage (str): One of STAGES, or any other name.
+        - start (float), end (float): time.perf_counter() at the start and the end of the stage.
+        - camera: Camera (or writer) the span belongs to, shown as its own row in the Chrome trace.
+        - frame (int): Frame index, shown with the span.
+        """
+        if stage not in self.durations:
+            self.durations[stage] = deque(maxlen=self.window)
+            self.ends[stage] = deque(maxlen=self.window)
+        self.durations[stage].append(end - start)
+        self.ends[stage].append(end)
+        self.events.append((stage, start, end, camera, frame, threading.current_thread().name))
+
+    @contextmanager
+    def span(self, stage, camera=None, frame=None):
+        """
+        Context manager that records the time spent inside it as a span of a stage.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, start, time.perf_counter(), camera, frame)
+
+    def decision(self, capture_time, decision_time, stages=None):
+        """
+        Records the latency of a decision, from the capture of its (oldest) frame to the decision.
+
+        Parameters:
+        - capture_time (float): time.perf_counter() when the frame was captured.
+        - decision_time (float): time.perf_counter() when the decision was made.
+        - stages (dict): {stage: seconds} spent on this decision, to find the stage that broke a missed deadline.
+        """
+        latency = decision_time - capture_time
+        self.latencies.append(latency)
+        self.decision_times.append(decision_time)
+        self.decisions += 1
+        if self.deadline is not None and latency > self.deadline:
+            self.misses[max(stages, key=stages.get) if stages else 'unknown'] += 1
+
+    @staticmethod
+    def _stats(values):
+        values = 1000 * np.asarray(values)
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        return {'p50 (ms)': float(p50), 'p95 (ms)': float(p95), 'p99 (ms)': float(p99), 'max (ms)': float(values.max()), 'count': len(values)}
+
+    @staticmethod
+    def _rate(ends):
+        # Spans per second over the window
+        return (len(ends) - 1) / (ends[-1] - ends[0]) if len(ends) > 1 and ends[-1] > ends[0] else 0.0
+
+    def summary(self):
+        """
+        Returns:
+        - dict: Per stage the latency percentiles and the rate (fps, of all cameras together) over the window; under 'frame to decision' the
+                same for the decisions, with the decision rate, the number of decisions and the deadline misses per stage.
+        """
+        summary = {}
+        for stage in list(self.durations):
+            durations, ends = list(self.durations[stage]), list(self.ends[stage])
+            if durations:
+                summary[stage] = {**self._stats(durations), 'fps': self._rate(ends)}
+
+        if self.latencies:
+            summary['frame to decision'] = {**self._stats(list(self.latencies)), 'fps': self._rate(list(self.decision_times))}
+        summary['decisions'] = self.decisions
+        summary['deadline (ms)'] = None if self.deadline is None else 1000 * self.deadline
+        summary['deadline misses'] = dict(self.misses)
+        return summary
+
+    def log(self, force=False):
+        """
+        Prints the summary if log_interval seconds passed since the last one (or if force).
+        """
+        now = time.perf_counter()
+        if not force and (self.log_interval is None or now - self.last_log < self.log_interval):
+            return
+        self.last_log = now
+
+        summary = self.summary()
+        print("{:<20} {:<10} {:<10} {:<10} {:<10} {:<8}".format("Stage", "p50 (ms)", "p95 (ms)", "p99 (ms)", "max (ms)", "fps"))
+        for stage in [stage for stage in self.STAGES if stage in summary] + [stage for stage in self.durations if stage not in self.STAGES] + ['frame to decision']:
+            if stage in summary:
+                stats = summary[stage]
+                print("{:<20} {:<10.2f} {:<10.2f} {:<10.2f} {:<10.2f} {:<8.1f}".format(stage, stats['p50 (ms)'], stats['p95 (ms)'], stats['p99 (ms)'], stats['max (ms)'], stats['fps']))
+        if self.deadline is not None:
+            misses = sum(self.misses.values())
+            colored_print(f"{misses} of {self.decisions} decisions missed the {1000 * self.deadline:.0f} ms deadline"
+                          + (f", slowest stage: {dict(self.misses)}" if misses else ''), "91" if misses else "92")
+
+    def serve(self, port=8765, host='127.0.0.1'):
+        """
+        Serves the summary as JSON on http://host:port/ from a background thread, e.g. curl localhost:8765.
+        """
+        tracer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(tracer.summary(), indent=2).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # No access log on the console of the live loop
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, name='LatencyTracer-server', daemon=True).start()
+        colored_print(f"Latency metrics served on http://{host}:{self.server.server_address[1]}/", "96")
+        return self.server
+
+    def export_chrome_trace(self, path):
+        """
+        Writes the recorded spans in Chrome trace format: one row per camera (or writer) and thread.
+        """
+        trace_events = []
+        for stage, start, end, camera, frame, thread in list(self.events):
+            trace_events.append({
+                'name': stage, 'cat': 'latency', 'ph': 'X',
+                'ts': 1e6 * (start - self.start_time), 'dur': 1e6 * (end - start),
+                'pid': os.getpid(), 'tid': f'{camera} ({thread})' if camera is not None else thread,
+                'args': {} if frame is None else {'frame': frame}
+            })
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, trace_file)
+        colored_print(f"Latency trace written to {path}", "96")
+        return path
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,535 @@
+"""
+__author__          ==  Amit Parag
+__organization__    ==  Sintef Ocean
+__date__            ==  19th October, 2026
+__description__     ==  Real-time slip detection on the live GelSight streams.
+
+                        Every camera has a preallocated ring buffer holding its last N preprocessed frames
+                        (N = the number of frames the classifier was trained on). A frame of get_image is
+                        cropped and resized a second time, like stream.py does before writing the training
+                        videos (gsdevice.Camera.recorded_frame), then converted to RGB, scaled to [0, 1] and
+                        written into the ring in place, like the training clips are decoded by VideoDataset. Every frame, or every k-th frame, the last
+                        N frames are copied into a preallocated model input and classified. When a camera
+                        goes from no slip to slip, a timestamped slip event is emitted.
+
+                        The ring is stored twice in a row (slot i and slot i + N are written together), so the
+                        last N frames are always one contiguous slice and no frame is ever reordered or
+                        reallocated.
+
+                        The classifier is anything with predict(videos) -> (classes, slip probabilities), e.g.
+                        onnx_engine.SlipDetectionEngine for a model exported with onnx_export.py.
+
+                        With both fingers streaming, push_all classifies the windows of all cameras in one
+                        batched forward per tick instead of one forward per camera, and decides per finger and
+                        for the whole grasp.
+
+                        With incremental=True the classifier is a spatial_cache.IncrementalViViT instead: every
+                        frame goes through the spatial encoder once when it arrives, and a decision only runs
+                        the temporal transformer and the head over the cached tokens of the window.
+
+                        With a motion_gate, a camera whose frames do not change (a static grasp) is not
+                        classified at all: the last decision is held until the MotionGate of the camera sees
+                        enough change again. The ring buffers are still filled, so the first decision after the
+                        gate opens sees the frames of the onset.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from collections import deque, namedtuple
+
+import cv2
+import numpy as np
+
+import gsdevice
+from latency_tracer import LatencyTracer
+from utils import colored_print
+
+
+# Camera name of the grasp-level events
+GRASP = 'grasp'
+
+# frame_time: when the frame that triggered the decision was captured. decision_time: when the decision was made.
+SlipEvent = namedtuple('SlipEvent', ['camera', 'frame_time', 'decision_time', 'probability', 'frame_index'])
+
+
+class FrameRingBuffer:
+    def __init__(self, num_frames, height=240, width=320):
+        """
+        Fixed-size buffer of the last num_frames preprocessed frames of one camera.
+
+        Parameters:
+        - num_frames (int): Number of frames per clip.
+        - height (int), width (int): Frame size after gsdevice.resize_crop_mini.
+        """
+        self.num_frames = num_frames
+        # (channels, 2 * num_frames, height, width): every frame is written twice, see the module docstring
+        self.frames = np.zeros((3, 2 * num_frames, height, width), dtype=np.float32)
+        self.timestamps = np.zeros(2 * num_frames)
+        self._rgb = np.empty((height, width, 3), dtype=np.uint8)
+        self.count = 0
+
+    def push(self, frame, timestamp):
+        """
+        Writes a BGR uint8 frame, cropped like the training videos (gsdevice.Camera.recorded_frame), into the buffer.
+        """
+        slot = self.count % self.num_frames
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=self._rgb)
+        for position in (slot, slot + self.num_frames):
+            np.multiply(self._rgb.transpose(2, 0, 1), 1 / 255., out=self.frames[:, position])
+            self.timestamps[position] = timestamp
+        self.count += 1
+
+    def latest(self):
+        """
+        Returns:
+        - np.ndarray: View of the newest frame, shape (3, height, width).
+        """
+        return self.frames[:, (self.count - 1) % self.num_frames]
+
+    def is_full(self):
+        return self.count >= self.num_frames
+
+    def window(self):
+        """
+        Returns:
+        - np.ndarray: View of the last num_frames frames, oldest first, shape (3, num_frames, height, width).
+        """
+        start = self.count % self.num_frames
+        return self.frames[:, start:start + self.num_frames]
+
+    def frame(self, index):
+        """
+        Returns:
+        - np.ndarray: View of the frame with the given index (one of the last num_frames), shape (3, height, width).
+        """
+        return self.frames[:, index % self.num_frames]
+
+
+class MotionGate:
+    def __init__(self, open_threshold=2e-5, close_threshold=1e-5, hold_frames=5, downsample=8):
+        """
+        Cheap change detector that decides whether a camera needs to be classified.
+
+        The change energy is the mean squared difference, on grayscale frames downsampled by downsample and scaled
+        to [0, 1], between the new frame and the last frame the gate was open for. While the gate is open that is the
+        previous frame; while it is closed the reference stays, so a slow creep adds up until it opens the gate.
+
+        Hysteresis: the gate opens as soon as the energy reaches open_threshold and closes only after hold_frames
+        frames in a row below close_threshold.
+
+        Parameters:
+        - open_threshold (float): Energy that opens the gate. Static GelSight frames are around 1e-6, the frames of
+                                  a slip or a wriggle around 1e-4 to 1e-3.
+        - close_threshold (float): Energy below which the gate may close. At most open_threshold.
+        - hold_frames (int): Quiet frames in a row before the gate closes.
+        - downsample (int): Downsampling factor of the frames.
+        """
+        if close_threshold > open_threshold:
+            raise ValueError(f"close_threshold ({close_threshold}) must not be above open_threshold ({open_threshold})")
+        self.open_threshold = open_threshold
+        self.close_threshold = close_threshold
+        self.hold_frames = hold_frames
+        self.downsample = downsample
+
+        self.is_open = True
+        self.quiet_frames = 0
+        self.energy = float('inf')
+        self.frame_count = 0
+        self.reference = None
+        self._small = None
+        self._gray = None
+        self._current = None
+
+    def update(self, frame):
+        """
+        Parameters:
+        - frame (np.ndarray): BGR uint8 frame from gsdevice.Camera.recorded_frame.
+
+        Returns:
+        - bool: True if the gate is open, i.e. the frame changed enough to classify the camera.
+        """
+        if self._small is None:
+            size = (max(frame.shape[1] // self.downsample, 1), max(frame.shape[0] // self.downsample, 1))
+            self._small = np.empty((size[1], size[0], 3), dtype=np.uint8)
+            self._gray = np.empty((size[1], size[0]), dtype=np.uint8)
+            self._current = np.empty((size[1], size[0]), dtype=np.float32)
+            self.reference = np.empty_like(self._current)
+        cv2.resize(frame, self._small.shape[1::-1], dst=self._small, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self._small, cv2.COLOR_BGR2GRAY, dst=self._gray)
+        np.multiply(self._gray, 1 / 255., out=self._current)
+
+        # The first frame has nothing to compare with and keeps the gate open
+        if self.frame_count > 0:
+            self.energy = float(np.mean(np.square(self._current - self.reference)))
+        self.frame_count += 1
+
+        if self.is_open:
+            self.quiet_frames = self.quiet_frames + 1 if self.energy < self.close_threshold else 0
+            self.is_open = self.quiet_frames < self.hold_frames
+        elif self.energy >= self.open_threshold:
+            self.is_open = True
+            self.quiet_frames = 0
+
+        if self.is_open:
+            np.copyto(self.reference, self._current)
+        return self.is_open
+
+
+class StreamingSlipDetector:
+    def __init__(self, classifier, cameras, num_frames=5, stride=1, threshold=0.5, on_slip=None, height=240, width=320, incremental=False,
+                 grasp_rule='any', tracer=None, motion_gate=None):
+        """
+        Parameters:
+        - classifier: Object with predict(videos) -> (classes, slip probabilities), e.g. onnx_engine.SlipDetectionEngine.
+        - cameras (list): Names of the cameras, e.g. ['left', 'right'].
+        - num_frames (int): Number of frames per clip the classifier was trained on.
+        - stride (int): Classify every stride-th frame of a camera (1 classifies every frame).
+        - threshold (float): Slip probability above which a clip counts as slip.
+        - on_slip (callable): Called with every SlipEvent, e.g. to stop the robot.
+        - height (int), width (int): Frame size after gsdevice.resize_crop_mini.
+        - incremental (bool): The classifier is a spatial_cache.IncrementalViViT that encodes every frame once.
+        - grasp_rule (str): How push_all decides for the grasp: 'any' finger slips, 'all' fingers slip, or the 'mean'
+                            slip probability of the fingers is above the threshold.
+        - tracer (LatencyTracer): Optional, traces the enqueue, queue wait, gate, forward and decision stages and the
+                                  frame-to-decision latency of every decision.
+        - motion_gate (dict): If given, parameters of a MotionGate per camera ({} for the defaults). A camera is only
+                              classified if its gate opened since its last decision; otherwise its last decision is held.
+        """
+        if grasp_rule not in ('any', 'all', 'mean'):
+            raise ValueError(f"Unknown grasp rule '{grasp_rule}', expected 'any', 'all' or 'mean'")
+        self.classifier = classifier
+        self.incremental = incremental
+        self.num_frames = num_frames
+        self.stride = stride
+        self.threshold = threshold
+        self.on_slip = on_slip
+        self.grasp_rule = grasp_rule
+        self.tracer = tracer
+
+        self.cameras = list(cameras)
+        self.buffers = {camera: FrameRingBuffer(num_frames, height, width) for camera in self.cameras}
+        self.slipping = dict.fromkeys(self.cameras + [GRASP], False)
+        self.gates = None if motion_gate is None else {camera: MotionGate(**motion_gate) for camera in self.cameras}
+        # Whether a camera's gate was open since its last decision
+        self.pending = dict.fromkeys(self.cameras, True)
+        # Decisions that ran the classifier and decisions held by the gates
+        self.decisions = 0
+        self.held_decisions = 0
+        # Model input with one clip per camera, reused for every decision
+        self.videos = np.zeros((len(self.cameras), 3, num_frames, height, width), dtype=np.float32)
+        self.ticks = 0
+
+        self.events = []
+        # Frame-to-decision latencies in seconds, of the most recent decisions
+        self.latencies = deque(maxlen=1000)
+
+    def push(self, camera, frame, timestamp=None):
+        """
+        Adds a frame of a camera and classifies the last num_frames frames if it is this frame's turn.
+
+        Parameters:
+        - camera (str): Name of the camera.
+        - frame (np.ndarray): BGR uint8 frame from gsdevice.Camera.recorded_frame.
+        - timestamp (float): time.perf_counter() when the frame was read. Defaults to now.
+
+        Returns:
+        - SlipEvent or None: The event if this frame started a slip on this camera.
+        """
+        start = time.perf_counter()
+        timestamp = start if timestamp is None else timestamp
+        stages = {}
+        self._trace('queue wait', timestamp, start, camera, self.buffers[camera].count, stages)
+        buffer = self.buffers[camera]
+        buffer.push(frame, timestamp)
+        frame_index = buffer.count - 1
+        self._trace('enqueue', start, time.perf_counter(), camera, frame_index, stages)
+        active = self._gate(camera, frame, frame_index, stages)
+        if self.incremental and active:
+            # Every frame is encoded, also those on which no decision is made
+            self._encode(camera, frame_index, stages)
+
+        if not buffer.is_full() or (buffer.count - self.num_frames) % self.stride != 0:
+            return None
+        if not self.pending[camera]:
+            # Nothing changed: the last decision holds
+            self.held_decisions += 1
+            return None
+        self.pending[camera] = active
+        self.decisions += 1
+
+        forward_start = time.perf_counter()
+        if self.incremental:
+            self._encode(camera, frame_index, stages)
+            _, slip_probabilities = self.classifier.predict(camera, frame_index)
+        else:
+            idx = self.cameras.index(camera)
+            video = self.videos[idx:idx + 1]
+            np.copyto(video[0], buffer.window())
+            _, slip_probabilities = self.classifier.predict(video)
+        decision_time = time.perf_counter()
+        self._trace('forward', forward_start, decision_time, camera, frame_index, stages)
+        self.latencies.append(decision_time - timestamp)
+
+        event = self._decide(camera, float(slip_probabilities[0]), timestamp, decision_time, frame_index)
+        self._trace_decision(timestamp, decision_time, camera, frame_index, stages)
+        return event
+
+    def push_all(self, frames, timestamps=None):
+        """
+        Adds one frame of every camera and, if it is this tick's turn, classifies the windows of all cameras in one
+        batched forward. Decides per finger and for the grasp (see grasp_rule).
+
+        Parameters:
+        - frames (dict): {camera name: BGR uint8 frame}, one frame for every camera.
+        - timestamps (dict): {camera name: time.perf_counter() when the frame was read}. Defaults to now.
+
+        Returns:
+        - list: The SlipEvents started by this tick, per finger and for the grasp (camera GRASP).
+        """
+        now = time.perf_counter()
+        timestamps = timestamps or dict.fromkeys(self.cameras, now)
+        # The oldest of the frames decides the latency of the tick
+        timestamp = min(timestamps.values())
+        stages = {}
+        for camera in self.cameras:
+            self._trace('queue wait', timestamps[camera], now, camera, self.buffers[camera].count, {})
+        # The oldest frame waited the longest
+        stages['queue wait'] = now - timestamp
+        active = {}
+        for camera in self.cameras:
+            start = time.perf_counter()
+            self.buffers[camera].push(frames[camera], timestamps[camera])
+            self._trace('enqueue', start, time.perf_counter(), camera, self.buffers[camera].count - 1, stages)
+            active[camera] = self._gate(camera, frames[camera], self.buffers[camera].count - 1, stages)
+            if self.incremental and active[camera]:
+                self._encode(camera, self.buffers[camera].count - 1, stages)
+        self.ticks += 1
+
+        if self.ticks < self.num_frames or (self.ticks - self.num_frames) % self.stride != 0:
+            return []
+        # One batched forward for all cameras, as soon as one of them changed
+        if not any(self.pending.values()):
+            self.held_decisions += 1
+            return []
+        self.pending = active
+        self.decisions += 1
+
+        forward_start = time.perf_counter()
+        if self.incremental:
+            for camera in self.cameras:
+                self._encode(camera, self.buffers[camera].count - 1, stages)
+            slip_probabilities = [self.classifier.predict(camera, self.buffers[camera].count - 1)[1][0] for camera in self.cameras]
+        else:
+            for idx, camera in enumerate(self.cameras):
+                np.copyto(self.videos[idx], self.buffers[camera].window())
+            _, slip_probabilities = self.classifier.predict(self.videos)
+        decision_time = time.perf_counter()
+        self._trace('forward', forward_start, decision_time, GRASP, self.ticks - 1, stages)
+        self.latencies.append(decision_time - timestamp)
+
+        events = []
+        for camera, probability in zip(self.cameras, slip_probabilities):
+            events.append(self._decide(camera, float(probability), timestamps[camera], decision_time, self.buffers[camera].count - 1))
+
+        probabilities = np.asarray(slip_probabilities, dtype=np.float32)
+        if self.grasp_rule == 'mean':
+            grasp_probability = float(probabilities.mean())
+        else:
+            # 'any': the most likely finger decides, 'all': the least likely one
+            grasp_probability = float(probabilities.max() if self.grasp_rule == 'any' else probabilities.min())
+        events.append(self._decide(GRASP, grasp_probability, timestamp, decision_time, self.ticks - 1))
+        self._trace_decision(timestamp, decision_time, GRASP, self.ticks - 1, stages)
+
+        return [event for event in events if event is not None]
+
+    def _gate(self, camera, frame, frame_index, stages):
+        # Updates the gate of a camera, returns whether it is open
+        if self.gates is None:
+            return True
+        start = time.perf_counter()
+        active = self.gates[camera].update(frame)
+        self._trace('gate', start, time.perf_counter(), camera, frame_index, stages)
+        self.pending[camera] = self.pending[camera] or active
+        return active
+
+    def _encode(self, camera, frame_index, stages):
+        # Spatial tokens of the frames of the window that are not cached, usually only the newest frame; after a
+        # closed gate also the frames it skipped
+        start = time.perf_counter()
+        missing = self.classifier.missing(camera, frame_index)
+        if not missing:
+            return
+        for index in missing:
+            self.classifier.encode(camera, index, self.buffers[camera].frame(index))
+        self._trace('forward', start, time.perf_counter(), camera, frame_index, stages)
+
+    def _trace(self, stage, start, end, camera, frame_index, stages):
+        # Adds the span to the tracer and its time to the stages of the current decision
+        stages[stage] = stages.get(stage, 0.0) + end - start
+        if self.tracer is not None:
+            self.tracer.record(stage, start, end, camera, frame_index)
+
+    def _trace_decision(self, timestamp, decision_time, camera, frame_index, stages):
+        if self.tracer is None:
+            return
+        decided = time.perf_counter()
+        self._trace('decision', decision_time, decided, camera, frame_index, stages)
+        self.tracer.decision(timestamp, decided, stages)
+
+    def _decide(self, camera, probability, timestamp, decision_time, frame_index):
+        # Emits an event when a camera (or the grasp) goes from no slip to slip
+        slipping = probability >= self.threshold
+        started = slipping and not self.slipping[camera]
+        self.slipping[camera] = slipping
+        if not started:
+            return None
+
+        event = SlipEvent(camera, timestamp, decision_time, probability, frame_index)
+        self.events.append(event)
+        if self.on_slip is not None:
+            self.on_slip(event)
+        return event
+
+    def latency_ms(self):
+        """
+        Returns:
+        - tuple: Mean and maximum frame-to-decision latency in milliseconds over the recent decisions.
+        """
+        if not self.latencies:
+            return 0.0, 0.0
+        return 1000 * float(np.mean(self.latencies)), 1000 * max(self.latencies)
+
+    def run(self, devices, duration=None, batched=True, wait_key=True):
+        """
+        Polls the connected cameras for new frames and feeds the detector until 'q' is pressed, Ctrl+C, duration
+        seconds or the end of a replayed recording (gsdevice.ReplayCamera). Every frame is pushed once: a camera whose
+        frame_index did not change since its last frame is skipped.
+
+        Parameters:
+        - devices (dict): {camera name: connected gsdevice.Camera}, the cameras of the detector.
+        - duration (float): Optional run time in seconds.
+        - batched (bool): Classify all cameras in one forward per tick (push_all) instead of one forward per camera (push).
+        - wait_key (bool): Stop on 'q'. Needs an OpenCV build with GUI support, so turn it off on headless machines.
+        """
+        start_time = time.perf_counter()
+        last_index = dict.fromkeys(devices)
+        frames, timestamps = {}, {}
+        try:
+            while (duration is None or time.perf_counter() - start_time < duration) and all(device.while_condition for device in devices.values()):
+                for camera, device in devices.items():
+                    # Newest frame without blocking; a camera with no new frame since the last one has nothing to add
+                    frame = device.get_image(wait=False)
+                    if frame is None or device.frame_index == last_index[camera]:
+                        continue
+                    last_index[camera] = device.frame_index
+                    # Cropped a second time, like the frames of the training videos
+                    frames[camera] = device.recorded_frame(frame)
+                    # Capture time of the frame (set by gsdevice.Camera.get_image)
+                    timestamps[camera] = device.timestamp
+
+                events = []
+                # A batched tick needs a new frame of every camera, an unbatched push only of its own
+                if frames and (not batched or len(frames) == len(devices)):
+                    if batched:
+                        events = self.push_all(frames, timestamps)
+                    else:
+                        events = [self.push(camera, frames[camera], timestamps[camera]) for camera in frames]
+                    frames, timestamps = {}, {}
+                elif not wait_key:
+                    # No new frame yet; waitKey pauses otherwise
+                    time.sleep(0.0005)
+
+                for event in events:
+                    if event is not None:
+                        colored_print(f"Slip on {event.camera} (p={event.probability:.2f}), "
+                                      f"{1000 * (event.decision_time - event.frame_time):.1f} ms after the frame", "91")
+                if self.tracer is not None:
+                    self.tracer.log()
+                if wait_key and cv2.waitKey(1) & 0xFF == ord('q'):
+                    break
+        except KeyboardInterrupt:
+            colored_print('Interrupted!', "91")
+
+        mean_latency, max_latency = self.latency_ms()
+        colored_print(f"Frame-to-decision latency: mean {mean_latency:.1f} ms, max {max_latency:.1f} ms, {len(self.events)} slip events", "96")
+        if self.gates is not None:
+            colored_print(f"Motion gate: classified {self.decisions} of {self.decisions + self.held_decisions} decisions, held the rest", "96")
+        if self.tracer is not None:
+            self.tracer.log(force=True)
+        return self.events
+
+
+if __name__ == "__main__":
+    # The ONNX Runtime engine lives at the root of the repository
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+    from onnx_engine import SlipDetectionEngine
+    from cascade import CascadeClassifier, load_stage
+
+    parser = argparse.ArgumentParser(description='Real-time slip detection on the GelSight streams.')
+    parser.add_argument('--onnx', required=True,
+                        help='5-frame model exported with onnx_export.py, e.g. ../../trained_models/5_Frames/vvt_checkpoint_epoch75.onnx')
+    parser.add_argument('--replay', nargs=2, metavar=('LEFT', 'RIGHT'), default=None,
+                        help='Play back two recordings (.avi, .npy or clip directories) instead of the cameras')
+    parser.add_argument('--as-fast-as-possible', action='store_true', help='Replay without pacing the frames')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='Replay: random extra delay per frame')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='Replay: probability that a frame is lost')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--cascade', default=None,
+                        help='Calibration of calibrate_cascade.py: a cheap first stage classifies every window, --onnx only the uncertain ones')
+    parser.add_argument('--motion-gate', action='store_true', help='Only classify a camera when its frames change (see MotionGate)')
+    parser.add_argument('--headless', action='store_true', help="No 'q' to stop, for OpenCV builds without GUI support")
+    parser.add_argument('--deadline-ms', type=float, default=None, help='Frame-to-decision deadline of the control loop')
+    parser.add_argument('--log-interval', type=float, default=None, help='Seconds between two latency summaries')
+    parser.add_argument('--metrics-port', type=int, default=None, help='Serve the latency summary as JSON on this local port')
+    parser.add_argument('--trace', default=None, help='Write the latency spans to this Chrome trace file')
+    args = parser.parse_args()
+
+    tracing = any(value is not None for value in (args.deadline_ms, args.log_interval, args.metrics_port, args.trace))
+    tracer = LatencyTracer(deadline_ms=args.deadline_ms, log_interval=args.log_interval) if tracing else None
+    if tracer is not None and args.metrics_port is not None:
+        tracer.serve(args.metrics_port)
+
+    cam1_id = 0
+    cam2_id = 2
+
+    devices = {}
+    for idx, (name, cam_id) in enumerate([('left', cam1_id), ('right', cam2_id)]):
+        if args.replay:
+            device = gsdevice.ReplayCamera(args.replay[idx], realtime=not args.as_fast_as_possible, jitter_ms=args.jitter_ms,
+                                           drop_rate=args.drop_rate, seed=None if args.seed is None else args.seed + idx)
+        else:
+            device = gsdevice.Camera(f"Camera {name} - ID {cam_id}")
+            device.dev_id = cam_id
+        device.connect()
+        device.tracer = tracer
+        # Each camera on its own thread: the detector always gets the newest frames of both
+        device.start_capture()
+        devices[name] = device
+
+    # Leave cores free for the libfranka real-time loop
+    engine = SlipDetectionEngine(args.onnx, num_threads=2)
+    threshold = 0.5
+    if args.cascade is not None:
+        with open(args.cascade) as calibration_file:
+            calibration = json.load(calibration_file)
+        first_stage = load_stage(calibration['first_stage'], calibration['first_stage_frames'], num_threads=2,
+                                 downsample=calibration.get('first_stage_downsample', 1))
+        engine = CascadeClassifier.from_calibration(first_stage, engine, args.cascade)
+        # The margin was tuned around this threshold, the calibrated recall only holds with it
+        threshold = calibration['threshold']
+    detector = StreamingSlipDetector(engine, cameras=list(devices), num_frames=5, stride=1, threshold=threshold, tracer=tracer,
+                                     motion_gate={} if args.motion_gate else None)
+    try:
+        detector.run(devices, wait_key=not args.headless)
+    finally:
+        for device in devices.values():
+            device.stop_capture()
+        if args.cascade is not None:
+            colored_print(f"Cascade: {engine.deferred} of {engine.windows} windows went to the full model", "96")
+        if tracer is not None:
+            if args.trace is not None:
+                tracer.export_chrome_trace(args.trace)
+            tracer.close()
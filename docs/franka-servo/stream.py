@@ -3,17 +3,229 @@ __author__          ==  Amit Parag
 __organization__    ==  Sintef Ocean
 __date__            ==  18th January, 2024
 __description__     ==  A helper script to initialize cameras and record videos.
+
+                        The videos are encoded on a separate thread per camera (AsyncVideoWriter), so a slow
+                        encode does not stall capture. The capture time of every written frame goes to a
+                        sidecar file next to the video (<video>.timestamps.csv): the container always claims
+                        25 fps, the sidecar tells when each frame was really taken.
+
+                        With clip_shards=True the preprocessed frames are also written as training-ready clips
+                        (ClipShardWriter): uint8 RGB arrays of frames_per_shard frames, exactly as VideoDataset
+                        decodes the .avi clips, but without the lossy XVID round trip. Each recording is listed
+                        in a manifest (manifest.jsonl) with its object, experiment number and motion.
 """
 
 import os
+import json
+import time
+import queue
+import datetime
+import threading
+
 import cv2
+import numpy as np
 import gsdevice
 from utils import colored_print
 
 
 
 
-def record_and_save_videos(cam1_id, cam2_id, save_path='./videos/'):
+class AsyncVideoWriter:
+    def __init__(self, path, fourcc, fps, frame_size, queue_size=64, tracer=None):
+        """
+        cv2.VideoWriter running on its own thread, fed through a bounded queue.
+
+        Params:
+        - path (str): Path of the video.
+        - fourcc (int): Codec, e.g. cv2.VideoWriter_fourcc(*'XVID').
+        - fps (float): Nominal frame rate written to the container.
+        - frame_size (tuple): (width, height) of the frames.
+        - queue_size (int): Frames waiting to be encoded at most. When the queue is full, new frames are dropped and counted.
+        - tracer (LatencyTracer): Optional, records the enqueue and write stages.
+        """
+        self.writer = cv2.VideoWriter(path, fourcc, fps, frame_size, isColor=True)
+        self._start(path, queue_size, tracer)
+
+    def _start(self, path, queue_size, tracer=None):
+        self.path = path
+        self.tracer = tracer
+        self.name = os.path.basename(path)
+        self.timestamps_path = f'{os.path.splitext(path)[0]}.timestamps.csv'
+        self.frames = queue.Queue(maxsize=queue_size)
+
+        self.written = 0
+        self.dropped = 0
+        # Frames dropped since the last queued one, sent along with the next frame so the writer sees the gap
+        self.gap = 0
+        self.last_index = None
+        # Largest number of frames that waited for the encoder at once
+        self.max_queued = 0
+        # Converts time.perf_counter() capture timestamps to wall-clock time
+        self.clock_offset = time.time() - time.perf_counter()
+
+        self.thread = threading.Thread(target=self._run, name=f'AsyncVideoWriter-{self.name}', daemon=True)
+        self.thread.start()
+
+    @property
+    def queued(self):
+        return self.frames.qsize()
+
+    def write(self, frame, timestamp=None, frame_index=None):
+        """
+        Queues a frame without blocking.
+
+        Params:
+        - frame (np.ndarray): BGR uint8 frame. It is copied, so the caller may reuse its buffer.
+        - timestamp (float): time.perf_counter() when the frame was captured. Defaults to now.
+        - frame_index (int): Index of the frame in the capture (gsdevice.Camera.frame_index). Frames skipped before it,
+                             e.g. replaced by the capture thread before they were read, are a gap like dropped ones.
+                             The frame written last again (no new frame arrived) is not written twice.
+
+        Returns:
+        - bool: False if the queue was full and the frame was dropped, or if it was written already.
+        """
+        if frame_index is not None and frame_index == self.last_index:
+            return False
+        start = time.perf_counter()
+        timestamp = start if timestamp is None else timestamp
+        if frame_index is not None:
+            if self.last_index is not None:
+                self.gap += max(frame_index - self.last_index - 1, 0)
+            self.last_index = frame_index
+        try:
+            self.frames.put_nowait((frame.copy(), timestamp, self.gap))
+            self.max_queued = max(self.max_queued, self.frames.qsize())
+            self.gap = 0
+            return True
+        except queue.Full:
+            self.dropped += 1
+            self.gap += 1
+            return False
+        finally:
+            if self.tracer is not None:
+                self.tracer.record('enqueue', start, time.perf_counter(), self.name)
+
+    def _run(self):
+        with open(self.timestamps_path, 'w') as self.timestamps_file:
+            self.timestamps_file.write('frame,timestamp\n')
+            while True:
+                item = self.frames.get()
+                # None marks the end of the recording
+                if item is None:
+                    break
+                frame, timestamp, gap = item
+                if gap:
+                    self._gap(gap)
+                encode_start = time.perf_counter()
+                self._encode(frame, timestamp)
+                if self.tracer is not None:
+                    self.tracer.record('write', encode_start, time.perf_counter(), self.name, self.written)
+                self.written += 1
+
+    def release(self):
+        """
+        Encodes the frames still queued, closes the video and the sidecar file.
+
+        Returns:
+        - str: Summary of the written, dropped and queued frame counts.
+        """
+        still_queued = self.queued
+        self.frames.put(None)
+        self.thread.join()
+        self._close()
+        return (f"{self.written} frames written to '{self.path}', {self.dropped} dropped, "
+                f"{still_queued} still queued at the end, at most {self.max_queued} queued")
+
+    def _encode(self, frame, timestamp):
+        self.writer.write(frame)
+        self.timestamps_file.write(f'{self.written},{self.clock_offset + timestamp:.6f}\n')
+
+    def _gap(self, dropped):
+        # The video skips the dropped frames, the sidecar shows the jump in time
+        pass
+
+    def _close(self):
+        self.writer.release()
+
+
+class ClipShardWriter(AsyncVideoWriter):
+    def __init__(self, directory, frames_per_shard=5, queue_size=64, tracer=None):
+        """
+        Writes the frames as training-ready clips instead of a video, on its own thread like AsyncVideoWriter.
+
+        Every frames_per_shard frames become one clip_<index>.npy in directory: a uint8 array of shape
+        (frames_per_shard, height, width, 3) in RGB, which is what VideoDataset gets from decoding an .avi clip.
+        Put the clips in the slip/wriggle folders of a dataset like the .avi clips. The capture times are in
+        <directory>.timestamps.csv; frame f is frame f % frames_per_shard of clip f // frames_per_shard.
+
+        A clip only ever holds consecutive frames: when frames are dropped at write (queue full) or in capture (see
+        the frame_index of write), the incomplete clip before the gap is discarded and counted in discarded_clips, and
+        the next clip starts after the gap.
+
+        Params:
+        - directory (str): Directory of the clips.
+        - frames_per_shard (int): Frames per clip, the N of the N_Frames dataset the clips are meant for.
+        - queue_size (int), tracer (LatencyTracer): See AsyncVideoWriter.
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.frames_per_shard = frames_per_shard
+        self.shard = None
+        self.shard_timestamps = np.empty(frames_per_shard)
+        self.filled = 0
+        self.shards = 0
+        # Incomplete clips thrown away because frames were dropped in the middle of them
+        self.discarded_clips = 0
+        self.discarded_frames = 0
+        self._start(directory, queue_size, tracer)
+
+    def _encode(self, frame, timestamp):
+        if self.shard is None:
+            self.shard = np.empty((self.frames_per_shard,) + frame.shape, dtype=np.uint8)
+        cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=self.shard[self.filled])
+        self.shard_timestamps[self.filled] = timestamp
+        self.filled += 1
+        if self.filled == self.frames_per_shard:
+            np.save(os.path.join(self.directory, f'clip_{self.shards:06d}.npy'), self.shard)
+            # Only the frames of saved clips go to the sidecar, so frame f stays in clip f // frames_per_shard
+            for position, capture_time in enumerate(self.shard_timestamps):
+                self.timestamps_file.write(f'{self.shards * self.frames_per_shard + position},{self.clock_offset + capture_time:.6f}\n')
+            self.shards += 1
+            self.filled = 0
+
+    def _gap(self, dropped):
+        # The frames before and after the gap are not consecutive, they must not end up in the same clip
+        if self.filled:
+            self.discarded_clips += 1
+            self.discarded_frames += self.filled
+            self.filled = 0
+
+    def _close(self):
+        # Frames of an incomplete last clip are not saved, self.filled counts them
+        pass
+
+    def release(self):
+        summary = super().release()
+        return (f"{summary}, {self.shards} clips saved, {self.discarded_clips} clips ({self.discarded_frames} frames) discarded at gaps, "
+                f"{self.filled} frames of an incomplete last clip discarded")
+
+
+def append_manifest_entry(manifest_path, entry):
+    """
+    Appends a recording to the experiment manifest, one JSON object per line.
+
+    Params:
+    - manifest_path (str): Path of the manifest, e.g. './datasets/manifest.jsonl'.
+    - entry (dict): The recording, see record_and_save_videos.
+    """
+    with open(manifest_path, 'a') as manifest_file:
+        manifest_file.write(json.dumps(entry) + '\n')
+
+
+
+
+def record_and_save_videos(cam1_id, cam2_id, save_path='./videos/', threaded_capture=True, capture_queue_size=64, clip_shards=False,
+                           frames_per_shard=5, experiment=None, manifest_path=None, tracer=None):
     """
     Record and save videos from two GelSight cameras.
 
@@ -21,6 +233,18 @@ def record_and_save_videos(cam1_id, cam2_id, save_path='./videos/'):
     - cam1_id (int): Camera ID for the first camera.
     - cam2_id (int): Camera ID for the second camera.
     - save_path (str): Save path for the videos.
+    - threaded_capture (bool): Read each camera on its own thread (see gsdevice.FrameGrabber), so both sensors are
+                               captured at the same time and display and encoding do not hold up capture.
+    - capture_queue_size (int): Frames each capture thread queues while the loop is busy. The loop takes them in order
+                                (gsdevice.Camera.get_next_image), so a slow display or encode delays frames instead of
+                                skipping them; only when a queue is full is its oldest frame lost (capture_dropped).
+    - clip_shards (bool): Also write the frames as training-ready clips (see ClipShardWriter) to camera_<id>_clips/.
+    - frames_per_shard (int): Frames per clip.
+    - experiment (dict): If given, e.g. {'object': 'wire3D', 'exp_number': 2, 'motion': 'wriggle'}, the recording is
+                         added to the manifest with these fields.
+    - manifest_path (str): Manifest of the recordings. Defaults to manifest.jsonl in save_path.
+    - tracer (LatencyTracer): Optional, traces the read, preprocess, enqueue and write stages of every frame and
+                              prints its summary every log_interval seconds and at the end.
     """
 
     # Check if the specified save path is a valid folder
@@ -41,6 +265,13 @@ def record_and_save_videos(cam1_id, cam2_id, save_path='./videos/'):
     dev2.dev_id = cam2_id
     dev2.connect()
 
+    dev1.tracer = tracer
+    dev2.tracer = tracer
+
+    if threaded_capture:
+        dev1.start_capture(queue_size=capture_queue_size)
+        dev2.start_capture(queue_size=capture_queue_size)
+
 
 
     # Set up VideoWriters for saving videos
@@ -54,9 +285,17 @@ def record_and_save_videos(cam1_id, cam2_id, save_path='./videos/'):
 
 
 
-    # Initialize VideoWriters
-    out1 = cv2.VideoWriter(save_path1, fourcc, 25, (dev1.imgh, dev1.imgw), isColor=True)
-    out2 = cv2.VideoWriter(save_path2, fourcc, 25, (dev2.imgh, dev2.imgw), isColor=True)
+    # Initialize VideoWriters, each encoding on its own thread
+    out1 = AsyncVideoWriter(save_path1, fourcc, 25, (dev1.imgh, dev1.imgw), tracer=tracer)
+    out2 = AsyncVideoWriter(save_path2, fourcc, 25, (dev2.imgh, dev2.imgw), tracer=tracer)
+    writers = [(dev1, out1), (dev2, out2)]
+
+    # Training-ready clips next to the videos
+    if clip_shards:
+        shards1 = ClipShardWriter(f'{save_path}camera_{dev1.dev_id}_clips', frames_per_shard, tracer=tracer)
+        shards2 = ClipShardWriter(f'{save_path}camera_{dev2.dev_id}_clips', frames_per_shard, tracer=tracer)
+        writers += [(dev1, shards1), (dev2, shards2)]
+    started_at = datetime.datetime.now().isoformat(timespec='seconds')
 
 
 
@@ -71,9 +310,9 @@ def record_and_save_videos(cam1_id, cam2_id, save_path='./videos/'):
 
         # Main video recording loop
         while dev1.while_condition and dev2.while_condition:
-            # Get frames from both cameras
-            frame1 = dev1.get_image()
-            frame2 = dev2.get_image()
+            # Get the next frames from both cameras, every captured frame in order
+            frame1 = dev1.get_next_image()
+            frame2 = dev2.get_next_image()
 
             # Add camera ID labels to frames
             frame1_display = cv2.putText(frame1.copy(), f'Camera {dev1.dev_id}', (20, 50), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2, cv2.LINE_AA)
@@ -86,12 +325,18 @@ def record_and_save_videos(cam1_id, cam2_id, save_path='./videos/'):
             cv2.imshow('Dual Camera View', combined_frame)
 
             # Crop and resize frames
-            frame1_cropped = gsdevice.resize_crop_mini(img=frame1, imgw=dev1.imgh, imgh=dev1.imgw)
-            frame2_cropped = gsdevice.resize_crop_mini(img=frame2, imgw=dev2.imgh, imgh=dev2.imgw)
+            frame1_cropped = dev1.recorded_frame(frame1)
+            frame2_cropped = dev2.recorded_frame(frame2)
 
-            # Save cropped frames to videos
-            out1.write(frame1_cropped)
-            out2.write(frame2_cropped)
+            # Queue cropped frames for encoding, with their capture time
+            out1.write(frame1_cropped, dev1.timestamp, dev1.frame_index)
+            out2.write(frame2_cropped, dev2.timestamp, dev2.frame_index)
+            if clip_shards:
+                shards1.write(frame1_cropped, dev1.timestamp, dev1.frame_index)
+                shards2.write(frame2_cropped, dev2.timestamp, dev2.frame_index)
+
+            if tracer is not None:
+                tracer.log()
 
             # Break the loop if 'q' is pressed
             if cv2.waitKey(1) & 0xFF == ord('q'):
@@ -104,9 +349,31 @@ def record_and_save_videos(cam1_id, cam2_id, save_path='./videos/'):
 
 
     finally:
+        # Frames pushed out of the full capture queues before the loop read them never reached the writers
+        capture_dropped = {dev.dev_id: dev.grabber.dropped if dev.grabber is not None else 0 for dev in (dev1, dev2)}
+
         # Release VideoWriters and close cameras
-        out1.release()
-        out2.release()
+        dev1.stop_capture()
+        dev2.stop_capture()
+        recordings = []
+        for dev, out in writers:
+            summary = out.release()
+            # Dropped frames leave gaps in the video, see the timestamps sidecar
+            colored_print(f"Info: {summary}, {capture_dropped[dev.dev_id]} dropped in capture before they were read",
+                          "93" if out.dropped or capture_dropped[dev.dev_id] else "96")
+            recording = {'camera': dev.dev_id, 'path': out.path, 'timestamps': out.timestamps_path, 'frames': out.written, 'dropped': out.dropped,
+                         'capture_dropped': capture_dropped[dev.dev_id]}
+            if isinstance(out, ClipShardWriter):
+                recording.update({'clips': out.shards, 'discarded_clips': out.discarded_clips, 'frames_per_shard': out.frames_per_shard})
+            recordings.append(recording)
+
+        if experiment is not None:
+            manifest_path = manifest_path or os.path.join(save_path, 'manifest.jsonl')
+            append_manifest_entry(manifest_path, {**experiment, 'started_at': started_at, 'recordings': recordings})
+            colored_print(f"Info: Recording added to '{manifest_path}'", "96")
+
+        if tracer is not None:
+            tracer.log(force=True)
         dev1.stop_video()
         dev2.stop_video()
 
@@ -0,0 +1,176 @@
+import itertools
+import torch
+from tqdm import tqdm
+
+from utils import colored_print, autocast
+from distributed import is_main_process
+from metrics import MetricsAccumulator
+
+
+class Evaluator:
+    def __init__(self, model, criterion, device, loaders, monitor='Validation', eval_interval=1, eval_on_plateau=False, plateau_patience=3, early_stopping_patience=None, min_delta=0.0, log_interval=10, autocast_dtype=None,
+                 memory_format=torch.preserve_format):
+        """
+        Evaluates a model on several loaders in a single interleaved pass and decides when to evaluate
+        and when to stop training.
+
+        Parameters:
+        - model: The model to evaluate.
+        - criterion: Loss function.
+        - device: Device to run on.
+        - loaders: Dictionary of {split name: DataLoader}, e.g. {'Test': test_loader, 'Validation': val_loader}.
+        - monitor: Name of the split whose loss drives the plateau detection and early stopping.
+        - eval_interval: Evaluate every N epochs. The last epoch is always evaluated.
+        - eval_on_plateau: If True, only the monitored split is evaluated every eval_interval epochs.
+                           The other splits are evaluated when the monitored loss has not improved
+                           for plateau_patience evaluations, and on the last epoch.
+        - plateau_patience: Number of evaluations without improvement that counts as a plateau.
+        - early_stopping_patience: Stop training after this many evaluations without improvement. None disables it.
+        - min_delta: Minimum decrease of the monitored loss that counts as an improvement.
+        - log_interval: Update the progress bar every N steps. This is the only time the metrics are synchronized with the host.
+        - autocast_dtype: Run the forward pass under autocast with this dtype, e.g. torch.bfloat16. None runs in float32.
+        - memory_format: Memory format of the videos passed to the model, e.g. torch.channels_last_3d.
+        """
+        self.model = model
+        self.criterion = criterion
+        self.device = device
+        self.loaders = loaders
+        self.monitor = monitor
+        self.eval_interval = eval_interval
+        self.eval_on_plateau = eval_on_plateau
+        self.plateau_patience = plateau_patience
+        self.early_stopping_patience = early_stopping_patience
+        self.min_delta = min_delta
+        self.log_interval = log_interval
+        self.autocast_dtype = autocast_dtype
+        self.memory_format = memory_format
+
+        self.best_loss = float('inf')
+        self.evaluations_without_improvement = 0
+
+    def splits_to_evaluate(self, epoch, num_epochs):
+        """
+        Returns the names of the splits to evaluate after this epoch. An empty list means no evaluation.
+
+        Parameters:
+        - epoch: Current epoch number.
+        - num_epochs: Total number of epochs.
+        """
+        last_epoch = epoch == num_epochs - 1
+        if not last_epoch and (epoch + 1) % self.eval_interval != 0:
+            return []
+        if not self.eval_on_plateau or last_epoch or self.on_plateau():
+            return list(self.loaders)
+        return [self.monitor]
+
+    def on_plateau(self):
+        return self.evaluations_without_improvement >= self.plateau_patience
+
+    def evaluate(self, epoch, num_epochs, splits=None):
+        """
+        Evaluates the model on the given splits. The batches of all loaders are interleaved, so the
+        workers of every loader are prefetching at the same time instead of one loader after the other.
+
+        Parameters:
+        - epoch: Current epoch number.
+        - num_epochs: Total number of epochs.
+        - splits: Names of the splits to evaluate. Defaults to all loaders.
+
+        Returns:
+        - dict: {split name: (avg loss, accuracy, precision, recall, f1, false positives, false negatives)}
+        """
+        splits = list(self.loaders) if splits is None else splits
+        loaders = [self.loaders[split] for split in splits]
+
+        accumulators = {split: MetricsAccumulator(device=self.device) for split in splits}
+
+        self.model.eval()
+        with torch.no_grad():
+            batches = itertools.zip_longest(*loaders)
+            batches_with_progress = tqdm(batches, total=max(len(loader) for loader in loaders), desc=f'Epoch [{epoch+1}/{num_epochs}] (evaluating {", ".join(splits)})', position=0, leave=True, disable=not is_main_process())
+
+            for step, step_batches in enumerate(batches_with_progress, start=1):
+                for split, batch in zip(splits, step_batches):
+                    if batch is None:
+                        continue
+                    videos, labels = batch
+                    videos = videos.to(self.device, memory_format=self.memory_format)
+                    labels = labels.to(self.device)
+                    with autocast(self.device, self.autocast_dtype):
+                        outputs = self.model(videos)
+                    outputs = outputs.float()
+                    loss = self.criterion(outputs, labels)
+                    accumulators[split].update(loss, outputs, labels)
+
+                if step % self.log_interval == 0 and is_main_process():
+                    batches_with_progress.set_postfix({f'{split} Loss': accumulators[split].compute()['Loss'] for split in splits})
+
+        results = {}
+        for split in splits:
+            # Sum over all ranks (no-op when not distributed)
+            accumulators[split].all_reduce()
+            metrics = accumulators[split].compute()
+            results[split] = (metrics['Loss'], metrics['Accuracy'], metrics['Precision'], metrics['Recall'], metrics['F1-Score'],
+                              metrics['False Positives'], metrics['False Negatives'])
+
+        return results
+
+    def precision_parity(self, epoch, num_epochs, split='Validation'):
+        """
+        Evaluates a split in float32 and with autocast_dtype and reports the difference.
+
+        Returns:
+        - dict: The metrics of both runs and the deltas of loss, accuracy and F1 (autocast minus float32).
+        """
+        autocast_dtype = self.autocast_dtype
+        try:
+            self.autocast_dtype = None
+            float32_metrics = self.evaluate(epoch, num_epochs, [split])[split]
+            self.autocast_dtype = autocast_dtype
+            autocast_metrics = self.evaluate(epoch, num_epochs, [split])[split]
+        finally:
+            self.autocast_dtype = autocast_dtype
+
+        names = ['Loss', 'Accuracy', 'Precision', 'Recall', 'F1-Score']
+        float32_metrics = dict(zip(names, float32_metrics))
+        autocast_metrics = dict(zip(names, autocast_metrics))
+        return {
+            'float32': float32_metrics,
+            str(autocast_dtype).replace('torch.', ''): autocast_metrics,
+            'Loss Delta': autocast_metrics['Loss'] - float32_metrics['Loss'],
+            'Accuracy Delta': autocast_metrics['Accuracy'] - float32_metrics['Accuracy'],
+            'F1 Delta': autocast_metrics['F1-Score'] - float32_metrics['F1-Score']
+        }
+
+    def update(self, results):
+        """
+        Tracks the monitored loss and returns True if training should stop early.
+
+        Parameters:
+        - results: The dictionary returned by evaluate.
+        """
+        if self.monitor not in results:
+            return False
+
+        monitored_loss = results[self.monitor][0]
+        if monitored_loss < self.best_loss - self.min_delta:
+            self.best_loss = monitored_loss
+            self.evaluations_without_improvement = 0
+        else:
+            self.evaluations_without_improvement += 1
+
+        if self.early_stopping_patience is not None and self.evaluations_without_improvement >= self.early_stopping_patience:
+            if is_main_process():
+                colored_print(f"Early stopping: {self.monitor} loss has not improved for {self.evaluations_without_improvement} evaluations", color_code=33)
+            return True
+        return False
+
+    def state_dict(self):
+        """
+        State of the plateau detection and early stopping, saved with the checkpoints so a resumed run continues it.
+        """
+        return {'best_loss': self.best_loss, 'evaluations_without_improvement': self.evaluations_without_improvement}
+
+    def load_state_dict(self, state_dict):
+        self.best_loss = state_dict['best_loss']
+        self.evaluations_without_improvement = state_dict['evaluations_without_improvement']
@@ -0,0 +1,87 @@
+import torch
+
+from distributed import all_reduce_tensor
+
+
+class MetricsAccumulator:
+    def __init__(self, num_classes=2, positive_class=1, device='cpu'):
+        """
+        Accumulates the loss and the confusion counts of an epoch as tensors on the device, so the hot loop
+        never waits on a host sync. Call compute() at a logging interval or at the end of the epoch.
+
+        Precision, recall and F1 are computed from the confusion counts for positive_class, which matches
+        sklearn's precision_recall_fscore_support(average='binary', zero_division=0).
+
+        Parameters:
+        - num_classes: Number of classes.
+        - positive_class: Index of the class treated as positive for precision, recall and F1.
+        - device: Device the counts live on. Use the device of the model outputs.
+        """
+        self.num_classes = num_classes
+        self.positive_class = positive_class
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        self.loss_sum = torch.zeros((), dtype=torch.float64, device=self.device)
+        # confusion[true, predicted]
+        self.confusion = torch.zeros(self.num_classes, self.num_classes, dtype=torch.int64, device=self.device)
+        self.num_batches = 0
+
+    def update(self, loss, outputs, labels):
+        """
+        Adds a batch. Does not synchronize with the host.
+
+        Parameters:
+        - loss: Scalar loss tensor of the batch.
+        - outputs: Logits of shape (batch, num_classes).
+        - labels: Class indices of shape (batch,).
+        """
+        self.loss_sum += loss.detach()
+        self.num_batches += 1
+
+        predicted = outputs.detach().argmax(dim=1)
+        index = labels * self.num_classes + predicted
+        self.confusion += torch.bincount(index, minlength=self.num_classes ** 2).view(self.num_classes, self.num_classes)
+
+    def all_reduce(self):
+        """
+        Sums the counts over all ranks. No-op when not running distributed.
+        """
+        num_batches = torch.tensor([self.num_batches], dtype=torch.float64, device=self.device)
+        packed = all_reduce_tensor(torch.cat([self.loss_sum.view(1), num_batches, self.confusion.flatten().double()]))
+        self.loss_sum = packed[0]
+        self.num_batches = int(packed[1].item())
+        self.confusion = packed[2:].round().long().view(self.num_classes, self.num_classes)
+
+    def compute(self):
+        """
+        Synchronizes once and returns the metrics accumulated so far.
+
+        Returns:
+        - dict: Loss (mean over batches), Accuracy (%), Precision, Recall, F1-Score, False Positives, False Negatives.
+        """
+        loss_sum = self.loss_sum.item()
+        confusion = self.confusion.cpu()
+
+        total = confusion.sum().item()
+        correct = confusion.diagonal().sum().item()
+
+        p = self.positive_class
+        true_positives = confusion[p, p].item()
+        false_positives = confusion[:, p].sum().item() - true_positives
+        false_negatives = confusion[p, :].sum().item() - true_positives
+
+        precision = true_positives / (true_positives + false_positives) if true_positives + false_positives else 0.0
+        recall = true_positives / (true_positives + false_negatives) if true_positives + false_negatives else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+
+        return {
+            'Loss': loss_sum / max(self.num_batches, 1),
+            'Accuracy': 100. * correct / max(total, 1),
+            'Precision': precision,
+            'Recall': recall,
+            'F1-Score': f1,
+            'False Positives': false_positives,
+            'False Negatives': false_negatives
+        }
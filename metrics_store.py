@@ -0,0 +1,161 @@
+"""
+__author__          ==  Amit Parag
+__organization__    ==  Sintef Ocean
+__description__     ==  Append-only, crash-safe store for training metrics.
+
+                        Every run writes its own JSON Lines file in the store directory, so any number of
+                        runs can log at the same time without locks or overwriting each other. Rows are
+                        appended as they are produced and epoch rows are fsynced, so a crash loses at most
+                        the steps since the last epoch. A reader can follow the files incrementally.
+
+                        Row types:
+                        - start:   {'type': 'start', 'run', 'name', 'config', 'resume', 'time'}
+                        - step:    {'type': 'step', 'run', 'name', 'split', 'epoch', 'step', <metrics>, 'time'}
+                        - epoch:   {'type': 'epoch', 'run', 'name', 'split', 'epoch', <metrics>, 'time'}
+                        - summary: {'type': 'summary', 'run', 'name', 'Training Time', 'time'}
+"""
+
+import os
+import json
+import time
+
+
+class MetricsStore:
+    def __init__(self, store_dir, name, config=None, resume=False):
+        """
+        Opens a new run file in the store.
+
+        Parameters:
+        - store_dir: Directory holding one .jsonl file per run.
+        - name: Name of the experiment, e.g. '5_Frames_VVT'. Later runs with the same name replace earlier ones when plotting.
+        - config: Optional dictionary of hyperparameters recorded in the start row.
+        - resume: The run continues the latest run with the same name from a checkpoint, so the reader appends its
+                  rows to that run instead of replacing it.
+        """
+        os.makedirs(store_dir, exist_ok=True)
+        self.name = name
+        self.run_id = f"{name}_{time.strftime('%Y%m%d-%H%M%S')}_{os.getpid()}"
+        self.path = os.path.join(store_dir, f'{self.run_id}.jsonl')
+        self.file = open(self.path, 'a', buffering=1)
+
+        self._write({'type': 'start', 'config': config or {}, 'resume': resume}, sync=True)
+
+    def _write(self, row, sync=False):
+        row = {'run': self.run_id, 'name': self.name, **row, 'time': time.time()}
+        # One write per line, so a crash leaves at most one truncated line at the end of the file
+        self.file.write(json.dumps(row) + '\n')
+        if sync:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def log_step(self, split, epoch, step, metrics):
+        """
+        Appends a per-step row. Not fsynced.
+        """
+        self._write({'type': 'step', 'split': split, 'epoch': epoch, 'step': step, **metrics})
+
+    def log_epoch(self, split, epoch, metrics):
+        """
+        Appends a per-epoch row and syncs it to disk.
+        """
+        self._write({'type': 'epoch', 'split': split, 'epoch': epoch, **metrics}, sync=True)
+
+    def log_summary(self, training_time):
+        self._write({'type': 'summary', 'Training Time': training_time}, sync=True)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+class MetricsReader:
+    def __init__(self, store_dir):
+        """
+        Follows the run files of a store. Each call to poll() only reads what was appended since the last call.
+
+        Parameters:
+        - store_dir: Directory holding one .jsonl file per run.
+        """
+        self.store_dir = store_dir
+        self.offsets = {}
+        self.rows = []
+
+    def poll(self):
+        """
+        Reads the complete rows appended since the last call.
+
+        Returns:
+        - list: The new rows.
+        """
+        new_rows = []
+        if not os.path.isdir(self.store_dir):
+            return new_rows
+
+        for file_name in sorted(os.listdir(self.store_dir)):
+            if not file_name.endswith('.jsonl'):
+                continue
+            path = os.path.join(self.store_dir, file_name)
+            with open(path, 'rb') as f:
+                f.seek(self.offsets.get(path, 0))
+                for line in f:
+                    # A line without newline is still being written, or was cut by a crash
+                    if not line.endswith(b'\n'):
+                        break
+                    self.offsets[path] = self.offsets.get(path, 0) + len(line)
+                    new_rows.append(json.loads(line))
+
+        self.rows.extend(new_rows)
+        return new_rows
+
+    def losses_dict(self, refresh=True):
+        """
+        Builds the dictionary that VideoTraining.train returns, for every run name in the store.
+        Later runs with the same name replace earlier ones, except resumed runs, which are appended to the run they
+        continue (its epochs, and the sum of the training times).
+
+        Parameters:
+        - refresh: Poll for new rows first.
+
+        Returns:
+        - dict: {name: {'Train': {...}, 'Test': {...}, 'Validation': {...}, 'Training Time': seconds}}
+        """
+        if refresh:
+            self.poll()
+
+        runs = {}
+        start_times = {}
+        last_times = {}
+        training_times = {}
+        latest_run = {}
+        # The run the rows of a run go to: itself, or for a resumed run the run it continues
+        merged_into = {}
+        for row in self.rows:
+            last_times[row['run']] = row['time']
+
+            if row['type'] == 'start':
+                start_times[row['run']] = row['time']
+                if row.get('resume') and row['name'] in latest_run:
+                    merged_into[row['run']] = latest_run[row['name']]
+                else:
+                    merged_into[row['run']] = row['run']
+                    if row['name'] not in latest_run or start_times[latest_run[row['name']]] <= row['time']:
+                        latest_run[row['name']] = row['run']
+
+            run_id = merged_into.get(row['run'], row['run'])
+            run = runs.setdefault(run_id, {'Train': {}, 'Test': {}, 'Validation': {}})
+            if row['type'] == 'epoch':
+                split = run.setdefault(row['split'], {})
+                split.setdefault('Epoch', []).append(row['epoch'])
+                for key, value in row.items():
+                    if key not in ('run', 'name', 'type', 'split', 'epoch', 'time'):
+                        split.setdefault(key, []).append(value)
+            elif row['type'] == 'summary':
+                training_times[row['run']] = row['Training Time']
+
+        losses = {}
+        for name, run_id in latest_run.items():
+            # A run that has not finished (or crashed) reports the time up to its last row
+            runs[run_id]['Training Time'] = sum(training_times.get(member, last_times[member] - start_times[member])
+                                                for member, target in merged_into.items() if target == run_id)
+            losses[name] = runs[run_id]
+        return losses
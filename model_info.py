@@ -1,22 +1,60 @@
+import copy
 import torch
 import time
 import torch.nn as nn
 from vit_pytorch.vivit import ViT
 import pytorchvideo.models.resnet
+from compilation import compile_model
 
 def count_parameters(model):
     return sum(p.numel() for p in model.parameters() if p.requires_grad)
 
-def measure_inference_time(model, input_size):
-    input_tensor = torch.randn(*input_size)
+def measure_inference_time(model, input_size, autocast_dtype=None, warmup=1, runs=5, memory_format=torch.contiguous_format):
+    # autocast_dtype=torch.bfloat16 runs the forward pass under CPU autocast.
+    # The warm-up calls keep one-off costs (allocation, compilation) out of the timing.
+    input_tensor = torch.randn(*input_size).contiguous(memory_format=memory_format)
     model.eval()
-    with torch.no_grad():
+    with torch.no_grad(), torch.autocast('cpu', dtype=autocast_dtype, enabled=autocast_dtype is not None):
+        for _ in range(warmup):
+            model(input_tensor)
         start_time = time.time()
-        output = model(input_tensor)
+        for _ in range(runs):
+            output = model(input_tensor)
         end_time = time.time()
-        inference_time = end_time - start_time
+        inference_time = (end_time - start_time) / runs
     return inference_time
 
+def compare_compiled(name, model, input_size):
+    # Eager, torch.compile and TorchScript inference rates side by side
+    eager_rate = 1 / measure_inference_time(model, input_size)
+    script_model = compile_model(copy.deepcopy(model), mode='torchscript', example_input=torch.randn(*input_size))
+    script_rate = 1 / measure_inference_time(script_model, input_size)
+    compiled_model = compile_model(copy.deepcopy(model), mode='compile')
+    compiled_rate = 1 / measure_inference_time(compiled_model, input_size)
+    print("{:<10} {:<20} {:<20} {:<20}".format("", "Eager (Hz)", "torch.compile (Hz)", "TorchScript (Hz)"))
+    print("{:<10} {:<20.2f} {:<20.2f} {:<20.2f}".format(name, eager_rate, compiled_rate, script_rate))
+
+def measure_training_step_time(model, input_size, warmup=1, runs=3, memory_format=torch.contiguous_format):
+    input_tensor = torch.randn(*input_size).contiguous(memory_format=memory_format)
+    labels = torch.zeros(input_size[0], dtype=torch.long)
+    criterion = nn.CrossEntropyLoss()
+    model.train()
+    for step in range(warmup + runs):
+        if step == warmup:
+            start_time = time.time()
+        model.zero_grad()
+        criterion(model(input_tensor), labels).backward()
+    return (time.time() - start_time) / runs
+
+def compare_memory_formats(name, model, input_size):
+    # Default (NCDHW) layout against channels_last_3d (NDHWC) for the weights and the input
+    channels_last_model = copy.deepcopy(model).to(memory_format=torch.channels_last_3d)
+    print("{:<10} {:<25} {:<25}".format("", "Inference (s)", "Training step (s)"))
+    print("{:<10} {:<25.4f} {:<25.4f}".format("NCDHW", measure_inference_time(model, input_size), measure_training_step_time(model, input_size)))
+    print("{:<10} {:<25.4f} {:<25.4f}".format("NDHWC",
+                                              measure_inference_time(channels_last_model, input_size, memory_format=torch.channels_last_3d),
+                                              measure_training_step_time(channels_last_model, input_size, memory_format=torch.channels_last_3d)))
+
 # Define ViT parameters
 vivit_params = {
     'image_size': (240, 320),
@@ -51,6 +89,8 @@ print("ViT - Number of learnable parameters:", vivit_num_params)
 # Calculate inference rate in Hertz for ViT model
 vivit_inference_rate = 1 / vivit_inference_time
 print("ViT - Inference rate:", vivit_inference_rate, "Hertz")
+vivit_bf16_inference_rate = 1 / measure_inference_time(vivit_model, vivit_input_size, autocast_dtype=torch.bfloat16)
+print("ViT - Inference rate (bfloat16):", vivit_bf16_inference_rate, "Hertz")
 
 # Print number of learnable parameters and inference time for ResNet model
 resnet_num_params = count_parameters(resnet_model)
@@ -58,4 +98,13 @@ resnet_input_size = (1, 3, 5, 240, 320)  # (batch_size, num_channels, num_frames
 resnet_inference_time = measure_inference_time(resnet_model, resnet_input_size)
 print("ResNet - Number of learnable parameters:", resnet_num_params)
 resnet_inference_rate = 1 / resnet_inference_time
-print("ResNet - Inference rate:", resnet_inference_rate, "Hertz")
\ No newline at end of file
+print("ResNet - Inference rate:", resnet_inference_rate, "Hertz")
+resnet_bf16_inference_rate = 1 / measure_inference_time(resnet_model, resnet_input_size, autocast_dtype=torch.bfloat16)
+print("ResNet - Inference rate (bfloat16):", resnet_bf16_inference_rate, "Hertz")
+
+# Memory format of the 3D convolutions
+compare_memory_formats("ResNet", resnet_model, (4, 3, 5, 240, 320))
+
+# Compiled inference
+compare_compiled("ViT", vivit_model, vivit_input_size)
+compare_compiled("ResNet", resnet_model, resnet_input_size)
@@ -0,0 +1,117 @@
+"""
+__author__          ==  Amit Parag
+__organization__    ==  Sintef Ocean
+__description__     ==  Slip detection with ONNX Runtime.
+
+                        Only needs numpy and onnxruntime: a deployment does not import torch, vit_pytorch or
+                        pytorchvideo, so it starts faster and uses less memory. The ONNX models are written by
+                        onnx_export.py.
+"""
+
+import os
+import time
+
+import numpy as np
+import onnxruntime as ort
+
+
+# Class indices of the datasets (sorted class folders)
+CLASSES = ['slip', 'wriggle']
+
+
+def _available_cores():
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+
+
+class SlipDetectionEngine:
+    def __init__(self, onnx_path, num_threads=None):
+        """
+        Loads an exported slip classifier into an ONNX Runtime session.
+
+        Parameters:
+        - onnx_path: Model written by onnx_export.export_onnx.
+        - num_threads: Intra-op threads. Defaults to the cores available to the process; see tune_threads.
+        """
+        self.onnx_path = onnx_path
+        self.num_threads = num_threads or _available_cores()
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.intra_op_num_threads = self.num_threads
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(onnx_path, sess_options=options, providers=['CPUExecutionProvider'])
+
+        video_input = self.session.get_inputs()[0]
+        self.input_name = video_input.name
+        # (batch, channels, frames, height, width), batch is dynamic
+        self.input_shape = video_input.shape
+
+    @staticmethod
+    def preprocess(frames):
+        """
+        Turns the frames of one clip into a model input, like ToTensor and the permute of VideoDataset.
+
+        Parameters:
+        - frames: List of (height, width, 3) uint8 RGB frames.
+
+        Returns:
+        - np.ndarray: float32 array of shape (1, 3, frames, height, width) with values in [0, 1].
+        """
+        clip = np.stack(frames).astype(np.float32) / 255.
+        return np.ascontiguousarray(clip.transpose(3, 0, 1, 2))[np.newaxis]
+
+    def predict_logits(self, videos):
+        """
+        Parameters:
+        - videos: float32 array of shape (batch, 3, frames, height, width).
+
+        Returns:
+        - np.ndarray: Logits of shape (batch, 2).
+        """
+        return self.session.run(None, {self.input_name: np.asarray(videos, dtype=np.float32)})[0]
+
+    def predict(self, videos):
+        """
+        Returns:
+        - tuple: The predicted class indices (see CLASSES) and the probability of slip, one per clip.
+        """
+        logits = self.predict_logits(videos)
+        exp_logits = np.exp(logits - logits.max(axis=1, keepdims=True))
+        probabilities = exp_logits / exp_logits.sum(axis=1, keepdims=True)
+        return probabilities.argmax(axis=1), probabilities[:, CLASSES.index('slip')]
+
+    def latency_ms(self, batch_size=1, warmup=3, runs=20):
+        """
+        Mean latency of one call on random input, in milliseconds.
+        """
+        videos = np.random.rand(batch_size, *self.input_shape[1:]).astype(np.float32)
+        for _ in range(warmup):
+            self.predict_logits(videos)
+        start_time = time.perf_counter()
+        for _ in range(runs):
+            self.predict_logits(videos)
+        return 1000 * (time.perf_counter() - start_time) / runs
+
+    @classmethod
+    def tune_threads(cls, onnx_path, thread_counts=None, batch_size=1):
+        """
+        Measures the latency for several thread counts and returns an engine with the fastest one.
+        On the robot PC, pass thread counts that leave cores free for the real-time loop.
+
+        Parameters:
+        - onnx_path: Model written by onnx_export.export_onnx.
+        - thread_counts: Candidates. Defaults to 1, 2, 4, ... up to the available cores.
+        - batch_size: Batch size to time, 1 for one clip at a time.
+        """
+        cores = _available_cores()
+        thread_counts = thread_counts or sorted({2 ** i for i in range(cores.bit_length()) if 2 ** i <= cores} | {cores})
+
+        best_engine, best_latency = None, None
+        for num_threads in thread_counts:
+            engine = cls(onnx_path, num_threads=num_threads)
+            latency = engine.latency_ms(batch_size)
+            print(f"  {num_threads} threads: {latency:.2f} ms")
+            if best_latency is None or latency < best_latency:
+                best_engine, best_latency = engine, latency
+        return best_engine
@@ -0,0 +1,138 @@
+"""
+__author__          ==  Amit Parag
+__organization__    ==  Sintef Ocean
+__description__     ==  Exports a trained checkpoint to ONNX with a dynamic batch dimension and checks that
+                        ONNX Runtime (onnx_engine.SlipDetectionEngine) reproduces the PyTorch outputs.
+
+                        python onnx_export.py ./trained_models/2_Frames/vvt_checkpoint_epoch75.pt --model vvt --frames 2 --dataset ./datasets/2_Frames
+
+                        Models trained with other vvt_params (e.g. a smaller first stage for cascade.py) take them
+                        as JSON, inline or in a file:
+
+                        python onnx_export.py ./trained_models/2_Frames/vvt_checkpoint_epoch75.pt --frames 2 --vvt-params small_vvt.json
+"""
+
+import os
+import json
+import argparse
+
+import numpy as np
+import torch
+from torchvision.transforms import Compose, ToTensor
+
+from dataset_manager import VideoDataset
+from onnx_engine import SlipDetectionEngine
+from train import load_trained_model
+from utils import colored_print
+
+
+def export_onnx(model, onnx_path, frames, image_size=(240, 320), opset_version=17):
+    """
+    Writes a model to ONNX. The input is 'video' of shape (batch, 3, frames, height, width), the output
+    'logits' of shape (batch, 2), and the batch dimension is dynamic.
+
+    Parameters:
+    - model: The trained model, see train.load_trained_model.
+    - onnx_path: Output path.
+    - frames: Number of frames per clip.
+    - image_size: (height, width) of the frames.
+    - opset_version: ONNX opset.
+    """
+    model.eval()
+    example_input = torch.randn(2, 3, frames, *image_size)
+    os.makedirs(os.path.dirname(onnx_path) or '.', exist_ok=True)
+    # The TorchScript-based exporter: torch.export cannot trace the einops rearranges of the ViViT
+    torch.onnx.export(
+        model, (example_input,), onnx_path,
+        input_names=['video'], output_names=['logits'],
+        dynamic_axes={'video': {0: 'batch'}, 'logits': {0: 'batch'}},
+        opset_version=opset_version, dynamo=False
+    )
+    colored_print(f"ONNX model written to {onnx_path}", color_code=36)
+    return onnx_path
+
+
+def validate_onnx(onnx_path, model, videos, rtol=1e-3, atol=1e-4):
+    """
+    Compares the ONNX Runtime logits with the PyTorch logits.
+
+    Parameters:
+    - onnx_path: The exported model.
+    - model: The PyTorch model it was exported from.
+    - videos: Batch of clips, shape (batch, 3, frames, height, width).
+    - rtol, atol: Tolerances of the comparison.
+
+    Returns:
+    - float: The largest absolute difference between the logits.
+
+    Raises:
+    - RuntimeError: If the logits differ by more than the tolerances or a prediction differs.
+    """
+    with torch.no_grad():
+        expected = model(videos).numpy()
+    actual = SlipDetectionEngine(onnx_path).predict_logits(videos.numpy())
+
+    max_difference = float(np.abs(expected - actual).max())
+    if not np.allclose(actual, expected, rtol=rtol, atol=atol) or not (actual.argmax(axis=1) == expected.argmax(axis=1)).all():
+        raise RuntimeError(f"ONNX Runtime output differs from PyTorch (max abs difference {max_difference:.2e}) for a batch of {len(videos)}")
+    return max_difference
+
+
+def export_checkpoint(checkpoint_path, model_name, frames, onnx_path=None, vvt_params=None, dataset_dir=None, opset_version=17):
+    """
+    Exports a checkpoint written by VideoTraining.save_checkpoint and validates the export on random batches
+    of several sizes and, if dataset_dir is given, on the clips of its validation split.
+
+    Returns:
+    - str: Path of the ONNX model, next to the checkpoint by default.
+    """
+    onnx_path = onnx_path or os.path.splitext(checkpoint_path)[0] + '.onnx'
+    model = load_trained_model(checkpoint_path, model_name, frames, vvt_params)
+    image_size = vvt_params['image_size'] if vvt_params else (240, 320)
+    export_onnx(model, onnx_path, frames, image_size=image_size, opset_version=opset_version)
+
+    # Batch sizes other than the traced one check the dynamic batch dimension
+    for batch_size in (1, 3):
+        max_difference = validate_onnx(onnx_path, model, torch.rand(batch_size, 3, frames, *image_size))
+        colored_print(f"Batch of {batch_size}: max abs difference {max_difference:.2e}", color_code=32)
+
+    if dataset_dir is not None:
+        dataset = VideoDataset(os.path.join(dataset_dir, 'validation'), transform=Compose([ToTensor()]))
+        videos = torch.stack([dataset[idx][0] for idx in range(min(len(dataset), 16))])
+        if tuple(videos.shape[-2:]) != tuple(image_size):
+            # A model trained on smaller frames gets the clips averaged down, like cascade.FrameSubsetClassifier does
+            videos = torch.nn.functional.interpolate(videos, size=(frames, *image_size), mode='area')
+        max_difference = validate_onnx(onnx_path, model, videos)
+        colored_print(f"{len(videos)} validation clips: max abs difference {max_difference:.2e}", color_code=32)
+
+    return onnx_path
+
+
+def parse_vvt_params(value):
+    """
+    Reads vvt_params (see train.build_video_vision_transformer) from a JSON string or the path of a JSON file.
+    JSON has no tuples, so lists such as image_size become tuples again.
+    """
+    if os.path.isfile(value):
+        with open(value) as params_file:
+            vvt_params = json.load(params_file)
+    else:
+        vvt_params = json.loads(value)
+    return {key: tuple(item) if isinstance(item, list) else item for key, item in vvt_params.items()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a trained checkpoint to ONNX and validate it with ONNX Runtime.')
+    parser.add_argument('checkpoint', help='Checkpoint written by VideoTraining.save_checkpoint')
+    parser.add_argument('--model', choices=['vvt', 'vvt_framewise', 'resnet'], default='vvt',
+                        help='vvt_framewise for a model trained with frame_wise=True (spatial_cache.FrameWiseViViT)')
+    parser.add_argument('--frames', type=int, required=True, help='Number of frames per clip')
+    parser.add_argument('--output', default=None, help='ONNX path, next to the checkpoint by default')
+    parser.add_argument('--dataset', default=None, help='Dataset directory whose validation clips are used for the check, e.g. ./datasets/5_Frames')
+    parser.add_argument('--vvt-params', type=parse_vvt_params, default=None,
+                        help='All the vvt_params the ViViT was trained with, as JSON or a JSON file, e.g. with image_size [120, 160]')
+    parser.add_argument('--opset', type=int, default=17)
+    args = parser.parse_args()
+
+    export_checkpoint(args.checkpoint, args.model, args.frames, onnx_path=args.output, vvt_params=args.vvt_params, dataset_dir=args.dataset,
+                      opset_version=args.opset)
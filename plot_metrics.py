@@ -7,6 +7,8 @@ import numpy as np
 import pandas as pd
 from sklearn.metrics import confusion_matrix
 
+from metrics_store import MetricsReader
+
 
 
 plt.rc('font', family='Times New Roman')
@@ -47,16 +49,49 @@ def save_figure(metric, models='both'):
     plt.savefig(f'./assets/{metric}_{"_".join(models.split())}.png')
 
 
+_readers = {}
+
+def load_losses(losses_path):
+    """
+    Load the losses dictionary, either from the metrics store directory written by train.py
+    or from a legacy losses.json file.
+
+    The store is read incrementally: calling this again only reads the rows appended since the
+    last call, so it can be polled while runs are still training.
+
+    Args:
+    - losses_path (str): Path to the metrics store directory or to a losses.json file.
+    """
+    if os.path.isdir(losses_path):
+        if losses_path not in _readers:
+            _readers[losses_path] = MetricsReader(losses_path)
+        return _readers[losses_path].losses_dict()
+
+    with open(losses_path, 'r') as f:
+        return json.load(f)
+
+
+def epochs_of(subset_dict):
+    """
+    Epochs at which a subset was evaluated. Older runs evaluated every epoch and carry no 'Epoch' list.
+
+    Args:
+    - subset_dict (dict): Metrics of one subset, e.g. losses_dict['5_Frames_VVT']['Test'].
+    """
+    if 'Epoch' in subset_dict:
+        return subset_dict['Epoch']
+    return list(range(len(subset_dict['Loss'])))
+
+
 def print_training_times(losses_path):
     """
     Print the training times for each model.
 
     Args:
-    - losses_path (str): Path to the losses.json file.
+    - losses_path (str): Path to the metrics store directory or to a losses.json file.
     """
-    # Load losses dictionary from file
-    with open(losses_path, 'r') as f:
-        losses_dict = json.load(f)
+    # Load losses dictionary from the metrics store or file
+    losses_dict = load_losses(losses_path)
 
     # Extract and print training times
     print("Training Times:")
@@ -74,12 +109,11 @@ def plot_metrics(losses_path, models='both'):
     Plot metrics from the losses dictionary stored in the losses.json file.
 
     Args:
-    - losses_path (str): Path to the losses.json file.
+    - losses_path (str): Path to the metrics store directory or to a losses.json file.
     - models (str): Specify which models to include. Options: 'both', 'VVT', 'Resnet'. Default is 'both'.
     """
-    # Load losses dictionary from file
-    with open(losses_path, 'r') as f:
-        losses_dict = json.load(f)
+    # Load losses dictionary from the metrics store or file
+    losses_dict = load_losses(losses_path)
 
     # Define the metrics to plot
     metrics_to_plot = ['Loss', 'Accuracy']
@@ -127,9 +161,12 @@ def plot_metrics(losses_path, models='both'):
                         palette = custom_palette_resnet
                     else:
                         palette = custom_palette
+                    # A run that is still training may not have evaluated this subset yet
+                    if not sub_dict.get(subset) or metric not in sub_dict[subset]:
+                        continue
                     legend_label = legend_names.get(main_key, main_key)  # Get legend name from dictionary
                     color_index = j % len(palette)  # Ensure index doesn't go out of range
-                    plt.plot(sub_dict[subset][metric], label=legend_label, color=palette[color_index], alpha=0.8,
+                    plt.plot(epochs_of(sub_dict[subset]), sub_dict[subset][metric], label=legend_label, color=palette[color_index], alpha=0.8,
                              linewidth=2)
 
 
@@ -149,12 +186,11 @@ def plot_precision_scores(losses_path, models='both'):
     Plot metrics from the losses dictionary stored in the losses.json file.
 
     Args:
-    - losses_path (str): Path to the losses.json file.
+    - losses_path (str): Path to the metrics store directory or to a losses.json file.
     - models (str): Specify which models to include. Options: 'both', 'VVT', 'Resnet'. Default is 'both'.
     """
-    # Load losses dictionary from file
-    with open(losses_path, 'r') as f:
-        losses_dict = json.load(f)
+    # Load losses dictionary from the metrics store or file
+    losses_dict = load_losses(losses_path)
 
     # Define the metrics to plot
     metrics_to_plot = ['Precision', 'Recall', 'F1-Score']
@@ -200,8 +236,11 @@ def plot_precision_scores(losses_path, models='both'):
                         palette = custom_palette_resnet
                     else:
                         palette = custom_palette
+                    # A run that is still training may not have evaluated this subset yet
+                    if not sub_dict.get(subset) or metric not in sub_dict[subset]:
+                        continue
                     legend_label = legend_names.get(main_key, main_key)  # Get legend name from dictionary
-                    plt.plot(sub_dict[subset][metric], label=legend_label, color=palette[index], alpha=0.8,
+                    plt.plot(epochs_of(sub_dict[subset]), sub_dict[subset][metric], label=legend_label, color=palette[index], alpha=0.8,
                              linewidth=2)
                     index = (index + 1) % len(palette)
 
@@ -224,7 +263,7 @@ def plot_precision_scores(losses_path, models='both'):
 
 
 
-losses_path = './trained_models/losses.json'
+losses_path = './trained_models/metrics'
 print_training_times(losses_path)
 plot_metrics(losses_path, models='VVT')  # Specify which models to plot: 'both', 'VVT', or 'Resnet'
 plot_precision_scores(losses_path, models='VVT')  # Specify which models to plot: 'both', 'VVT', or 'Resnet'
@@ -0,0 +1,126 @@
+import os
+import time
+import resource
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+from utils import colored_print
+
+
+class TrainingProfiler:
+    PHASES = ['Data Wait', 'Forward', 'Backward', 'Optimizer', 'Evaluation', 'Checkpoint']
+
+    def __init__(self, enabled=False, trace_steps=None, trace_dir='./trained_models/traces'):
+        """
+        Records, per epoch, where the training time goes: waiting on the DataLoader (ffmpeg decoding and
+        transforms), forward, backward, optimizer step, evaluation and checkpointing, as well as the
+        throughput in samples/s and the peak resident memory of the process.
+
+        Parameters:
+        - enabled: If False, every method is a no-op.
+        - trace_steps: Optional (first, last) global training steps to record with torch.profiler.
+                       The trace is written in Chrome trace format (open it in chrome://tracing or Perfetto).
+        - trace_dir: Directory for the torch.profiler traces.
+        """
+        self.enabled = enabled
+        self.trace_steps = trace_steps
+        self.trace_dir = trace_dir
+
+        self.global_step = 0
+        self.trace = None
+        self.history = []
+        self._reset_epoch()
+
+    def _reset_epoch(self):
+        self.times = dict.fromkeys(self.PHASES, 0.0)
+        self.samples = 0
+        self.epoch_start = time.perf_counter()
+        self.data_wait_start = None
+
+    @contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += time.perf_counter() - start
+
+    def phase(self, name):
+        """
+        Context manager that adds the time spent inside it to a phase.
+
+        Parameters:
+        - name: One of TrainingProfiler.PHASES.
+        """
+        return self._timed(name) if self.enabled else nullcontext()
+
+    def start_epoch(self):
+        if self.enabled:
+            self._reset_epoch()
+            self.data_wait_start = time.perf_counter()
+
+    def step_started(self, batch_size):
+        """
+        Call at the top of the training loop body, right after the loader produced a batch.
+        """
+        if not self.enabled:
+            return
+        self.times['Data Wait'] += time.perf_counter() - self.data_wait_start
+        self.samples += batch_size
+
+        if self.trace_steps is not None and self.global_step == self.trace_steps[0]:
+            self.trace = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], record_shapes=True, profile_memory=True)
+            self.trace.__enter__()
+
+    def step_finished(self):
+        """
+        Call at the bottom of the training loop body.
+        """
+        if not self.enabled:
+            return
+        if self.trace is not None and self.global_step == self.trace_steps[1]:
+            self._export_trace()
+        self.global_step += 1
+        self.data_wait_start = time.perf_counter()
+
+    def _export_trace(self):
+        self.trace.__exit__(None, None, None)
+        os.makedirs(self.trace_dir, exist_ok=True)
+        trace_path = os.path.join(self.trace_dir, f'trace_steps{self.trace_steps[0]}-{self.trace_steps[1]}_{os.getpid()}.json')
+        self.trace.export_chrome_trace(trace_path)
+        self.trace = None
+        colored_print(f"Profiler trace written to {trace_path}", color_code=36)
+
+    def end_epoch(self):
+        """
+        Closes the epoch and returns its summary.
+
+        Returns:
+        - dict: Seconds per phase, total epoch time, samples/s and peak RSS in MB. None when disabled.
+        """
+        if not self.enabled:
+            return None
+
+        epoch_time = time.perf_counter() - self.epoch_start
+        train_time = epoch_time - self.times['Evaluation'] - self.times['Checkpoint']
+        summary = {
+            **self.times,
+            'Epoch Time': epoch_time,
+            'Samples/s': self.samples / train_time if train_time > 0 else 0.0,
+            # ru_maxrss is in kilobytes on Linux
+            'Peak RSS (MB)': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        }
+        self.history.append(summary)
+        return summary
+
+    def close(self):
+        # Export a trace window that ran past the end of training
+        if self.trace is not None:
+            self._export_trace()
+
+    @staticmethod
+    def print_summary(summary):
+        print("{:<20} ".format("Profile") + " ".join("{:<12}".format(name) for name in TrainingProfiler.PHASES + ['Samples/s', 'Peak RSS']))
+        print("{:<20} ".format("Seconds") + " ".join("{:<12.2f}".format(summary[name]) for name in TrainingProfiler.PHASES)
+              + " {:<12.1f} {:<12.0f}".format(summary['Samples/s'], summary['Peak RSS (MB)']))
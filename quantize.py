@@ -0,0 +1,209 @@
+"""
+__author__          ==  Amit Parag
+__organization__    ==  Sintef Ocean
+__description__     ==  Post-training int8 quantization of trained vvt and resnet checkpoints for CPU inference.
+
+                        On the robot PC the slip detector shares the CPU with the libfranka real-time loop,
+                        so a smaller and faster model leaves more headroom. Two workflows:
+                        - dynamic: the weights of the Linear layers are stored in int8, activations are
+                          quantized on the fly. No calibration needed. This is where the ViViT spends its
+                          time; the ResNet only has one Linear layer in its head.
+                        - static: weights and activations are int8, with activation ranges calibrated on a
+                          sample of the validation split. The ResNet is quantized as a whole graph (FX mode,
+                          conv + batchnorm + relu fused). The ViViT forward pass cannot be traced symbolically,
+                          so each of its Linear layers is quantized on its own, between a quantize and a
+                          dequantize step.
+
+                        compare_quantization evaluates the float and the quantized models on the test split and
+                        reports accuracy, F1, single-clip latency and model size, with the deltas against float.
+"""
+
+import io
+import os
+import copy
+import time
+import itertools
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, get_default_qconfig_mapping, prepare, convert, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from torch.utils.data import DataLoader
+from torchvision.transforms import Compose, ToTensor
+
+from dataset_manager import VideoDataset
+from metrics import MetricsAccumulator
+from train import load_trained_model, frames_of
+from utils import colored_print
+
+
+# Quantized kernels for x86 CPUs (fbgemm / oneDNN)
+BACKEND = 'x86'
+
+
+class _QuantizedLayer(nn.Module):
+    # Runs one layer in int8: quantizes its input and dequantizes its output
+    def __init__(self, layer):
+        super().__init__()
+        self.quant = QuantStub()
+        self.layer = layer
+        self.dequant = DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.layer(self.quant(x)))
+
+
+def _wrap_layers(module, layer_types, qconfig):
+    for name, child in module.named_children():
+        if isinstance(child, layer_types):
+            wrapped = _QuantizedLayer(child)
+            wrapped.qconfig = qconfig
+            setattr(module, name, wrapped)
+        else:
+            _wrap_layers(child, layer_types, qconfig)
+
+
+def quantize_dynamic_model(model):
+    """
+    Returns an int8 copy of the model with dynamically quantized Linear layers.
+    """
+    torch.backends.quantized.engine = BACKEND
+    return quantize_dynamic(copy.deepcopy(model).eval(), {nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_static_model(model, model_name, calibration_loader, num_batches=8):
+    """
+    Returns a statically quantized int8 copy of the model.
+
+    Parameters:
+    - model: The float model.
+    - model_name: 'vvt' or 'resnet'.
+    - calibration_loader: Loader over the calibration clips, e.g. the validation split.
+    - num_batches: Number of batches used to calibrate the activation ranges.
+    """
+    torch.backends.quantized.engine = BACKEND
+    model = copy.deepcopy(model).eval()
+
+    if model_name == 'resnet':
+        example_inputs = (calibration_loader.dataset[0][0].unsqueeze(0),)
+        prepared_model = prepare_fx(model, get_default_qconfig_mapping(BACKEND), example_inputs)
+    else:
+        _wrap_layers(model, nn.Linear, get_default_qconfig(BACKEND))
+        prepared_model = prepare(model)
+
+    with torch.no_grad():
+        for videos, _ in itertools.islice(calibration_loader, num_batches):
+            prepared_model(videos)
+
+    return convert_fx(prepared_model) if model_name == 'resnet' else convert(prepared_model)
+
+
+def model_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2 ** 20
+
+
+def measure_latency(model, example_input, warmup=3, runs=20):
+    """
+    Returns the mean latency of one forward pass in milliseconds.
+    """
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(example_input)
+        start_time = time.perf_counter()
+        for _ in range(runs):
+            model(example_input)
+    return 1000 * (time.perf_counter() - start_time) / runs
+
+
+def evaluate_model(model, loader, example_input):
+    """
+    Returns the metrics of the model on a loader (see MetricsAccumulator), its single-clip latency and its size.
+    """
+    criterion = nn.CrossEntropyLoss()
+    metrics = MetricsAccumulator()
+    with torch.no_grad():
+        for videos, labels in loader:
+            outputs = model(videos)
+            metrics.update(criterion(outputs, labels), outputs, labels)
+
+    results = metrics.compute()
+    results['Latency (ms)'] = measure_latency(model, example_input)
+    results['Size (MB)'] = model_size_mb(model)
+    return results
+
+
+def compare_quantization(checkpoint_path, model_name, project_dir, vvt_params=None, calibration_batches=8, batch_size=8,
+                         num_workers=4, cache_dir=None, save_dir=None):
+    """
+    Quantizes a checkpoint dynamically and statically and compares both with the float model on the test split.
+
+    Parameters:
+    - checkpoint_path: Checkpoint written by VideoTraining.save_checkpoint.
+    - model_name: 'vvt' or 'resnet'.
+    - project_dir: Dataset directory, e.g. './datasets/5_Frames'. The number of frames is taken from its name.
+    - vvt_params: ViT parameters the checkpoint was trained with.
+    - calibration_batches: Number of validation batches used for the static calibration.
+    - batch_size: Batch size of the calibration and evaluation loaders.
+    - num_workers: DataLoader workers.
+    - cache_dir: Decoded video cache, see VideoDataset.
+    - save_dir: If set, the quantized models are saved there as TorchScript (<model_name>_int8_dynamic.pt, <model_name>_int8_static.pt).
+
+    Returns:
+    - dict: {'Float': metrics, 'Dynamic int8': metrics, 'Static int8': metrics}, each quantized entry with the
+            deltas against float under 'Accuracy Delta', 'F1 Delta' and 'Latency Delta (ms)'.
+    """
+    frames = frames_of(os.path.basename(os.path.normpath(project_dir)))
+    float_model = load_trained_model(checkpoint_path, model_name, frames, vvt_params)
+
+    data_transform = Compose([ToTensor()])
+    validation_dataset = VideoDataset(os.path.join(project_dir, 'validation'), transform=data_transform, cache_dir=cache_dir)
+    test_dataset = VideoDataset(os.path.join(project_dir, 'test'), transform=data_transform, cache_dir=cache_dir)
+    calibration_loader = DataLoader(validation_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+    test_loader = DataLoader(test_dataset, batch_size=batch_size, num_workers=num_workers)
+    # The robot classifies one clip at a time
+    example_input = test_dataset[0][0].unsqueeze(0)
+
+    colored_print(f"Quantizing {checkpoint_path}", color_code=36)
+    models = {
+        'Float': float_model,
+        'Dynamic int8': quantize_dynamic_model(float_model),
+        'Static int8': quantize_static_model(float_model, model_name, calibration_loader, calibration_batches)
+    }
+
+    results = {}
+    for name, model in models.items():
+        results[name] = evaluate_model(model, test_loader, example_input)
+        if name != 'Float':
+            results[name]['Accuracy Delta'] = results[name]['Accuracy'] - results['Float']['Accuracy']
+            results[name]['F1 Delta'] = results[name]['F1-Score'] - results['Float']['F1-Score']
+            results[name]['Latency Delta (ms)'] = results[name]['Latency (ms)'] - results['Float']['Latency (ms)']
+
+    print("{:<20} {:<12} {:<12} {:<15} {:<12}".format("", "Accuracy", "F1-Score", "Latency (ms)", "Size (MB)"))
+    for name, metrics in results.items():
+        print("{:<20} {:<12.3f} {:<12.3f} {:<15.2f} {:<12.2f}".format(name, metrics['Accuracy'], metrics['F1-Score'], metrics['Latency (ms)'], metrics['Size (MB)']))
+    for name in ['Dynamic int8', 'Static int8']:
+        print("{:<20} {:<+12.3f} {:<+12.3f} {:<+15.2f}".format(f"{name} delta", results[name]['Accuracy Delta'], results[name]['F1 Delta'], results[name]['Latency Delta (ms)']))
+
+    if save_dir is not None:
+        os.makedirs(save_dir, exist_ok=True)
+        for name, mode in [('Dynamic int8', 'dynamic'), ('Static int8', 'static')]:
+            with torch.no_grad():
+                script_model = torch.jit.trace(models[name], example_input)
+            script_path = os.path.join(save_dir, f'{model_name}_int8_{mode}.pt')
+            torch.jit.save(script_model, script_path)
+            colored_print(f"{name} model saved to {script_path}", color_code=36)
+
+    return results
+
+
+if __name__ == '__main__':
+    # The dataset and the last checkpoint of the ViViT trained by train.py
+    project_name = '2_Frames'
+    compare_quantization(
+        checkpoint_path=f'./trained_models/{project_name}/vvt_checkpoint_epoch75.pt',
+        model_name='vvt',
+        project_dir=f'./datasets/{project_name}',
+        save_dir=f'./trained_models/{project_name}'
+    )
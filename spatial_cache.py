@@ -0,0 +1,323 @@
+"""
+__author__          ==  Amit Parag
+__organization__    ==  Sintef Ocean
+__description__     ==  Temporal-only fine-tuning of a trained ViViT from cached spatial tokens.
+
+                        The factorised ViViT (vit_pytorch.vivit.ViT) runs the patch embedding and the spatial
+                        transformer on every frame patch, keeps one token per frame patch (the spatial CLS
+                        token, or the mean with pool='mean'), and then runs the temporal transformer and the
+                        head over those tokens. With the spatial part frozen, its output for a clip never
+                        changes, so it is computed once per clip and cached in memory or on disk. Training
+                        then only runs the temporal transformer and the head.
+
+                        The cached tokens depend on the position of each frame patch in the clip (the
+                        positional embedding is added before the spatial transformer), so they are cached per
+                        clip, not per frame.
+
+                        FrameWiseViViT removes that dependency: every frame is its own frame patch, all frames
+                        share one spatial positional embedding, and the frame order enters through a positional
+                        embedding before the temporal transformer. A frame's spatial token is then the same
+                        wherever the frame sits in the clip, so on a live stream with a sliding window
+                        (IncrementalViViT) each frame goes through the spatial encoder only once.
+"""
+
+import os
+import hashlib
+
+import torch
+import torch.nn as nn
+from einops import rearrange, repeat, reduce
+from vit_pytorch.vivit import ViT
+from torch.utils.data import DataLoader, Dataset
+from torchvision.transforms import Compose, ToTensor
+
+from dataset_manager import VideoDataset
+from utils import colored_print
+
+
+def spatial_modules(vvt_model):
+    """
+    Returns the parameters and modules of the spatial encoder, in a fixed order.
+    """
+    return [vvt_model.to_patch_embedding, vvt_model.pos_embedding, vvt_model.spatial_cls_token, vvt_model.spatial_transformer]
+
+
+def freeze_spatial_encoder(vvt_model):
+    for part in spatial_modules(vvt_model):
+        if part is None:
+            continue
+        parameters = [part] if isinstance(part, nn.Parameter) else part.parameters()
+        for parameter in parameters:
+            parameter.requires_grad = False
+
+
+def encode_spatial(vvt_model, video):
+    """
+    Runs the patch embedding and the spatial transformer of a ViViT.
+
+    Parameters:
+    - vvt_model: A vit_pytorch.vivit.ViT.
+    - video: Tensor of shape (batch, channels, frames, height, width).
+
+    Returns:
+    - torch.Tensor: One token per frame patch, shape (batch, frame patches, dim).
+    """
+    x = vvt_model.to_patch_embedding(video)
+    b, f, n, _ = x.shape
+
+    x = x + vvt_model.pos_embedding[:, :f, :n]
+
+    if vvt_model.spatial_cls_token is not None:
+        spatial_cls_tokens = repeat(vvt_model.spatial_cls_token, '1 1 d -> b f 1 d', b=b, f=f)
+        x = torch.cat((spatial_cls_tokens, x), dim=2)
+
+    x = vvt_model.dropout(x)
+    x = rearrange(x, 'b f n d -> (b f) n d')
+    x = vvt_model.spatial_transformer(x)
+    x = rearrange(x, '(b f) n d -> b f n d', b=b)
+
+    return x[:, :, 0] if not vvt_model.global_average_pool else reduce(x, 'b f n d -> b f d', 'mean')
+
+
+def _temporal_forward(modules, x):
+    # Temporal transformer and head of a ViViT (or TemporalHead) over spatial tokens of shape (b, f, d)
+    b, f, _ = x.shape
+
+    if getattr(modules, 'temporal_pos_embedding', None) is not None:
+        x = x + modules.temporal_pos_embedding[:, :f]
+
+    if modules.temporal_cls_token is not None:
+        temporal_cls_tokens = repeat(modules.temporal_cls_token, '1 1 d-> b 1 d', b=b)
+        x = torch.cat((temporal_cls_tokens, x), dim=1)
+
+    x = modules.temporal_transformer(x)
+    x = x[:, 0] if not modules.global_average_pool else reduce(x, 'b f d -> b d', 'mean')
+    x = modules.to_latent(x)
+    return modules.mlp_head(x)
+
+
+class TemporalHead(nn.Module):
+    def __init__(self, vvt_model):
+        """
+        The temporal transformer and classification head of a ViViT, taking spatial tokens as input.
+        Its modules are shared with vvt_model, so training it updates vvt_model in place.
+
+        Parameters:
+        - vvt_model: A vit_pytorch.vivit.ViT.
+        """
+        super().__init__()
+        self.temporal_cls_token = vvt_model.temporal_cls_token
+        self.temporal_transformer = vvt_model.temporal_transformer
+        self.to_latent = vvt_model.to_latent
+        self.mlp_head = vvt_model.mlp_head
+        self.global_average_pool = vvt_model.global_average_pool
+        # Only a FrameWiseViViT has one
+        self.temporal_pos_embedding = getattr(vvt_model, 'temporal_pos_embedding', None)
+
+    def forward(self, x):
+        return _temporal_forward(self, x)
+
+
+class FrameWiseViViT(ViT):
+    def __init__(self, **vvt_params):
+        """
+        ViViT whose spatial encoder treats every frame on its own and the same way at every position in the clip:
+        frame_patch_size is 1 and all frames share one spatial positional embedding. The frame order is given
+        to the temporal transformer by a temporal positional embedding instead.
+
+        Parameters:
+        - vvt_params: The parameters of vit_pytorch.vivit.ViT. frame_patch_size is ignored.
+        """
+        super().__init__(**{**vvt_params, 'frame_patch_size': 1})
+        _, _, num_image_patches, dim = self.pos_embedding.shape
+        self.pos_embedding = nn.Parameter(torch.randn(1, 1, num_image_patches, dim))
+        self.temporal_pos_embedding = nn.Parameter(torch.randn(1, vvt_params['frames'], dim))
+
+    def forward_tokens(self, x):
+        """
+        Classifies a clip from its spatial tokens, shape (batch, frames, dim), see encode_spatial.
+        """
+        return _temporal_forward(self, x)
+
+    def forward(self, video):
+        return self.forward_tokens(encode_spatial(self, video))
+
+
+class IncrementalViViT:
+    # Class index of slip (sorted class folders: slip, wriggle)
+    SLIP_CLASS = 0
+
+    def __init__(self, model, device='cpu'):
+        """
+        Sliding-window inference for a trained FrameWiseViViT. The spatial token of every frame is computed once
+        and cached by (stream, frame index); a decision only runs the temporal transformer and the head over the
+        cached tokens of the window. A new frame costs one spatial pass instead of one per frame of the window.
+
+        Parameters:
+        - model: A trained FrameWiseViViT.
+        - device: Device to run the model on.
+        """
+        self.model = model.to(device).eval()
+        self.device = device
+        self.num_frames = model.temporal_pos_embedding.shape[1]
+        self.tokens = {}
+
+    def encode(self, stream, frame_index, frame):
+        """
+        Computes and caches the spatial token of one frame.
+
+        Parameters:
+        - stream: Name of the stream (camera) the frame belongs to.
+        - frame_index: Index of the frame in its stream.
+        - frame: Array or tensor of shape (3, height, width) with values in [0, 1], preprocessed like the training clips.
+        """
+        video = torch.as_tensor(frame, device=self.device)[None, :, None]
+        with torch.no_grad():
+            self.tokens[(stream, frame_index)] = encode_spatial(self.model, video)[0, 0]
+        # Frames that left the window, also those left behind when frames were skipped
+        for key in [key for key in self.tokens if key[0] == stream and key[1] <= frame_index - self.num_frames]:
+            del self.tokens[key]
+
+    def missing(self, stream, frame_index):
+        """
+        Returns:
+        - list: Indices of the frames in the window ending at frame_index that were not encoded (e.g. skipped by a gate).
+        """
+        return [index for index in range(max(frame_index - self.num_frames + 1, 0), frame_index + 1) if (stream, index) not in self.tokens]
+
+    def predict(self, stream, frame_index):
+        """
+        Classifies the window of the last num_frames frames of a stream, ending at frame_index.
+
+        Returns:
+        - tuple: The predicted class and the probability of slip, as arrays of one element (like onnx_engine.SlipDetectionEngine.predict).
+        """
+        window = torch.stack([self.tokens[(stream, index)] for index in range(frame_index - self.num_frames + 1, frame_index + 1)])
+        with torch.no_grad():
+            probabilities = self.model.forward_tokens(window[None]).softmax(dim=1).cpu()
+        return probabilities.argmax(dim=1).numpy(), probabilities[:, self.SLIP_CLASS].numpy()
+
+
+class SpatialTokenCache:
+    def __init__(self, vvt_model, cache_dir=None, device='cpu'):
+        """
+        Spatial tokens per clip, in memory or on disk.
+
+        Parameters:
+        - vvt_model: The ViViT whose (frozen) spatial encoder produces the tokens.
+        - cache_dir: Directory for the tokens. None keeps them in memory only.
+        - device: Device to run the spatial encoder on.
+        """
+        self.vvt_model = vvt_model
+        self.cache_dir = cache_dir
+        self.device = device
+        self.tokens = {}
+        self.fingerprint = self._fingerprint()
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _fingerprint(self):
+        # Tokens computed with other spatial weights must not be reused
+        digest = hashlib.sha1()
+        for part in spatial_modules(self.vvt_model):
+            if part is None:
+                continue
+            tensors = [part] if isinstance(part, nn.Parameter) else part.state_dict().values()
+            for tensor in tensors:
+                digest.update(tensor.detach().cpu().numpy().tobytes())
+        return digest.hexdigest()[:16]
+
+    def _path(self, video_path):
+        stat = os.stat(video_path)
+        key = f"{os.path.realpath(video_path)}:{stat.st_size}:{stat.st_mtime_ns}:{self.fingerprint}"
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.pt')
+
+    def get(self, video_path):
+        if video_path in self.tokens:
+            return self.tokens[video_path]
+        if self.cache_dir is not None and os.path.exists(self._path(video_path)):
+            self.tokens[video_path] = torch.load(self._path(video_path))
+            return self.tokens[video_path]
+        return None
+
+    def put(self, video_path, tokens):
+        self.tokens[video_path] = tokens
+        if self.cache_dir is not None:
+            temporary_path = f"{self._path(video_path)}.{os.getpid()}.tmp"
+            torch.save(tokens, temporary_path)
+            os.replace(temporary_path, self._path(video_path))
+
+    def fill(self, video_dataset, batch_size=16, num_workers=4):
+        """
+        Computes the tokens of every clip of video_dataset that is not cached yet, in batches.
+        """
+        missing = [idx for idx, (video_path, _) in enumerate(video_dataset.videos) if self.get(video_path) is None]
+        if not missing:
+            return
+
+        colored_print(f"Encoding {len(missing)} clips of {video_dataset.data_dir}", color_code=36)
+        loader = DataLoader(_IndexedDataset(video_dataset, missing), batch_size=batch_size, num_workers=num_workers)
+        self.vvt_model.eval()
+        with torch.no_grad():
+            for videos, indices in loader:
+                tokens = encode_spatial(self.vvt_model, videos.to(self.device)).cpu()
+                for idx, clip_tokens in zip(indices.tolist(), tokens):
+                    self.put(video_dataset.videos[idx][0], clip_tokens.clone())
+
+
+class _IndexedDataset(Dataset):
+    def __init__(self, video_dataset, indices):
+        self.video_dataset = video_dataset
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        video, _ = self.video_dataset[self.indices[i]]
+        return video, self.indices[i]
+
+
+class SpatialTokenDataset(Dataset):
+    def __init__(self, video_dataset, cache):
+        """
+        Dataset of (spatial tokens, label) for the clips of a VideoDataset. Call cache.fill(video_dataset) first.
+        """
+        self.videos = video_dataset.videos
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.videos)
+
+    def __getitem__(self, idx):
+        video_path, label = self.videos[idx]
+        return self.cache.get(video_path), label
+
+
+def create_token_loaders(root_dir, vvt_model, batch_size, cache_dir=None, num_workers=8, video_cache_dir=None, device='cpu'):
+    """
+    Encodes the train, test and validation clips once and returns loaders over their spatial tokens.
+
+    Parameters:
+    - root_dir: Dataset directory, e.g. './datasets/5_Frames'.
+    - vvt_model: The ViViT providing the frozen spatial encoder.
+    - batch_size: Number of samples per batch.
+    - cache_dir: Directory for the spatial tokens. None keeps them in memory.
+    - num_workers: DataLoader workers used while encoding.
+    - video_cache_dir: Decoded video cache, see VideoDataset.
+    - device: Device to run the spatial encoder on.
+
+    Returns:
+    - tuple: Training, testing and validation loaders of (tokens, label).
+    """
+    cache = SpatialTokenCache(vvt_model, cache_dir=cache_dir, device=device)
+    data_transform = Compose([ToTensor()])
+
+    loaders = []
+    for subset in ['train', 'test', 'validation']:
+        video_dataset = VideoDataset(os.path.join(root_dir, subset), transform=data_transform, cache_dir=video_cache_dir)
+        cache.fill(video_dataset, batch_size=batch_size, num_workers=num_workers)
+        # The tokens are tiny and already in memory: no workers needed
+        loaders.append(DataLoader(SpatialTokenDataset(video_dataset, cache), batch_size=batch_size, shuffle=True))
+
+    return tuple(loaders)
@@ -0,0 +1,219 @@
+"""
+__author__          ==  Amit Parag
+__organization__    ==  Sintef Ocean
+__description__     ==  Parallel hyperparameter sweeps over datasets (2_Frames ... 5_Frames), models and optimizer settings.
+
+                        The cores of the machine are split into slots. Every trial runs in its own process,
+                        pinned to one slot with torch.set_num_threads and CPU affinity, so four trials on a
+                        64-core node each get 16 cores instead of fighting over all of them. The videos are
+                        decoded once into a shared cache that every trial memory-maps.
+
+                        Two modes:
+                        - run_sweep: train every configuration of the grid for the full number of epochs.
+                        - successive_halving: train every configuration for a few epochs, keep the best
+                          fraction by validation F1, train those for more epochs (resuming from their
+                          checkpoints) and repeat. Trials whose validation loss stops improving are
+                          stopped early and not promoted.
+"""
+
+import os
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from dataset_manager import VideoDataLoader
+from metrics_store import MetricsStore
+from train import train_video_vision_transformer, train_resnet
+from utils import colored_print, pin_to_cores, seed_everything
+
+
+def make_trials(grid):
+    """
+    Expands a grid into the list of its configurations.
+
+    Parameters:
+    - grid: Dictionary with lists for 'dataset', 'model', 'lr', 'batch_size' and 'weight_decay', e.g.
+            {'dataset': ['2_Frames', '5_Frames'], 'model': ['vvt'], 'lr': [4e-4, 1e-3], 'batch_size': [64], 'weight_decay': [1e-4]}
+
+    Returns:
+    - list: One dictionary per configuration.
+    """
+    keys = ['dataset', 'model', 'lr', 'batch_size', 'weight_decay']
+    return [dict(zip(keys, values)) for values in itertools.product(*(grid[key] for key in keys))]
+
+
+def trial_name(trial):
+    return f"{trial['dataset']}_{trial['model']}_lr{trial['lr']:g}_bs{trial['batch_size']}_wd{trial['weight_decay']:g}"
+
+
+def _init_worker(slots, num_slots):
+    # Every worker process takes one slot for its lifetime and pins itself to those cores
+    slot = slots.get()
+    cores = pin_to_cores(slot, num_slots)
+    os.environ['SWEEP_NUM_WORKERS'] = str(min(8, max(1, len(cores) // 2)))
+
+
+def _run_trial(trial, root_dir, num_epochs, cache_dir, metrics_dir, seed, resume_from, early_stopping_patience):
+    seed_everything(seed)
+    name = trial_name(trial)
+    # A promoted trial continues its run in the store, so its plots show every rung
+    metrics_store = MetricsStore(metrics_dir, name=name, config=trial, resume=resume_from is not None)
+
+    train_function = train_video_vision_transformer if trial['model'] == 'vvt' else train_resnet
+    losses = train_function(
+        project_name=trial['dataset'],
+        root_dir=root_dir,
+        num_epochs=num_epochs,
+        batch_size=trial['batch_size'],
+        lr=trial['lr'],
+        weight_decay=trial['weight_decay'],
+        device='cpu',
+        metrics_store=metrics_store,
+        num_workers=int(os.environ.get('SWEEP_NUM_WORKERS', 4)),
+        cache_dir=cache_dir,
+        run_name=name,
+        resume_from=resume_from,
+        early_stopping_patience=early_stopping_patience
+    )
+    metrics_store.close()
+
+    validation_f1 = losses['Validation']['F1-Score']
+    return {
+        'trial': trial,
+        'score': max(validation_f1) if validation_f1 else 0.0,
+        'stopped_early': losses['Stopped Early'],
+        'checkpoint': losses['Checkpoint'],
+        'losses': losses
+    }
+
+
+class SweepRunner:
+    def __init__(self, root_dir, num_slots=None, min_cores_per_trial=4, cache_dir='./datasets/.decoded_cache',
+                 metrics_dir='./trained_models/metrics', seed=10000000):
+        """
+        Runs trials in parallel, one process per slot of cores.
+
+        Parameters:
+        - root_dir: Directory containing the datasets (2_Frames, 3_Frames, ...).
+        - num_slots: Number of trials running at the same time. Defaults to as many as fit with min_cores_per_trial cores each.
+        - min_cores_per_trial: Lower bound on the cores given to one trial when num_slots is not set.
+        - cache_dir: Shared cache of decoded videos. None decodes with ffmpeg in every trial.
+        - metrics_dir: Metrics store directory, one file per trial.
+        - seed: Seed used for every trial.
+        """
+        self.root_dir = root_dir
+        self.num_slots = num_slots
+        self.min_cores_per_trial = min_cores_per_trial
+        self.cache_dir = cache_dir
+        self.metrics_dir = metrics_dir
+        self.seed = seed
+
+    def _slots_for(self, num_trials):
+        if self.num_slots is not None:
+            return self.num_slots
+        num_cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        return max(1, min(num_trials, num_cores // self.min_cores_per_trial))
+
+    def _precache(self, trials):
+        if self.cache_dir is None:
+            return
+        for dataset in sorted({trial['dataset'] for trial in trials}):
+            colored_print(f"Decoding {dataset} into {self.cache_dir}", color_code=36)
+            VideoDataLoader.precache(os.path.join(self.root_dir, dataset), self.cache_dir)
+
+    def run(self, trials, num_epochs, resume_from=None, early_stopping_patience=None):
+        """
+        Trains the trials in parallel.
+
+        Parameters:
+        - trials: List of configurations, see make_trials.
+        - num_epochs: Total number of epochs of every trial.
+        - resume_from: Optional list of checkpoints, one per trial (None entries start from scratch).
+        - early_stopping_patience: Passed on to VideoTraining.
+
+        Returns:
+        - list: One result dictionary per trial with 'trial', 'score' (best validation F1), 'stopped_early', 'checkpoint' and 'losses'.
+        """
+        self._precache(trials)
+        resume_from = resume_from or [None] * len(trials)
+
+        num_slots = self._slots_for(len(trials))
+        context = multiprocessing.get_context('spawn')
+        slots = context.Queue()
+        for slot in range(num_slots):
+            slots.put(slot)
+
+        colored_print(f"Running {len(trials)} trials, {num_slots} at a time", color_code=36)
+        with ProcessPoolExecutor(max_workers=num_slots, mp_context=context, initializer=_init_worker, initargs=(slots, num_slots)) as executor:
+            futures = [executor.submit(_run_trial, trial, self.root_dir, num_epochs, self.cache_dir, self.metrics_dir, self.seed, checkpoint, early_stopping_patience)
+                       for trial, checkpoint in zip(trials, resume_from)]
+            return [future.result() for future in futures]
+
+
+def run_sweep(grid, root_dir, num_epochs, **runner_kwargs):
+    """
+    Trains every configuration of the grid for num_epochs.
+
+    Returns:
+    - list: The results of SweepRunner.run, best validation F1 first.
+    """
+    results = SweepRunner(root_dir, **runner_kwargs).run(make_trials(grid), num_epochs)
+    return sorted(results, key=lambda result: result['score'], reverse=True)
+
+
+def successive_halving(grid, root_dir, min_epochs=5, max_epochs=75, reduction_factor=3, early_stopping_patience=3, **runner_kwargs):
+    """
+    Successive-halving search. Every rung trains the surviving trials up to a number of epochs, ranks them by
+    their best validation F1 and promotes the top 1/reduction_factor to the next rung, which trains
+    reduction_factor times longer. Promoted trials resume from their last checkpoint, early stopping state included,
+    and their metrics continue the run of the previous rung in the store. Trials stopped early by
+    VideoTraining (no validation improvement for early_stopping_patience evaluations) are not promoted.
+
+    Parameters:
+    - grid: See make_trials.
+    - root_dir: Directory containing the datasets.
+    - min_epochs: Epochs of the first rung.
+    - max_epochs: Epochs of the last rung.
+    - reduction_factor: Fraction of trials kept, and growth of the epoch budget, from one rung to the next.
+    - early_stopping_patience: Passed on to VideoTraining.
+
+    Returns:
+    - list: The results of the last rung, best validation F1 first.
+    """
+    runner = SweepRunner(root_dir, **runner_kwargs)
+    trials = make_trials(grid)
+    checkpoints = [None] * len(trials)
+    num_epochs = min_epochs
+
+    while True:
+        colored_print(f"Successive halving: {len(trials)} trials up to epoch {num_epochs}", color_code=36)
+        results = runner.run(trials, num_epochs, resume_from=checkpoints, early_stopping_patience=early_stopping_patience)
+        results = sorted(results, key=lambda result: result['score'], reverse=True)
+
+        if num_epochs >= max_epochs or len(results) == 1:
+            return results
+
+        # Kill the trials that stopped improving, unless that would kill all of them
+        survivors = [result for result in results if not result['stopped_early']] or results[:1]
+        promoted = survivors[:max(1, len(results) // reduction_factor)]
+        for result in results:
+            if result not in promoted:
+                colored_print(f"Stopping {trial_name(result['trial'])} (validation F1 {result['score']:.3f})", color_code=33)
+
+        trials = [result['trial'] for result in promoted]
+        checkpoints = [result['checkpoint'] for result in promoted]
+        num_epochs = min(num_epochs * reduction_factor, max_epochs)
+
+
+if __name__ == '__main__':
+    grid = {
+        'dataset': ['5_Frames', '4_Frames', '3_Frames', '2_Frames'],
+        'model': ['vvt'],
+        'lr': [4e-4],
+        'batch_size': [64],
+        'weight_decay': [1e-4]
+    }
+
+    results = run_sweep(grid, root_dir='./datasets', num_epochs=75)
+    for result in results:
+        print(f"{trial_name(result['trial']):<50} validation F1: {result['score']:.3f}")
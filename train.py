@@ -1,16 +1,20 @@
 import os
 import torch
 import torch.nn as nn
-import json
 
 from vit_pytorch.vivit import ViT
 import pytorchvideo.models.resnet
 from dataset_manager import VideoDataLoader
 from trainer import VideoTraining
+from metrics_store import MetricsStore
+from spatial_cache import create_token_loaders, freeze_spatial_encoder, TemporalHead, FrameWiseViViT
+from distillation import DistillationLoss, create_distillation_loaders
 from utils import seed_everything, check_cuda_availability, colored_print
+from distributed import launched_with_torchrun, setup_distributed, cleanup_distributed, is_main_process
 
-# Wrapper to train a Video Vision Transformer model
-def train_video_vision_transformer(project_name, root_dir, num_epochs=100, batch_size=16, lr=3e-4, weight_decay=0.0, device='cpu', vvt_params=None):
+# Builds the Video Vision Transformer for a number of frames.
+# frame_wise builds the variant whose per-frame features can be reused on a sliding window (see spatial_cache.py)
+def build_video_vision_transformer(frames, vvt_params=None, frame_wise=False):
     # Default ViT parameters
     if vvt_params is None:
         vvt_params = {
@@ -24,15 +28,44 @@ def train_video_vision_transformer(project_name, root_dir, num_epochs=100, batch
             'mlp_dim': 8
         }
 
-    dataset_name = project_name.split('_')[0]  
-    vvt_params['frames'] = int(dataset_name[0]) 
+    vvt_params = dict(vvt_params)
+    vvt_params['frames'] = frames
     vvt_params['frame_patch_size'] = vvt_params['frames']
 
-    vvt_model = ViT(**vvt_params)
+    return FrameWiseViViT(**vvt_params) if frame_wise else ViT(**vvt_params)
+
+# Builds the Video Resnet model
+def build_resnet():
+    return pytorchvideo.models.resnet.create_resnet(
+        input_channel=3, 
+        model_depth=50, 
+        model_num_class=2,
+        norm=nn.BatchNorm3d,
+        activation=nn.ReLU,
+    )
+
+# Number of frames of a dataset, e.g. 5 for '5_Frames'
+def frames_of(project_name):
+    dataset_name = project_name.split('_')[0]  
+    return int(dataset_name[0]) 
+
+# Model with the weights of a checkpoint written by VideoTraining.save_checkpoint, in eval mode
+def load_trained_model(checkpoint_path, model_name, frames, vvt_params=None, device='cpu'):
+    if model_name in ('vvt', 'vvt_framewise'):
+        model = build_video_vision_transformer(frames, vvt_params, frame_wise=model_name == 'vvt_framewise')
+    else:
+        model = build_resnet()
+    checkpoint = torch.load(checkpoint_path, map_location=device)
+    model.load_state_dict(checkpoint['model_state_dict'])
+    return model.to(device).eval()
+
+# Wrapper to train a Video Vision Transformer model
+def train_video_vision_transformer(project_name, root_dir, num_epochs=100, batch_size=16, lr=3e-4, weight_decay=0.0, device='cpu', vvt_params=None, distributed=False, metrics_store=None, num_workers=8, cache_dir=None, frame_wise=False, **trainer_kwargs):
+    vvt_model = build_video_vision_transformer(frames_of(project_name), vvt_params, frame_wise=frame_wise)
 
     print("\n\n")
 
-    train_loader, test_loader, val_loader = VideoDataLoader.create_loaders(os.path.join(root_dir, project_name), batch_size, num_workers=8)
+    train_loader, test_loader, val_loader = VideoDataLoader.create_loaders(os.path.join(root_dir, project_name), batch_size, num_workers=num_workers, distributed=distributed, cache_dir=cache_dir)
 
     criterion = torch.nn.CrossEntropyLoss()
 
@@ -40,7 +73,7 @@ def train_video_vision_transformer(project_name, root_dir, num_epochs=100, batch
 
     vvt_trainer = VideoTraining(
         model=vvt_model,
-        model_name='vvt',
+        model_name='vvt_framewise' if frame_wise else 'vvt',
         train_loader=train_loader,
         test_loader=test_loader,
         validation_loader=val_loader,
@@ -49,7 +82,10 @@ def train_video_vision_transformer(project_name, root_dir, num_epochs=100, batch
         optimizer=vvt_optimizer,
         device=device,
         project_name=project_name,
-        weight_decay=weight_decay
+        weight_decay=weight_decay,
+        distributed=distributed,
+        metrics_store=metrics_store,
+        **trainer_kwargs
     )
 
     # Train the model and get losses
@@ -58,19 +94,99 @@ def train_video_vision_transformer(project_name, root_dir, num_epochs=100, batch
 
     return vvt_losses
 
-# Wrapper to train a Video Resnet model
-def train_resnet(project_name, root_dir, num_epochs=100, batch_size=16, lr=3e-4, weight_decay=0.0, device='cpu'):
-    model =  pytorchvideo.models.resnet.create_resnet(
-        input_channel=3, 
-        model_depth=50, 
-        model_num_class=2,
-        norm=nn.BatchNorm3d,
-        activation=nn.ReLU,
+# Wrapper to fine-tune only the temporal transformer and head of a trained Video Vision Transformer,
+# from spatial tokens computed once per clip (see spatial_cache.py)
+def train_temporal_head(project_name, root_dir, checkpoint_path, num_epochs=25, batch_size=16, lr=3e-4, weight_decay=0.0, device='cpu', vvt_params=None, metrics_store=None, num_workers=8, cache_dir=None, token_cache_dir=None, **trainer_kwargs):
+    vvt_model = build_video_vision_transformer(frames_of(project_name), vvt_params)
+    vvt_model.load_state_dict(torch.load(checkpoint_path, map_location=device)['model_state_dict'])
+    vvt_model.to(device)
+    freeze_spatial_encoder(vvt_model)
+
+    print("\n\n")
+
+    train_loader, test_loader, val_loader = create_token_loaders(os.path.join(root_dir, project_name), vvt_model, batch_size, cache_dir=token_cache_dir, num_workers=num_workers, video_cache_dir=cache_dir, device=device)
+
+    temporal_head = TemporalHead(vvt_model)
+
+    criterion = torch.nn.CrossEntropyLoss()
+
+    temporal_optimizer = torch.optim.Adam(temporal_head.parameters(), lr=lr, weight_decay=weight_decay)
+
+    temporal_trainer = VideoTraining(
+        model=temporal_head,
+        model_name='vvt_temporal',
+        train_loader=train_loader,
+        test_loader=test_loader,
+        validation_loader=val_loader,
+        num_epochs=num_epochs,
+        criterion=criterion,
+        optimizer=temporal_optimizer,
+        device=device,
+        project_name=project_name,
+        weight_decay=weight_decay,
+        metrics_store=metrics_store,
+        **trainer_kwargs
+    )
+
+    # Train the head and get losses
+    temporal_losses = temporal_trainer.train()
+
+    # The head shares its modules with vvt_model, so this is the complete fine-tuned model
+    finetuned_path = os.path.join(temporal_trainer.project_dir, 'vvt_temporal_finetuned.pt')
+    torch.save({'model_state_dict': vvt_model.state_dict()}, finetuned_path)
+    colored_print(f"Fine-tuned model saved to {finetuned_path}", color_code=36)
+    temporal_trainer.cleanup()
+
+    return temporal_losses
+
+# Wrapper to distill a trained teacher (ResNet or larger Video Vision Transformer) into a small Video Vision Transformer,
+# with the teacher logits computed once per clip (see distillation.py)
+def train_distilled_video_vision_transformer(project_name, root_dir, teacher_checkpoint, teacher_name='resnet', teacher_vvt_params=None, num_epochs=100, batch_size=16, lr=3e-4, weight_decay=0.0, device='cpu', vvt_params=None,
+                                             temperature=4.0, alpha=0.5, metrics_store=None, num_workers=8, cache_dir=None, teacher_cache_dir='./trained_models/teacher_logits', **trainer_kwargs):
+    frames = frames_of(project_name)
+    teacher_model = load_trained_model(teacher_checkpoint, teacher_name, frames, teacher_vvt_params, device=device)
+    vvt_model = build_video_vision_transformer(frames, vvt_params)
+
+    print("\n\n")
+
+    train_loader, test_loader, val_loader = create_distillation_loaders(os.path.join(root_dir, project_name), teacher_model, batch_size, num_workers=num_workers, cache_dir=teacher_cache_dir, video_cache_dir=cache_dir, device=device)
+    # The logits are cached and the cache released the teacher, drop the last reference
+    del teacher_model
+
+    criterion = DistillationLoss(temperature=temperature, alpha=alpha)
+
+    vvt_optimizer = torch.optim.Adam(vvt_model.parameters(), lr=lr, weight_decay=weight_decay)
+
+    distilled_trainer = VideoTraining(
+        model=vvt_model,
+        model_name='vvt_distilled',
+        train_loader=train_loader,
+        test_loader=test_loader,
+        validation_loader=val_loader,
+        num_epochs=num_epochs,
+        criterion=criterion,
+        optimizer=vvt_optimizer,
+        device=device,
+        project_name=project_name,
+        weight_decay=weight_decay,
+        metrics_store=metrics_store,
+        **trainer_kwargs
     )
 
+    # Train the student and get losses
+    distilled_losses = distilled_trainer.train()
+    distilled_trainer.cleanup()
+
+    return distilled_losses
+
+# Wrapper to train a Video Resnet model
+def train_resnet(project_name, root_dir, num_epochs=100, batch_size=16, lr=3e-4, weight_decay=0.0, device='cpu', distributed=False, metrics_store=None, num_workers=8, cache_dir=None, channels_last=False, **trainer_kwargs):
+    model = build_resnet()
+
     print("\n\n")
 
-    train_loader, test_loader, val_loader = VideoDataLoader.create_loaders(os.path.join(root_dir, project_name), batch_size, num_workers=8)
+    # channels_last: NDHWC batches and weights for the oneDNN 3D convolutions
+    train_loader, test_loader, val_loader = VideoDataLoader.create_loaders(os.path.join(root_dir, project_name), batch_size, num_workers=num_workers, distributed=distributed, cache_dir=cache_dir, channels_last=channels_last)
 
     criterion = torch.nn.CrossEntropyLoss()
 
@@ -87,7 +203,11 @@ def train_resnet(project_name, root_dir, num_epochs=100, batch_size=16, lr=3e-4,
         optimizer=resnet_optimizer,
         device=device,
         project_name=project_name,
-        weight_decay=weight_decay
+        weight_decay=weight_decay,
+        distributed=distributed,
+        metrics_store=metrics_store,
+        channels_last=channels_last,
+        **trainer_kwargs
     )
 
     # Train the model and get losses
@@ -95,22 +215,23 @@ def train_resnet(project_name, root_dir, num_epochs=100, batch_size=16, lr=3e-4,
     resnet_trainer.cleanup
     return resnet_losses
 
-# Check if the losses file exists, if not, create it
-def create_losses_file(losses_file):
-    directory = os.path.dirname(losses_file)
-    if not os.path.exists(directory):
-        os.makedirs(directory)
-    if not os.path.exists(losses_file):
-        with open(losses_file, 'w') as f:
-            json.dump({}, f)
-
 if __name__ == '__main__':
     seed_everything(10000000)
+
+    # Launched with torchrun: one gloo process per slice of cores, possibly across nodes
+    distributed = launched_with_torchrun()
+    if distributed:
+        setup_distributed(backend='gloo')
+
     root_dir = './datasets'
     #projects = ['5_Frames', '4_Frames', '3_Frames', '2_Frames']
     projects = ['2_Frames']
 
     experiment_name = 'Data Collection 1'
+    # Every run appends to its own file here; see metrics_store.py and plot_metrics.py
+    metrics_dir = './trained_models/metrics'
+    # Pick batch size, DataLoader workers and torch threads for this machine (see autotune.py)
+    use_autotune = False
     all_losses = {}
 
     for project_name in projects:
@@ -118,21 +239,26 @@ if __name__ == '__main__':
         colored_print(f"Training VVT on {project_name}", color_code=36)
         num_epochs = 75
         batch_size = 64
+        num_workers = 8
         lr = 4e-4
         weight_decay = 1e-4
         device = 'cpu'
-        losses_file = f"./trained_models/losses.json"
-        create_losses_file(losses_file)  
-        vvt_losses = train_video_vision_transformer(project_name=project_name, root_dir=root_dir, num_epochs=num_epochs, batch_size=batch_size, lr=lr, weight_decay=weight_decay, device=device)
+        if use_autotune:
+            from autotune import AutoTuner
+            tuned = AutoTuner(os.path.join(root_dir, project_name), model_name='vvt').tune()
+            batch_size, num_workers = tuned['batch_size'], tuned['num_workers']
+            torch.set_num_threads(tuned['num_threads'])
+        config = {'experiment': experiment_name, 'num_epochs': num_epochs, 'batch_size': batch_size, 'lr': lr, 'weight_decay': weight_decay}
+        metrics_store = MetricsStore(metrics_dir, name=f"{project_name}_VVT", config=config) if is_main_process() else None
+        vvt_losses = train_video_vision_transformer(project_name=project_name, root_dir=root_dir, num_epochs=num_epochs, batch_size=batch_size, lr=lr, weight_decay=weight_decay, device=device, distributed=distributed, metrics_store=metrics_store, num_workers=num_workers)
         all_losses[f"{project_name}_VVT"] = vvt_losses
-        with open(losses_file, 'r') as f:
-            all_experiment_losses = json.load(f)
-            all_experiment_losses[f"{project_name}_VVT"] = vvt_losses
-        with open(losses_file, 'w') as f:
-            json.dump(all_experiment_losses, f)
+        if metrics_store is not None:
+            metrics_store.close()
 
         print("----------------------------------------------------------")
 
+    cleanup_distributed()
+
     """
     projects = ['5_Frames']
 
@@ -144,15 +270,11 @@ if __name__ == '__main__':
         lr = 1e-3
         weight_decay = 1e-4
         device = 'cpu'
-        losses_file = f"./trained_models/losses.json"
-        create_losses_file(losses_file)  
-        resnet_losses = train_resnet(project_name=project_name, root_dir=root_dir, num_epochs=num_epochs, batch_size=batch_size, lr=lr, weight_decay=weight_decay, device=device)
+        config = {'experiment': experiment_name, 'num_epochs': num_epochs, 'batch_size': batch_size, 'lr': lr, 'weight_decay': weight_decay}
+        metrics_store = MetricsStore(metrics_dir, name=f"{project_name}_Resnet", config=config)
+        resnet_losses = train_resnet(project_name=project_name, root_dir=root_dir, num_epochs=num_epochs, batch_size=batch_size, lr=lr, weight_decay=weight_decay, device=device, metrics_store=metrics_store)
         all_losses[f"{project_name}_Resnet"] = resnet_losses
-        with open(losses_file, 'r') as f:
-            all_experiment_losses = json.load(f)
-            all_experiment_losses[f"{project_name}_Resnet"] = resnet_losses
-        with open(losses_file, 'w') as f:
-            json.dump(all_experiment_losses, f)
+        metrics_store.close()
 
         print("----------------------------------------------------------")
-        """
\ No newline at end of file
+        """
@@ -2,20 +2,79 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 from torch.optim.lr_scheduler import StepLR
+from torch.nn.parallel import DistributedDataParallel
 import os
 import time
 from tqdm import tqdm
-from sklearn.metrics import precision_recall_fscore_support, confusion_matrix
+from sklearn.metrics import confusion_matrix
 import seaborn as sns
 import matplotlib.pyplot as plt
-from utils import colored_print
+from utils import colored_print, autocast
+from distributed import is_main_process
+from evaluator import Evaluator
+from metrics import MetricsAccumulator
+from profiler import TrainingProfiler
+from compilation import compile_model
 
 
 class VideoTraining:
-    def __init__(self, model, model_name, train_loader, test_loader, validation_loader, num_epochs, criterion, optimizer, device, project_name, checkpoint_interval=None, weight_decay=1e-4):
+    # Autocast dtype per precision. bfloat16 has the exponent range of float32, so it needs no loss scaling
+    PRECISIONS = {'float32': None, 'bfloat16': torch.bfloat16}
+
+    def __init__(self, model, model_name, train_loader, test_loader, validation_loader, num_epochs, criterion, optimizer, device, project_name, checkpoint_interval=None, weight_decay=1e-4, distributed=False,
+                 eval_interval=1, eval_on_plateau=False, plateau_patience=3, early_stopping_patience=None, log_interval=10,
+                 metrics_store=None, run_name=None, resume_from=None, profile=False, trace_steps=None, precision='float32',
+                 torch_compile=False, channels_last=False):
         """
         Initializes the VideoTraining class.
+
+        Test and validation run together in one interleaved pass (see evaluator.py). eval_interval evaluates
+        every N epochs. With eval_on_plateau, only validation runs on that schedule and the test split is
+        evaluated once the validation loss has not improved for plateau_patience evaluations.
+        early_stopping_patience stops training after that many evaluations without improvement.
+
+        Metrics are accumulated on the device (see metrics.py) and only synchronized every log_interval
+        steps for the progress bar, and at the end of the epoch. If a MetricsStore is given (see metrics_store.py),
+        the metrics are appended to it at those same points, so they survive a crash.
+
+        run_name puts the checkpoints in trained_models/<project_name>/<run_name>, so runs on the same dataset
+        (e.g. the trials of a sweep) do not overwrite each other. resume_from continues training from a
+        checkpoint written by save_checkpoint, up to num_epochs in total.
+
+        profile=True records per epoch the time spent waiting on data, in forward, backward, optimizer step,
+        evaluation and checkpointing, plus samples/s and peak RSS (see profiler.py). trace_steps=(first, last)
+        additionally records those training steps with torch.profiler.
+
+        precision='bfloat16' runs the forward pass of training and evaluation under CPU autocast. Matmuls and
+        convolutions run in bfloat16 (fast on CPUs with AVX512-BF16 or AMX), while the weights, the loss,
+        the L2 term and the optimizer stay in float32. At the end of training the validation split is
+        evaluated in both float32 and bfloat16 and the difference is reported under 'Precision Parity'.
+
+        torch_compile=True compiles the model in place with torch.compile (see compilation.py). The first
+        epoch pays for the compilation, later runs reuse the on-disk cache. Checkpoints are unaffected.
+
+        channels_last=True converts the weights and the input videos to channels_last_3d (NDHWC), the layout
+        the oneDNN 3D convolutions prefer on CPU. Meant for the ResNet; pair it with
+        VideoDataLoader.create_loaders(channels_last=True) so the workers already produce that layout.
+
+        With distributed=True the model is wrapped in DistributedDataParallel (gloo on CPU), the loaders are
+        expected to use a DistributedSampler, metrics are all-reduced over the ranks and only rank 0 prints
+        and saves checkpoints. See distributed.py for setting up the process group.
         """
+        if precision not in self.PRECISIONS:
+            raise ValueError(f"Unknown precision '{precision}', expected one of {list(self.PRECISIONS)}")
+        self.precision = precision
+        self.autocast_dtype = self.PRECISIONS[precision]
+
+        self.memory_format = torch.channels_last_3d if channels_last else torch.preserve_format
+        if channels_last:
+            model = model.to(memory_format=torch.channels_last_3d)
+
+        self.distributed = distributed
+        if self.distributed:
+            model = DistributedDataParallel(model)
+        if torch_compile:
+            model = compile_model(model, mode='compile')
         self.model = model
         self.model_name = model_name
         self.train_loader = train_loader
@@ -28,6 +87,10 @@ class VideoTraining:
         self.project_name = project_name
         self.checkpoint_interval = checkpoint_interval
         self.weight_decay = weight_decay
+        self.log_interval = log_interval
+        self.profiler = TrainingProfiler(enabled=profile, trace_steps=trace_steps)
+        # Only rank 0 writes metrics
+        self.metrics_store = metrics_store if is_main_process() else None
         
         # Initialize lists to store metrics after each epoch
         self.train_losses = []
@@ -42,14 +105,41 @@ class VideoTraining:
         self.validation_recall = []
         self.test_f1 = []
         self.validation_f1 = []
+        # Epochs at which each split was evaluated
+        self.test_epochs = []
+        self.validation_epochs = []
+
+        self.evaluator = Evaluator(
+            model=self.model,
+            criterion=self.criterion,
+            device=self.device,
+            loaders={'Test': self.test_loader, 'Validation': self.validation_loader},
+            monitor='Validation',
+            eval_interval=eval_interval,
+            eval_on_plateau=eval_on_plateau,
+            plateau_patience=plateau_patience,
+            early_stopping_patience=early_stopping_patience,
+            log_interval=log_interval,
+            autocast_dtype=self.autocast_dtype,
+            memory_format=self.memory_format
+        )
 
         # Create a directory to save trained models within the project directory
         self.project_dir = os.path.join('trained_models', self.project_name)
-        os.makedirs(self.project_dir, exist_ok=True)
+        if run_name is not None:
+            self.project_dir = os.path.join(self.project_dir, run_name)
+        if is_main_process():
+            os.makedirs(self.project_dir, exist_ok=True)
 
         # Learning rate scheduler
         self.scheduler = StepLR(self.optimizer, step_size=30, gamma=0.1)
 
+        self.start_epoch = 0
+        self.last_checkpoint = resume_from
+        self.stopped_early = False
+        if resume_from is not None:
+            self.load_checkpoint(resume_from)
+
         if self.checkpoint_interval is None:
             if self.model_name == 'vvt':
                 self.checkpoint_interval = 25
@@ -62,80 +152,117 @@ class VideoTraining:
         """
         start_time = time.time()
 
-        for epoch in range(self.num_epochs):
+        for epoch in range(self.start_epoch, self.num_epochs):
+            self.profiler.start_epoch()
             self.model.train()
-            running_loss = 0.0
-            correct_batch = 0
-            total_batch = 0
+            train_metrics = MetricsAccumulator(device=self.device)
 
-            train_loader_with_progress = tqdm(self.train_loader, desc=f'Epoch [{epoch+1}/{self.num_epochs}] (training)', position=0, leave=True)
+            # Reshuffle the shards of every rank
+            if self.distributed:
+                for loader in (self.train_loader, self.test_loader, self.validation_loader):
+                    if hasattr(loader.sampler, 'set_epoch'):
+                        loader.sampler.set_epoch(epoch)
 
-            for videos, labels in train_loader_with_progress:
-                videos = videos.to(self.device)
+            train_loader_with_progress = tqdm(self.train_loader, desc=f'Epoch [{epoch+1}/{self.num_epochs}] (training)', position=0, leave=True, disable=not is_main_process())
+
+            # Loaders may yield extra targets after the labels (e.g. teacher logits, see distillation.py),
+            # which are passed on to the criterion
+            for step, (videos, labels, *targets) in enumerate(train_loader_with_progress, start=1):
+                self.profiler.step_started(labels.size(0))
+                videos = videos.to(self.device, memory_format=self.memory_format)
                 labels = labels.to(self.device)
+                targets = [target.to(self.device) for target in targets]
 
                 self.optimizer.zero_grad()
-                outputs = self.model(videos)
-                loss = self.criterion(outputs, labels)
-
-                # Apply L2 regularization
-                l2_regularization = sum(torch.norm(param, p=2) ** 2 for param in self.model.parameters())
-                loss += 0.5 * self.weight_decay * l2_regularization  # 0.5 * weight_decay * ||w||^2
-
-                loss.backward()
-
-                self.optimizer.step()
-
-                running_loss += loss.item()
-
-                _, predicted_batch = outputs.max(1)
-                total_batch += labels.size(0)
-                correct_batch += predicted_batch.eq(labels).sum().item()
-
-                train_loader_with_progress.set_postfix({'Train Loss (Batch)': loss.item(),
-                                                        'Train Acc (Batch)': 100. * correct_batch / total_batch,
-                                                        'Train Loss': running_loss / len(self.train_loader)})
-
-            epoch_accuracy = 100. * correct_batch / total_batch
-            train_loader_with_progress.set_postfix({'Train Loss': running_loss / len(self.train_loader), 'Train Acc': epoch_accuracy})
-
-            self.train_losses.append(running_loss / len(self.train_loader))
-            self.train_accuracy.append(100. * correct_batch / total_batch)
-
-            # Conduct test and log metrics
-            avg_test_loss, test_accuracy, test_precision, test_recall, test_f1, _, _ = self.test(epoch)
-            self.test_losses.append(avg_test_loss)
-            self.test_accuracy.append(test_accuracy)
-            self.test_precision.append(test_precision)
-            self.test_recall.append(test_recall)
-            self.test_f1.append(test_f1)
-
-            # Conduct validation and log metrics
-            avg_validation_loss, validation_accuracy, validation_precision, validation_recall, validation_f1, _, _ = self.validate(epoch)
-            self.validation_losses.append(avg_validation_loss)
-            self.validation_accuracy.append(validation_accuracy)
-            self.validation_precision.append(validation_precision)
-            self.validation_recall.append(validation_recall)
-            self.validation_f1.append(validation_f1)
+                with self.profiler.phase('Forward'):
+                    with autocast(self.device, self.autocast_dtype):
+                        outputs = self.model(videos)
+                    # Loss and regularization in float32
+                    outputs = outputs.float()
+                    loss = self.criterion(outputs, labels, *targets)
+
+                    # Apply L2 regularization
+                    l2_regularization = sum(torch.norm(param, p=2) ** 2 for param in self.model.parameters())
+                    loss += 0.5 * self.weight_decay * l2_regularization  # 0.5 * weight_decay * ||w||^2
+
+                with self.profiler.phase('Backward'):
+                    loss.backward()
+
+                with self.profiler.phase('Optimizer'):
+                    self.optimizer.step()
+
+                train_metrics.update(loss, outputs, labels)
+
+                # Synchronize with the host only every log_interval steps
+                if step % self.log_interval == 0 and is_main_process():
+                    running = train_metrics.compute()
+                    batch_loss = loss.item()
+                    train_loader_with_progress.set_postfix({'Train Loss (Batch)': batch_loss,
+                                                            'Train Acc': running['Accuracy'],
+                                                            'Train Loss': running['Loss']})
+                    if self.metrics_store is not None:
+                        self.metrics_store.log_step('Train', epoch, step, {'Loss': running['Loss'], 'Accuracy': running['Accuracy'], 'Batch Loss': batch_loss})
+
+                self.profiler.step_finished()
+
+            # Sum over all ranks (no-op when not distributed)
+            train_metrics.all_reduce()
+            epoch_metrics = train_metrics.compute()
+            avg_train_loss = epoch_metrics['Loss']
+            epoch_accuracy = epoch_metrics['Accuracy']
+
+            train_loader_with_progress.set_postfix({'Train Loss': avg_train_loss, 'Train Acc': epoch_accuracy})
+
+            self.train_losses.append(avg_train_loss)
+            self.train_accuracy.append(epoch_accuracy)
+
+            # Conduct test and validation in one pass and log metrics
+            splits = self.evaluator.splits_to_evaluate(epoch, self.num_epochs)
+            with self.profiler.phase('Evaluation'):
+                results = self.evaluator.evaluate(epoch, self.num_epochs, splits) if splits else {}
+            self._log_evaluation(epoch, results)
+            if self.metrics_store is not None:
+                self.metrics_store.log_epoch('Train', epoch, {'Loss': avg_train_loss, 'Accuracy': epoch_accuracy})
+                for split, (avg_loss, accuracy, precision, recall, f1, _, _) in results.items():
+                    self.metrics_store.log_epoch(split, epoch, {'Loss': avg_loss, 'Accuracy': accuracy, 'Precision': precision, 'Recall': recall, 'F1-Score': f1})
+            stop_early = self.evaluator.update(results)
 
             # Print train, test, and validation metrics
-            print(f"Epoch [{epoch+1}/{self.num_epochs}]")
-            print("{:<20} {:<20} {:<20}".format("", "Loss", "Accuracy", "Precision", "Recall", "F1-Score"))
-            print("{:<20} {:<20.4f} {:<20.3f}% {:<20.3f} {:<20.3f} {:<20.3f}".format("Train", running_loss / len(self.train_loader), epoch_accuracy, _, _, _))
-            print("{:<20} {:<20.4f} {:<20.3f}% {:<20.3f} {:<20.3f} {:<20.3f}".format("Test", avg_test_loss, test_accuracy, test_precision, test_recall, test_f1))
-            print("{:<20} {:<20.4f} {:<20.3f}% {:<20.3f} {:<20.3f} {:<20.3f}".format("Validation", avg_validation_loss, validation_accuracy, validation_precision, validation_recall, validation_f1))
-            print()  # Add a newline for spacing between epochs
+            if is_main_process():
+                print(f"Epoch [{epoch+1}/{self.num_epochs}]")
+                print("{:<20} {:<20} {:<20}".format("", "Loss", "Accuracy", "Precision", "Recall", "F1-Score"))
+                print("{:<20} {:<20.4f} {:<20.3f}%".format("Train", avg_train_loss, epoch_accuracy))
+                for split, (avg_loss, accuracy, precision, recall, f1, _, _) in results.items():
+                    print("{:<20} {:<20.4f} {:<20.3f}% {:<20.3f} {:<20.3f} {:<20.3f}".format(split, avg_loss, accuracy, precision, recall, f1))
+                print()  # Add a newline for spacing between epochs
 
             # Save checkpoint if needed
-            if (epoch + 1) % self.checkpoint_interval == 0 or epoch == self.num_epochs - 1:
-                self.save_checkpoint(epoch)
+            if ((epoch + 1) % self.checkpoint_interval == 0 or epoch == self.num_epochs - 1 or stop_early) and is_main_process():
+                with self.profiler.phase('Checkpoint'):
+                    self.save_checkpoint(epoch)
+
+            profile_summary = self.profiler.end_epoch()
+            if profile_summary is not None and is_main_process():
+                TrainingProfiler.print_summary(profile_summary)
+                print()
+                if self.metrics_store is not None:
+                    self.metrics_store.log_epoch('Profile', epoch, profile_summary)
+
+            if stop_early:
+                self.stopped_early = True
+                break
 
             # Step the learning rate scheduler
             self.scheduler.step()
 
+        self.profiler.close()
         end_time = time.time()
         total_training_time = end_time - start_time
 
+        parity = self.precision_parity() if self.autocast_dtype is not None else None
+        if self.metrics_store is not None:
+            self.metrics_store.log_summary(total_training_time)
+
         losses_dict = {
             'Train': {
                 'Loss': self.train_losses,
@@ -146,64 +273,64 @@ class VideoTraining:
                 'Accuracy': self.test_accuracy,
                 'Precision': self.test_precision,
                 'Recall': self.test_recall,
-                'F1-Score': self.test_f1
+                'F1-Score': self.test_f1,
+                'Epoch': self.test_epochs
             },
             'Validation': {
                 'Loss': self.validation_losses,
                 'Accuracy': self.validation_accuracy,
                 'Precision': self.validation_precision,
                 'Recall': self.validation_recall,
-                'F1-Score': self.validation_f1
+                'F1-Score': self.validation_f1,
+                'Epoch': self.validation_epochs
             },
-            'Training Time': total_training_time
+            'Training Time': total_training_time,
+            'Stopped Early': self.stopped_early,
+            'Checkpoint': self.last_checkpoint
         }
+        if self.profiler.enabled:
+            losses_dict['Profile'] = self.profiler.history
+        if parity is not None:
+            losses_dict['Precision Parity'] = parity
 
         return losses_dict
 
 
-    def test(self, epoch):
+    def _log_evaluation(self, epoch, results):
         """
-        Tests the model on the test dataset and computes additional evaluation metrics.
+        Appends the metrics of the evaluated splits to the per-split lists.
 
         Parameters:
         - epoch: Current epoch number.
+        - results: The dictionary returned by Evaluator.evaluate.
         """
-        self.model.eval()
-        test_loss = 0.0
-        correct = 0
-        total = 0
-        false_positives = 0
-        false_negatives = 0
-
-        with torch.no_grad():
-            test_loader_with_progress = tqdm(self.test_loader, desc=f'Epoch [{epoch+1}/{self.num_epochs}] (testing)', position=0, leave=True)
-
-            all_labels = []
-            all_predicted = []
-
-            for videos, labels in test_loader_with_progress:
-                videos = videos.to(self.device)
-                labels = labels.to(self.device)
-                outputs = self.model(videos)
-                loss = self.criterion(outputs, labels)
-                test_loss += loss.item()
-
-                _, predicted = outputs.max(1)
-                total += labels.size(0)
-                correct += predicted.eq(labels).sum().item()
-
-                all_labels.extend(labels.cpu().numpy())
-                all_predicted.extend(predicted.cpu().numpy())
+        if 'Test' in results:
+            avg_test_loss, test_accuracy, test_precision, test_recall, test_f1, _, _ = results['Test']
+            self.test_losses.append(avg_test_loss)
+            self.test_accuracy.append(test_accuracy)
+            self.test_precision.append(test_precision)
+            self.test_recall.append(test_recall)
+            self.test_f1.append(test_f1)
+            self.test_epochs.append(epoch)
 
-                test_loader_with_progress.set_postfix({'Test Loss': test_loss / len(self.test_loader),
-                                                    'Test Acc': 100. * correct / total})
+        if 'Validation' in results:
+            avg_validation_loss, validation_accuracy, validation_precision, validation_recall, validation_f1, _, _ = results['Validation']
+            self.validation_losses.append(avg_validation_loss)
+            self.validation_accuracy.append(validation_accuracy)
+            self.validation_precision.append(validation_precision)
+            self.validation_recall.append(validation_recall)
+            self.validation_f1.append(validation_f1)
+            self.validation_epochs.append(epoch)
 
-            avg_test_loss = test_loss / len(self.test_loader)
 
-            # Calculate metrics using sklearn functions
-            precision, recall, f1, _= precision_recall_fscore_support(all_labels, all_predicted, average='binary', zero_division=0)
+    def test(self, epoch):
+        """
+        Tests the model on the test dataset and computes additional evaluation metrics.
 
-            return avg_test_loss, 100. * correct / total, precision, recall, f1, false_positives, false_negatives
+        Parameters:
+        - epoch: Current epoch number.
+        """
+        return self.evaluator.evaluate(epoch, self.num_epochs, ['Test'])['Test']
 
 
     def validate(self, epoch):
@@ -213,42 +340,28 @@ class VideoTraining:
         Parameters:
         - epoch: Current epoch number.
         """
-        self.model.eval()
-        validation_loss = 0.0
-        correct = 0
-        total = 0
-        false_positives = 0
-        false_negatives = 0
-
-        with torch.no_grad():
-            validation_loader_with_progress = tqdm(self.validation_loader, desc=f'Epoch [{epoch+1}/{self.num_epochs}] (validating)', position=0, leave=True)
-
-            all_labels = []
-            all_predicted = []
-
-            for videos, labels in validation_loader_with_progress:
-                videos = videos.to(self.device)
-                labels = labels.to(self.device)
-                outputs = self.model(videos)
-                loss = self.criterion(outputs, labels)
-                validation_loss += loss.item()
-
-                _, predicted = outputs.max(1)
-                total += labels.size(0)
-                correct += predicted.eq(labels).sum().item()
-
-                all_labels.extend(labels.cpu().numpy())
-                all_predicted.extend(predicted.cpu().numpy())
+        return self.evaluator.evaluate(epoch, self.num_epochs, ['Validation'])['Validation']
 
-                validation_loader_with_progress.set_postfix({'Validation Loss': validation_loss / len(self.validation_loader),
-                                                    'Validation Acc': 100. * correct / total})
 
-            avg_validation_loss = validation_loss / len(self.validation_loader)
-
-            # Calculate metrics using sklearn functions
-            precision, recall, f1, _ = precision_recall_fscore_support(all_labels, all_predicted, average='binary', zero_division=0)
+    def precision_parity(self):
+        """
+        Evaluates the validation split in float32 and in the training precision and prints the difference.
 
-            return avg_validation_loss, 100. * correct / total, precision, recall, f1, false_positives, false_negatives
+        Returns:
+        - dict: See Evaluator.precision_parity.
+        """
+        parity = self.evaluator.precision_parity(self.num_epochs - 1, self.num_epochs, 'Validation')
+        if is_main_process():
+            colored_print(f"Validation parity, {self.precision} vs float32:", color_code=36)
+            print("{:<20} {:<20} {:<20} {:<20}".format("", "Loss", "Accuracy", "F1-Score"))
+            for name, metrics in parity.items():
+                if isinstance(metrics, dict):
+                    print("{:<20} {:<20.4f} {:<20.3f}% {:<20.3f}".format(name, metrics['Loss'], metrics['Accuracy'], metrics['F1-Score']))
+            print("{:<20} {:<20.4f} {:<20.3f}% {:<20.3f}".format("Delta", parity['Loss Delta'], parity['Accuracy Delta'], parity['F1 Delta']))
+            print()
+            if self.metrics_store is not None:
+                self.metrics_store.log_epoch('Precision Parity', self.num_epochs - 1, {key: value for key, value in parity.items() if not isinstance(value, dict)})
+        return parity
 
 
         
@@ -260,18 +373,43 @@ class VideoTraining:
         - epoch: Current epoch number.
         """
         checkpoint_path = os.path.join(self.project_dir, f'{self.model_name}_checkpoint_epoch{epoch + 1}.pt')
+        # Save the weights without the DistributedDataParallel 'module.' prefix so the checkpoint loads anywhere
+        model = self.model.module if isinstance(self.model, DistributedDataParallel) else self.model
         torch.save({
             'epoch': epoch,
-            'model_state_dict': self.model.state_dict(),
+            'model_state_dict': model.state_dict(),
             'optimizer_state_dict': self.optimizer.state_dict(),
+            'scheduler_state_dict': self.scheduler.state_dict(),
+            'evaluator_state_dict': self.evaluator.state_dict(),
         }, checkpoint_path)
+        self.last_checkpoint = checkpoint_path
         colored_print(f"Checkpoint saved at epoch {epoch+1}", color_code=36)
 
 
+    def load_checkpoint(self, checkpoint_path):
+        """
+        Restores the model, optimizer, scheduler and early stopping state from a checkpoint and continues after its epoch.
+
+        Parameters:
+        - checkpoint_path: Path to a checkpoint written by save_checkpoint.
+        """
+        checkpoint = torch.load(checkpoint_path, map_location=self.device)
+        model = self.model.module if isinstance(self.model, DistributedDataParallel) else self.model
+        model.load_state_dict(checkpoint['model_state_dict'])
+        self.optimizer.load_state_dict(checkpoint['optimizer_state_dict'])
+        if 'scheduler_state_dict' in checkpoint:
+            self.scheduler.load_state_dict(checkpoint['scheduler_state_dict'])
+        # Early stopping continues where it was instead of starting over
+        if 'evaluator_state_dict' in checkpoint:
+            self.evaluator.load_state_dict(checkpoint['evaluator_state_dict'])
+        self.start_epoch = checkpoint['epoch'] + 1
+
+
     def cleanup(self):
             """
             Releases all resources.
             """
+            del self.evaluator
             del self.model
             del self.train_loader
             del self.test_loader
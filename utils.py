@@ -141,6 +141,41 @@ def check_cuda_availability():
     else:
         print("CUDA is not available.")
 
+def pin_to_cores(slot, num_slots, num_threads=None):
+    """
+    Pins the current process to a contiguous slice of the cores it is allowed to run on
+    and sets the number of intra-op threads to match.
+
+    Parameters:
+    - slot: Index of the slice this process should use.
+    - num_slots: Number of processes sharing the cores of this machine.
+    - num_threads: Number of torch threads. Defaults to the number of cores in the slice.
+
+    Returns:
+    - list: The cores this process is pinned to.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        available = sorted(os.sched_getaffinity(0))
+    else:
+        available = list(range(os.cpu_count() or 1))
+
+    cores_per_slot = max(1, len(available) // num_slots)
+    start = (slot % num_slots) * cores_per_slot
+    cores = available[start:start + cores_per_slot] or available
+
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(num_threads or len(cores))
+
+    return cores
+
+def autocast(device, dtype=None):
+    """
+    Autocast context for the device type of device, e.g. autocast('cpu', torch.bfloat16).
+    A no-op when dtype is None.
+    """
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype, enabled=dtype is not None)
+
 def seed_everything(seed):
     random.seed(seed)
     os.environ['PYTHONHASHSEED'] = str(seed)